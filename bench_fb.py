@@ -0,0 +1,259 @@
+import sys
+import os
+import json
+import time
+import datetime
+import calendar
+import resource
+import subprocess
+import tempfile
+import threading
+
+import mock_graph_server
+
+# End-to-end benchmark of the scraper against mock_graph_server.  One scenario per run so peak RSS is that scenario's:
+#   scrape   scrape_fb_pages_items over the posts of every page
+#   csv      scrape_posts_to_csv (--output=<format> to use an output sink)
+#   elastic  social_elastic.fb_main, scraping and bulk indexing owned pages' posts and videos
+# Results are appended to BENCH_RESULTS_PATH and compared with the last run of the same scenario and settings.
+# --record=<path> archives the run's Graph API traffic and --replay=<path> serves it back from the archive instead of the
+# mock server, for repeatable runs of the processing code alone.
+# python bench_fb.py <scrape/csv/elastic> [--pages=20] [--owned=5] [--posts-per-day=8] [--days=90] [--latency-ms=0]
+#                    [--error-rate=0] [--throttle-rate=0] [--usage=10] [--usage-headers=1] [--token-rate=0] [--token-pool=1]
+#                    [--shares=0] [--output=<format>] [--shared-links=0] [--profile=owned-full] [--competitor-profile=<profile>]
+#                    [--replay=<path>] [--record=<path>] [--label=<text>] [--results=<path>]
+# Each owned page has its own token; --token-rate caps each token's calls per second at the mock server and --token-pool=0
+# sends every competitor request with the one default token as before the pool.  --shares=1 looks up public URL shares
+# for every post, which is most of the requests made for competitors' pages, and --shared-links=0.3 has 30% of link posts
+# link an article common to every page.  --profile and --competitor-profile pick get_fb_data's fetch profiles;
+# mb_received is the size of the Graph API responses.  --usage-headers=0 sends no X-App-Usage, so with --throttle-rate
+# tokens have only their successful responses to recover by; rate_limits gives each token's state at the end of the run
+BENCH_RESULTS_PATH = './facebook_output/bench_results.jsonl'
+BENCH_TOKEN = 'mock-token'
+
+BENCH_DEFAULTS = {
+    'pages': 20,
+    'owned': 5,
+    'posts-per-day': 8,
+    'days': 90,
+    'latency-ms': 0,
+    'error-rate': 0.0,
+    'throttle-rate': 0.0,
+    'usage': 10,
+    'usage-headers': 1,
+    'token-rate': 0,
+    'token-pool': 1,
+    'shares': 0,
+    'shared-links': 0.0,
+    'output': None,
+    'profile': 'owned-full',
+    'competitor-profile': None,
+    'replay': None
+}
+
+
+def percentile(sorted_values, fraction):
+    if len(sorted_values) == 0:
+        return None
+    return sorted_values[int(round(fraction * (len(sorted_values) - 1)))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on OS X
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0), 1)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_bench_options(argv):
+    settings = dict(BENCH_DEFAULTS)
+    extras = {'label': None, 'results': BENCH_RESULTS_PATH, 'record': None}
+    positional = []
+    for arg in argv:
+        if not arg.startswith('--'):
+            positional.append(arg)
+            continue
+        name, _, value = arg[2:].partition('=')
+        if name in extras:
+            extras[name] = value
+        elif name not in settings:
+            raise SystemExit('Unknown option --{}'.format(name))
+        elif isinstance(BENCH_DEFAULTS[name], float):
+            settings[name] = float(value)
+        elif isinstance(BENCH_DEFAULTS[name], int):
+            settings[name] = int(value)
+        else:
+            settings[name] = value
+    return positional, settings, extras
+
+
+def configure_mock_server(settings):
+    mock_graph_server.MOCK_POSTS_PER_DAY = settings['posts-per-day']
+    mock_graph_server.MOCK_DAYS = settings['days']
+    mock_graph_server.MOCK_LATENCY_MEDIAN_MS = settings['latency-ms']
+    mock_graph_server.MOCK_ERROR_RATE = settings['error-rate']
+    mock_graph_server.MOCK_THROTTLE_RATE = settings['throttle-rate']
+    mock_graph_server.MOCK_APP_USAGE = settings['usage']
+    mock_graph_server.MOCK_USAGE_HEADERS_BOOL = bool(settings['usage-headers'])
+    mock_graph_server.MOCK_TOKEN_CALLS_PER_SECOND = settings['token-rate']
+    mock_graph_server.MOCK_SHARED_LINK_RATE = settings['shared-links']
+    return mock_graph_server.start_mock_graph_server()
+
+
+def time_graph_requests(get_fb_data):
+    # Wrap the single point every Graph API call goes through to time it.  Returns the list latencies are added to
+    latencies = []
+    send_http_request = get_fb_data.send_http_request
+
+    def timed_send_http_request(url, data=None):
+        t0 = time.time()
+        try:
+            return send_http_request(url, data)
+        finally:
+            latencies.append(time.time() - t0)
+
+    get_fb_data.send_http_request = timed_send_http_request
+    return latencies
+
+
+def count_scraped_items(get_fb_data):
+    # Every engine scrapes each page (or back-fill window) through scrape_single_fb_page_items.  Returns the running count
+    item_count = [0]
+    item_count_lock = threading.Lock()
+    scrape_single_fb_page_items = get_fb_data.scrape_single_fb_page_items
+
+    def counted_scrape_single_fb_page_items(*args, **kwargs):
+        rows = scrape_single_fb_page_items(*args, **kwargs)
+        with item_count_lock:
+            item_count[0] += len(rows)
+        return rows
+
+    get_fb_data.scrape_single_fb_page_items = counted_scrape_single_fb_page_items
+    return item_count
+
+
+def run_scenario(scenario, settings, extras, base_url):
+    os.environ.setdefault('MY_TOKEN', BENCH_TOKEN)
+    import get_fb_data
+
+    page_ids = ['benchpage{}'.format(n) for n in range(settings['pages'])]
+    owned_pages_tokens = dict((page_id, '{}-{}'.format(BENCH_TOKEN, page_id)) for page_id in page_ids[:settings['owned']])
+    get_fb_data.GRAPH_API_HOST = base_url
+    get_fb_data.OWNED_PAGES_TOKENS = owned_pages_tokens or {'benchapp': BENCH_TOKEN}
+    get_fb_data.OUTPUT_FORMAT = settings['output']
+    get_fb_data.TOKEN_POOL_BOOL = bool(settings['token-pool'])
+    get_fb_data.GET_PUBLIC_SHARES_BOOL = bool(settings['shares'])
+    get_fb_data.TRAFFIC_REPLAY_PATH = settings['replay']
+    get_fb_data.TRAFFIC_RECORD_PATH = extras['record']
+    get_fb_data.FETCH_PROFILE = settings['profile']
+    get_fb_data.COMPETITOR_FETCH_PROFILE = settings['competitor-profile']
+    latencies = time_graph_requests(get_fb_data)
+    item_count = count_scraped_items(get_fb_data)
+
+    end_date = mock_graph_server.MOCK_END_DATE
+    local_from_date = end_date - datetime.timedelta(days=settings['days'])
+    utc_posix_until_date = calendar.timegm(end_date.timetuple()) + 1
+
+    t0 = time.time()
+    if scenario == 'scrape':
+        get_fb_data.scrape_fb_pages_items(page_ids, local_from_date, utc_posix_until_date, get_fb_data.get_fb_page_post_data, get_fb_data.process_fb_page_post)
+    elif scenario == 'csv':
+        # Output goes to a scratch directory; the default writer uses ./facebook_output
+        output_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(output_dir, 'facebook_output'))
+        os.chdir(output_dir)
+        get_fb_data.OUTPUT_DIR = output_dir
+        get_fb_data.scrape_posts_to_csv(page_ids, local_from_date, utc_posix_until_date, get_fb_data.get_fb_page_post_data, get_fb_data.process_fb_page_post)
+    elif scenario == 'elastic':
+        for name in ('PAGE1_FB_PERM_TOKEN', 'PAGE2_FB_PERM_TOKEN', 'PAGE3_FB_PERM_TOKEN', 'MY_INSTA_TOKEN'):
+            os.environ.setdefault(name, BENCH_TOKEN)
+        os.environ.setdefault('ELASTIC_HOST_PROD2', base_url)
+        try:
+            import social_elastic
+        except ImportError as e:
+            raise SystemExit('The elastic scenario needs social_elastic.py and its imports: {}'.format(e))
+        social_elastic.ELASTIC_HOSTS = [base_url]
+        social_elastic.OWNED_PAGES_TOKENS = get_fb_data.OWNED_PAGES_TOKENS
+        social_elastic.fb_main(local_from_date)
+    else:
+        raise SystemExit('Unknown scenario {}'.format(scenario))
+    seconds = time.time() - t0
+    num_items = item_count[0]
+
+    latencies = sorted(latencies)
+    return {
+        'seconds': round(seconds, 3),
+        'items': num_items,
+        'items_per_sec': round(num_items / seconds, 1),
+        'requests': len(latencies),
+        'requests_per_sec': round(len(latencies) / seconds, 1),
+        'p50_ms': None if not latencies else round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': None if not latencies else round(percentile(latencies, 0.99) * 1000, 1),
+        'mb_received': round(sum(stats['bytes'] for stats in get_fb_data.run_telemetry.requests.values()) / (1024.0 * 1024), 2),
+        'peak_rss_mb': peak_rss_mb(),
+        'rate_limits': dict((rate_limiter.name, rate_limiter.report()) for rate_limiter in get_fb_data.rate_limiters.values()),
+        'server': dict(mock_graph_server.mock_stats)
+    }
+
+
+def load_previous_result(results_path, scenario, settings):
+    previous = None
+    if os.path.isfile(results_path):
+        with open(results_path) as results_file:
+            for line in results_file:
+                record = json.loads(line)
+                if record['scenario'] == scenario and record['settings'] == settings:
+                    previous = record
+    return previous
+
+
+def print_comparison(results, previous):
+    print '\n{:<18}{:>14}{:>14}'.format('', 'this run', 'last run' if previous else '')
+    for name in ('seconds', 'items', 'items_per_sec', 'requests', 'requests_per_sec', 'p50_ms', 'p99_ms', 'mb_received', 'peak_rss_mb'):
+        value = results[name]
+        if previous is None:
+            print '{:<18}{:>14}'.format(name, value)
+            continue
+        previous_value = previous['results'].get(name)
+        change = '' if not previous_value or value is None else '{:+.1f}%'.format(100.0 * (value - previous_value) / previous_value)
+        print '{:<18}{:>14}{:>14}{:>10}'.format(name, value, previous_value, change)
+    print 'Mock server: {}'.format(results['server'])
+    if previous is not None:
+        print 'Compared with {} ({})'.format(previous['time'], previous.get('commit') or 'unknown commit')
+
+
+if __name__ == '__main__':
+    positional, settings, extras = parse_bench_options(sys.argv[1:])
+    if len(positional) != 1:
+        print 'python {} <scrape/csv/elastic> [--option=value ...]  Options and defaults: {}'.format(sys.argv[0], BENCH_DEFAULTS)
+        sys.exit()
+    scenario = positional[0]
+    results_path = os.path.abspath(extras['results'])
+
+    base_url = configure_mock_server(settings)
+    results = run_scenario(scenario, settings, extras, base_url)
+    mock_graph_server.stop_mock_graph_server()
+
+    previous = load_previous_result(results_path, scenario, settings)
+    record = {
+        'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'commit': git_commit(),
+        'label': extras['label'],
+        'scenario': scenario,
+        'settings': settings,
+        'results': results
+    }
+    if not os.path.isdir(os.path.dirname(results_path)):
+        os.makedirs(os.path.dirname(results_path))
+    with open(results_path, 'a') as results_file:
+        results_file.write(json.dumps(record, sort_keys=True) + '\n')
+
+    print_comparison(results, previous)
+    print 'Recorded in {}'.format(results_path)
@@ -0,0 +1,82 @@
+import sys
+import os
+import time
+
+# get_fb_data reads its token at import; none is needed to compute metrics
+os.environ.setdefault('MY_TOKEN', '')
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+import get_fb_data
+
+
+# Time the metric functions the row builders call on random counts, and what memoising the Wilson z-score saves
+# python bench_metrics.py [num rows]
+def random_post_counts(num_rows, random_state):
+    impressions = random_state.randint(0, 200000, num_rows)
+    # Some posts with no impressions and some without engagement counts, as for competitors' posts
+    impressions[random_state.rand(num_rows) < 0.02] = 0
+    shares = random_state.randint(0, 2000, num_rows).astype(object)
+    shares[random_state.rand(num_rows) < 0.05] = None
+    return pd.DataFrame({
+        'Type': random_state.choice(['link', 'photo', 'video', 'status'], num_rows),
+        'Unique Link Clicks': random_state.randint(0, 10000, num_rows),
+        'Unique Impressions': impressions,
+        'Fan Unique Impressions': (impressions * random_state.rand(num_rows)).astype(int),
+        'Video Views': random_state.randint(0, 50000, num_rows),
+        'Hide Clicks': random_state.randint(0, 50, num_rows),
+        'Hide All Clicks': random_state.randint(0, 10, num_rows),
+        'Num Shares': shares,
+        'Num Reactions': random_state.randint(0, 20000, num_rows),
+        'Num Comments': random_state.randint(0, 3000, num_rows)
+    })
+
+
+def random_video_counts(num_rows, random_state):
+    impressions = random_state.randint(0, 500000, num_rows)
+    views_3s = random_state.randint(0, 100000, num_rows)
+    views_3s[random_state.rand(num_rows) < 0.02] = 0
+    return pd.DataFrame({
+        'Impressions': impressions,
+        'Fan Impressions': (impressions * random_state.rand(num_rows)).astype(int),
+        '3s Views': views_3s,
+        '10s Views': (views_3s * random_state.rand(num_rows)).astype(int),
+        'Complete Views': (views_3s * random_state.rand(num_rows) / 2).astype(int),
+        'Num Reactions': random_state.randint(0, 20000, num_rows),
+        'Num Comments': random_state.randint(0, 3000, num_rows)
+    })
+
+
+def benchmark(name, counts, row_function, row_arguments):
+    # Plain Python values, as the row builders get them from the Graph API
+    argument_rows = zip(*[counts[column].tolist() for column in row_arguments])
+
+    t0 = time.time()
+    for arguments in argument_rows:
+        row_function(*arguments)
+    seconds = time.time() - t0
+
+    print '{}: {} rows | {:.2f}s | {:.1f}us per row'.format(name, len(counts), seconds, seconds / max(len(counts), 1) * 1e6)
+
+
+if __name__ == '__main__':
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    random_state = np.random.RandomState(0)
+
+    benchmark('Posts', random_post_counts(num_rows, random_state), get_fb_data.post_metrics,
+              ['Type', 'Unique Link Clicks', 'Unique Impressions', 'Fan Unique Impressions', 'Video Views', 'Hide Clicks', 'Hide All Clicks',
+               'Num Shares', 'Num Reactions', 'Num Comments'])
+    benchmark('Videos', random_video_counts(num_rows, random_state), get_fb_data.video_metrics,
+              ['Impressions', 'Fan Impressions', '3s Views', '10s Views', 'Complete Views', 'Num Reactions', 'Num Comments'])
+
+    # What the z-score memo saves on every bound computed row by row
+    pos = random_state.randint(0, 1000, 20000).tolist()
+    t0 = time.time()
+    for p in pos:
+        z = norm.ppf((1-(1-0.95)/2), loc=0, scale=1)
+    t1 = time.time()
+    for p in pos:
+        z = get_fb_data.wilson_z(0.95)
+    t2 = time.time()
+    print 'z-score: norm.ppf per call {:.2f}s | memoised {:.3f}s per {} bounds'.format(t1 - t0, t2 - t1, len(pos))
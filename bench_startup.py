@@ -0,0 +1,59 @@
+import sys
+import os
+import json
+import time
+import subprocess
+
+# Cold start of the scripts cron runs: import time and resident memory of a fresh interpreter importing each module,
+# the median of several runs.  The pandas/numpy/scipy line is what a run pays when it gets to a stage that needs them
+# python bench_startup.py [runs]
+STARTUP_MODULES = [
+    ('get_fb_data', ['get_fb_data']),
+    ('social_elastic', ['social_elastic']),
+    ('pandas, numpy, scipy.stats', ['pandas', 'numpy', 'scipy.stats'])
+]
+
+# Run in the child: the time to import the modules and peak RSS once they're loaded, in kilobytes on Linux and bytes on OS X
+CHILD_CODE = '''
+import sys, time, json, resource
+t0 = time.time()
+for name in sys.argv[1:]:
+    __import__(name)
+seconds = time.time() - t0
+print json.dumps({'import_seconds': seconds, 'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+'''
+
+
+def measure_startup(modules, env):
+    t0 = time.time()
+    output = subprocess.check_output([sys.executable, '-c', CHILD_CODE] + modules, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    process_seconds = time.time() - t0
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process_seconds'] = process_seconds
+    result['peak_rss_mb'] = result['peak_rss'] / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+    return result
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+if __name__ == '__main__':
+    num_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    # The scripts read their tokens and hosts at import; none are used
+    env = dict(os.environ)
+    for name in ('MY_TOKEN', 'PAGE1_FB_PERM_TOKEN', 'PAGE2_FB_PERM_TOKEN', 'PAGE3_FB_PERM_TOKEN', 'MY_INSTA_TOKEN', 'ELASTIC_HOST_PROD2'):
+        env.setdefault(name, 'bench-startup')
+
+    print '{:<30}{:>14}{:>16}{:>14}'.format('', 'import (ms)', 'process (ms)', 'RSS (MB)')
+    for label, modules in STARTUP_MODULES:
+        try:
+            results = [measure_startup(modules, env) for run in range(num_runs)]
+        except subprocess.CalledProcessError:
+            print '{:<30}{:>14}'.format(label, 'import failed')
+            continue
+        print '{:<30}{:>14.0f}{:>16.0f}{:>14.1f}'.format(label, median([result['import_seconds'] for result in results]) * 1000,
+                                                          median([result['process_seconds'] for result in results]) * 1000,
+                                                          median([result['peak_rss_mb'] for result in results]))
@@ -1,22 +1,53 @@
+import sys
+# The gevent engine needs the standard library patched before requests and threading are imported
+if __name__ == '__main__' and '--engine=gevent' in sys.argv:
+    from gevent import monkey
+    monkey.patch_all()
+
 import datetime
+# strptime imports this lazily, which isn't thread safe in Python 2 when e.g. the video and post scrapes start together
+import _strptime
 import calendar
 import requests
 import time
-import sys
 import os
 import threading
 import Queue
 import math
+import json
+import random
+import urlparse
+import urllib
+import re
+import multiprocessing
+import itertools
+import cPickle
+import socket
+import traceback
+import sqlite3
+import zlib
+import csv
+import gzip
 from dateutil import tz
 
-import pandas as pd
-from scipy.stats import norm
+# pandas and numpy are imported by the stages that use them (CSV summaries) rather than here, so
+# runs that only scrape and index start quickly
 
 
 #  At the cost of performance, set these to true for more precise data: reaction type breakdown and public shares across Facebook
 #  Overall reactions per post are already pulled
 GET_SPECIFIC_REACTIONS_BOOL = False
 GET_PUBLIC_SHARES_BOOL = False
+# Send the per-item insights/reactions/URL share calls for each page of results as Graph API batch requests
+BATCH_SUB_REQUESTS_BOOL = True
+# Public share lookups go through a cache shared by every page: links are normalised (tracking parameters, fragment and
+# trailing slash dropped), a link already being looked up is waited on rather than requested again.  Counts are kept for
+# the run only unless set with --share-store=<path> to a SQLite store, where later runs reuse them until
+# URL_SHARES_TTL_SECONDS old, so their share counts can be that stale
+URL_SHARES_CACHE_PATH = None
+URL_SHARES_TTL_SECONDS = 12 * 60 * 60
+# Query parameters dropped from links, as well as any starting utm_
+URL_TRACKING_PARAMETERS = ('fbclid', 'gclid', 'dclid', 'mc_cid', 'mc_eid', 'cmpid', 'smid', 'ocid', 'ncid', '_ga')
 
 # Page IDs to be scraped, defined by page's Facebook handle.  
 PAGE_IDS_TO_SCRAPE = [
@@ -47,65 +78,1239 @@ OWNED_PAGES_TOKENS = {
 TIMEZONE = 'America/New_York'
 API_VERSION = '2.7'
 
+POST_INSIGHTS_FIELDS = 'post_consumptions_by_type_unique'\
+                ',post_impressions_by_paid_non_paid_unique'\
+                ',post_video_views'\
+                ',post_impressions_fan_unique'\
+                ',post_negative_feedback_by_type_unique'
+
+# Video insights metrics process_fb_page_video reads
+VIDEO_INSIGHTS_CORE_METRICS = 'total_video_views,total_video_10s_views,total_video_complete_views,total_video_avg_time_watched'\
+                ',total_video_impressions,total_video_impressions_fan,total_video_views_paid'
+
+# Fetch profiles: the fields and summary edges listed for each post and video, and the insights metrics requested for
+# each item of an owned page ('' for none, None for every video metric).  Columns a profile doesn't fetch are empty.
+# 'owned-full' is everything the rows can hold, 'lean-competitor' only the counts (no captions or insights) and
+# 'video-core' only the video insights of the video CSV.  FETCH_PROFILE applies to every page but those not in
+# OWNED_PAGES_TOKENS when COMPETITOR_FETCH_PROFILE is set.  Set with --profile=<name> and --competitor-profile=<name>
+FETCH_PROFILES = {
+    'owned-full': {
+        'post_fields': 'message,link,created_time,type,name,id,comments.limit(0).summary(true),shares,reactions.limit(0).summary(true)',
+        'video_fields': 'title,description,created_time,id,comments.limit(0).summary(true),likes.limit(0).summary(true),'
+                        'reactions.limit(0).summary(true),permalink_url,live_status,status',
+        'post_insights': POST_INSIGHTS_FIELDS,
+        'video_insights': None
+    },
+    'lean-competitor': {
+        'post_fields': 'link,created_time,type,name,id,comments.limit(0).summary(total_count),shares,reactions.limit(0).summary(total_count)',
+        'video_fields': 'title,created_time,id,comments.limit(0).summary(total_count),likes.limit(0).summary(total_count),'
+                        'reactions.limit(0).summary(total_count),permalink_url,live_status,status',
+        'post_insights': '',
+        'video_insights': ''
+    },
+    'video-core': {
+        'post_fields': 'message,link,created_time,type,name,id,comments.limit(0).summary(true),shares,reactions.limit(0).summary(true)',
+        'video_fields': 'title,description,created_time,id,comments.limit(0).summary(true),likes.limit(0).summary(true),'
+                        'reactions.limit(0).summary(true),permalink_url,live_status,status',
+        'post_insights': POST_INSIGHTS_FIELDS,
+        'video_insights': VIDEO_INSIGHTS_CORE_METRICS
+    }
+}
+FETCH_PROFILE = 'owned-full'
+COMPETITOR_FETCH_PROFILE = None
+
+GRAPH_API_HOST = 'https://graph.facebook.com'
+
+# Shared keep-alive connection pool used by every Graph API call.  Pool size is per host and must cover every call that
+# can be in flight at once, or the connections beyond it are thrown away.  It is sized when a scrape starts from its page
+# threads, their lookahead threads and the item workers (MAX_IN_FLIGHT_REQUESTS for gevent), and never below
+# HTTP_POOL_MIN_MAXSIZE
+HTTP_POOL_CONNECTIONS = 4
+HTTP_POOL_MIN_MAXSIZE = 10
+HTTP_TIMEOUT_SECONDS = 60
+# Graph API caps a batch request at 50 operations
+GRAPH_BATCH_SIZE = 50
+# Seconds a fetcher waits on another page's batch that is fetching its URL before requesting the URL itself
+BATCHED_RESPONSE_WAIT_SECONDS = HTTP_TIMEOUT_SECONDS
+
+# 'threads' runs one thread per page with items processed in turn; 'gevent' runs pages and their items concurrently on
+# greenlets with at most MAX_IN_FLIGHT_REQUESTS Graph API calls outstanding.  Select with --engine=gevent at commandline
+SCRAPE_ENGINE = 'threads'
+MAX_IN_FLIGHT_REQUESTS = 50
+# Threads engine: worker threads shared by all page threads which process the items of each fetched page concurrently.
+# Being shared, this is the budget for the whole run however many pages are scraped.  0 processes items in turn
+ITEM_WORKER_THREADS = 16
+# Result pages requested ahead of the page whose items are being processed.  0 follows paging.next only once a page is done
+PAGINATION_LOOKAHEAD = 2
+
+# Rate control per access token.  Requests are paced by a token bucket which, along with the number of concurrent calls,
+# is scaled down as the X-App-Usage/X-Page-Usage headers approach 100%.  Throttling errors back off exponentially with jitter
+RATE_LIMIT_REQUESTS_PER_SECOND = 50.0
+RATE_LIMIT_MAX_CONCURRENCY = 20
+RATE_LIMIT_SLOW_DOWN_USAGE = 75     # % of quota used at which pacing starts to slow
+RATE_LIMIT_MAX_RETRIES = 6          # Throttled attempts per request, on top of the usual 3 attempts
+RATE_LIMIT_BASE_BACKOFF_SECONDS = 2
+RATE_LIMIT_MAX_BACKOFF_SECONDS = 600
+# Successful responses after a backoff that restore full speed when they carry no usage headers to go by
+RATE_LIMIT_RECOVERY_SUCCESSES = 5
+# Requests for pages not in OWNED_PAGES_TOKENS can be made with any token, so they're spread over every owned page's token
+# and PUBLIC_PAGE_TOKENS (e.g. app tokens), least loaded first, leaving out tokens backing off from throttling until they
+# cool down.  Owned pages' requests always use their own token
+TOKEN_POOL_BOOL = True
+PUBLIC_PAGE_TOKENS = []
+# https://developers.facebook.com/docs/graph-api/using-graph-api/error-handling
+THROTTLE_ERROR_CODES = (4, 17, 32, 613, 80001, 80002, 80003, 80004, 80005, 80006, 80008)
+
+# On-disk cache of Graph API responses keyed by URL without the access token.  Enable with --cache at commandline
+RESPONSE_CACHE_BOOL = False
+RESPONSE_CACHE_PATH = './facebook_output/response_cache.sqlite'
+RESPONSE_CACHE_MAX_MB = 512         # Least recently used responses are evicted beyond this
+# Seconds a response stays fresh.  Responses about items published in the last RESPONSE_CACHE_RECENT_DAYS get the short TTL
+RESPONSE_CACHE_RECENT_TTL = 60 * 60
+RESPONSE_CACHE_OLD_TTL = 7 * 24 * 60 * 60
+RESPONSE_CACHE_RECENT_DAYS = 14
+# Endpoints whose TTL doesn't depend on age.  None never expires
+RESPONSE_CACHE_ENDPOINT_TTLS = {
+    'videos': None
+}
+
+# Per page and endpoint record of the newest item scraped, the cursor reached and the rows collected so far.
+# 'incremental' scrapes only items newer than the last run; 'resume' carries on an interrupted scrape from its cursor
+CHECKPOINT_MODE = None
+CHECKPOINT_DIR = './facebook_output/checkpoints'
+
+# Back-fill mode (threads engine): each page's date range is split into up to BACKFILL_MAX_WINDOWS since/until windows
+# scraped in parallel, sized to hold about BACKFILL_WINDOW_ITEMS items each.  Set with --backfill=<max windows>
+BACKFILL_MAX_WINDOWS = 0
+BACKFILL_WINDOW_ITEMS = 300
+BACKFILL_MAX_THREADS = 16
+
+# None writes one CSV through pandas once the scrape is done, followed by summaries.  'csv', 'csv.gz', 'csv.zst' or
+# 'parquet' instead stream each page's rows to disk as the page finishes so memory doesn't grow with the size of the run.
+# Parquet output is a dataset partitioned by Page and publish date.  Set with --output=<format>
+OUTPUT_FORMAT = None
+OUTPUT_DIR = './facebook_output'
+
+# Record every Graph API request and response to a SQLite archive, with access tokens redacted, or replay a recorded
+# archive with no network.  Replay runs at full speed unless TRAFFIC_REPLAY_TIMING, which waits each request's recorded
+# latency and paces requests as live.  The response cache is bypassed while either is on.
+# Set with --record=<path>, --replay=<path> and --replay-timing at commandline
+TRAFFIC_RECORD_PATH = None
+TRAFFIC_REPLAY_PATH = None
+TRAFFIC_REPLAY_TIMING = False
+# Response headers kept in the archive, which the rate limiter reads
+TRAFFIC_ARCHIVE_HEADERS = ('Content-Type', 'X-App-Usage', 'X-Page-Usage', 'X-Ad-Account-Usage', 'X-Business-Use-Case-Usage')
+
+# Keep each scraped item along with the responses of the requests made to process it in a SQLite raw store, so rows can
+# be rebuilt by the current process_* functions with no Graph API calls: python get_fb_data.py reprocess <post/video> ...
+# Set with --keep-raw at commandline
+RAW_STORE_BOOL = False
+RAW_STORE_PATH = './facebook_output/raw_store.sqlite'
+# Reprocess mode rebuilds rows from the raw store in place of scraping, on REPROCESS_PROCESSES processes (0 for one per core)
+REPROCESS_BOOL = False
+REPROCESS_PROCESSES = 0
+
+# Sharded mode (threads engine): pages, or their back-fill windows, are queued as shards in a SQLite work queue and
+# scraped by SHARD_PROCESSES worker processes (0 for one per core) of SHARD_WORKER_THREADS threads each.  Workers on
+# other hosts sharing the queue file join in with: python get_fb_data.py worker [<queue path>].  Rows are merged back
+# in page order as from one process.  Set with --shards[=<processes>] and --shard-queue=<path> at commandline
+SHARD_BOOL = False
+SHARD_PROCESSES = 0
+SHARD_WORKER_THREADS = 8
+SHARD_QUEUE_PATH = './facebook_output/shard_queue.sqlite'
+SHARD_CLAIM_TIMEOUT_SECONDS = 600   # A running shard whose worker hasn't reported in for this long is claimed again
+SHARD_MAX_ATTEMPTS = 3
+SHARD_POLL_SECONDS = 0.25
+SHARD_WORKER_IDLE_SECONDS = 60      # How long a worker started from commandline waits for a run to be queued
+
+# Requests, bytes, latency, retries and throttling per endpoint and page, with each page's time processing versus waiting
+# on the Graph API, are recorded for every run.  Set with --report=<path> to write them out: JSON, or Prometheus text
+# format when the path ends in .prom
+TELEMETRY_REPORT_PATH = None
+# Upper bounds in seconds of the request latency histogram buckets
+TELEMETRY_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def import_pandas():
+    import pandas as pd
+    # Set display precision when printing Pandas dataframes
+    pd.set_option('precision',1)
+    # Deal with scientific notation
+    pd.options.display.float_format = '{:20,.0f}'.format
+    # Don't wrap dataframe when printing to console
+    pd.set_option('display.expand_frame_repr', False)
+    return pd
+
+
+http_session = None
+http_session_lock = threading.Lock()
+http_pool_maxsize = HTTP_POOL_MIN_MAXSIZE
+
+
+def mount_http_adapter(session):
+    adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=http_pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
+def get_http_session():
+    # One Session shared by all threads so TLS connections are reused rather than renegotiated on every call
+    global http_session
+    if http_session is None:
+        with http_session_lock:
+            if http_session is None:
+                session = requests.Session()
+                mount_http_adapter(session)
+                session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+                http_session = session
+    return http_session
+
+
+def size_http_pool(page_threads):
+    # Grow the shared pool for a scrape of page_threads pages (or windows) at once.  A session already made gets a bigger
+    # adapter; it is only ever grown so a smaller scrape alongside doesn't shrink it
+    global http_pool_maxsize
+    if SCRAPE_ENGINE == 'gevent':
+        concurrency = MAX_IN_FLIGHT_REQUESTS
+    else:
+        concurrency = page_threads * (2 if PAGINATION_LOOKAHEAD > 0 else 1) + ITEM_WORKER_THREADS
+    with http_session_lock:
+        if concurrency > http_pool_maxsize:
+            http_pool_maxsize = concurrency
+            if http_session is not None:
+                mount_http_adapter(http_session)
+
+
+# Minimal stand-in for requests' Response so batched answers can be served to the get_* fetchers unchanged
+class GraphResponse(object):
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def graph_error_code(response):
+    if response.status_code == 200:
+        return None
+    try:
+        return response.json().get('error', {}).get('code')
+    except (ValueError, AttributeError):
+        return None
+
+
+def max_usage_percent(headers):
+    # Highest % of any quota reported by the usage headers, or None if none were sent
+    usages = []
+    for header in ('X-App-Usage', 'X-Page-Usage', 'X-Ad-Account-Usage'):
+        if headers.get(header):
+            try:
+                usages.extend(value for value in json.loads(headers[header]).values() if isinstance(value, (int, float)))
+            except (ValueError, AttributeError):
+                pass
+    if headers.get('X-Business-Use-Case-Usage'):
+        try:
+            for use_cases in json.loads(headers['X-Business-Use-Case-Usage']).values():
+                for use_case in use_cases:
+                    usages.extend(use_case.get(key, 0) for key in ('call_count', 'total_time', 'total_cputime'))
+        except (ValueError, AttributeError):
+            pass
+    return max(usages) if usages else None
+
+
+class TokenRateLimiter(object):
+    # Token bucket plus a concurrency cap for one access token, both adjusted from the usage Facebook reports back
+    def __init__(self, name):
+        self.name = name
+        self.condition = threading.Condition()
+        self.rate = RATE_LIMIT_REQUESTS_PER_SECOND
+        self.max_concurrency = RATE_LIMIT_MAX_CONCURRENCY
+        self.bucket = RATE_LIMIT_REQUESTS_PER_SECOND
+        self.last_refill = time.time()
+        self.in_flight = 0
+        self.blocked_until = 0
+        self.consecutive_throttles = 0
+        self.successes_since_throttle = 0
+        self.usage = None
+        self.throttle_events = 0
+        self.requests = 0
+        self.state = 'ok'
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                now = time.time()
+                if now < self.blocked_until:
+                    self.condition.wait(self.blocked_until - now)
+                    continue
+                if self.in_flight >= self.max_concurrency:
+                    self.condition.wait(1)
+                    continue
+                self.bucket = min(max(self.rate, 1), self.bucket + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.bucket >= 1:
+                    self.bucket -= 1
+                    self.in_flight += 1
+                    self.requests += 1
+                    return
+                self.condition.wait((1 - self.bucket) / self.rate)
+
+    def release(self, response):
+        with self.condition:
+            self.in_flight -= 1
+            if response is not None:
+                if graph_error_code(response) in THROTTLE_ERROR_CODES:
+                    self.record_throttle(response.headers)
+                else:
+                    self.consecutive_throttles = 0
+                    usage = max_usage_percent(response.headers)
+                    if usage is not None:
+                        self.record_usage(usage)
+                    elif response.status_code == 200 and self.state == 'throttled' and time.time() >= self.blocked_until:
+                        self.successes_since_throttle += 1
+                        if self.successes_since_throttle >= RATE_LIMIT_RECOVERY_SUCCESSES:
+                            self.rate = RATE_LIMIT_REQUESTS_PER_SECOND
+                            self.max_concurrency = RATE_LIMIT_MAX_CONCURRENCY
+                            self.set_state('ok', 'no usage headers')
+            self.condition.notify_all()
+
+    def record_usage(self, usage):
+        if usage is None:
+            return
+        self.usage = usage
+        if usage >= 100:
+            self.record_throttle({})
+        elif usage >= RATE_LIMIT_SLOW_DOWN_USAGE:
+            # Scale linearly from full speed at RATE_LIMIT_SLOW_DOWN_USAGE to a crawl at 100%
+            scale = max(0.05, float(100 - usage) / (100 - RATE_LIMIT_SLOW_DOWN_USAGE))
+            self.rate = RATE_LIMIT_REQUESTS_PER_SECOND * scale
+            self.max_concurrency = max(1, int(RATE_LIMIT_MAX_CONCURRENCY * scale))
+            self.set_state('slowed')
+        else:
+            self.rate = RATE_LIMIT_REQUESTS_PER_SECOND
+            self.max_concurrency = RATE_LIMIT_MAX_CONCURRENCY
+            self.set_state('ok')
+
+    def record_throttle(self, headers):
+        with self.condition:
+            self.throttle_events += 1
+            self.consecutive_throttles += 1
+            self.successes_since_throttle = 0
+            backoff = min(RATE_LIMIT_MAX_BACKOFF_SECONDS, RATE_LIMIT_BASE_BACKOFF_SECONDS * 2 ** (self.consecutive_throttles - 1))
+            backoff = backoff * random.uniform(0.5, 1.5)
+            # Business use case usage says how long until access is regained, in minutes
+            try:
+                for use_cases in json.loads(headers.get('X-Business-Use-Case-Usage') or '{}').values():
+                    for use_case in use_cases:
+                        backoff = max(backoff, 60 * use_case.get('estimated_time_to_regain_access', 0))
+            except (ValueError, AttributeError):
+                pass
+            self.blocked_until = max(self.blocked_until, time.time() + backoff)
+            self.max_concurrency = 1
+            self.set_state('throttled', 'backing off {:.0f}s'.format(backoff))
+            self.condition.notify_all()
+
+    def set_state(self, state, detail=''):
+        # Coming out of a backoff into a still-slowed state isn't worth reporting every time
+        if state != self.state and not (self.state == 'throttled' and state == 'slowed'):
+            print 'Rate limit for token {}: {} -> {} | usage {}% {} | {}'.format(self.name, self.state, state, self.usage, detail, datetime.datetime.now())
+        self.state = state
+
+    def load(self, now):
+        # Sort key for picking the token that can send soonest: not backing off, then least of its concurrency in use
+        # and its quota used
+        return (self.blocked_until > now, float(self.in_flight) / self.max_concurrency, self.usage or 0)
+
+    def report(self):
+        return {'state': self.state, 'usage_percent': self.usage, 'requests_per_second': round(self.rate, 2), 'max_concurrency': self.max_concurrency,
+                'requests': self.requests, 'throttle_events': self.throttle_events}
+
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(access_token):
+    with rate_limiters_lock:
+        if access_token not in rate_limiters:
+            # Only the tail of the token is shown in output
+            rate_limiters[access_token] = TokenRateLimiter('...' + (access_token or 'none')[-6:])
+        return rate_limiters[access_token]
+
+
+def request_access_token(url, data=None):
+    if data is not None and 'access_token' in data:
+        return data['access_token']
+    return urlparse.parse_qs(urlparse.urlsplit(url).query).get('access_token', [None])[0]
+
+
+class TokenPool(object):
+    # Tokens that public pages' requests are spread over, starting the search for the least loaded at the next token in
+    # turn so equally loaded tokens share the work
+    def __init__(self, access_tokens):
+        self.lock = threading.Lock()
+        self.access_tokens = []
+        for access_token in access_tokens:
+            if access_token and access_token not in self.access_tokens:
+                self.access_tokens.append(access_token)
+        self.next_index = 0
+        self.assigned = dict((access_token, 0) for access_token in self.access_tokens)
+
+    def choose(self):
+        now = time.time()
+        with self.lock:
+            in_turn = self.access_tokens[self.next_index:] + self.access_tokens[:self.next_index]
+            self.next_index = (self.next_index + 1) % len(self.access_tokens)
+            access_token = min(in_turn, key=lambda access_token: get_rate_limiter(access_token).load(now))
+            self.assigned[access_token] += 1
+        return access_token
+
+    def report(self):
+        return ' | '.join('{} {} requests ({})'.format(get_rate_limiter(access_token).name, self.assigned[access_token], get_rate_limiter(access_token).state)
+                          for access_token in self.access_tokens)
+
+
+token_pool = None
+token_pool_lock = threading.Lock()
+
+
+def get_token_pool():
+    global token_pool
+    if token_pool is None:
+        with token_pool_lock:
+            if token_pool is None:
+                token_pool = TokenPool(OWNED_PAGES_TOKENS.values() + PUBLIC_PAGE_TOKENS)
+    return token_pool
+
+
+def route_public_page_request(url, data=None):
+    # Swap the token of a request made for a page we don't own for the pool's pick.  Returns the (url, data) to send
+    page_id = run_telemetry.current_page()
+    if not TOKEN_POOL_BOOL or page_id is None or page_id.lower() in [x.lower() for x in OWNED_PAGES_TOKENS.keys()]:
+        return url, data
+    pool = get_token_pool()
+    if len(pool.access_tokens) < 2 or request_access_token(url, data) is None:
+        return url, data
+    access_token = pool.choose()
+    if data is None:
+        return set_access_token(url, access_token), None
+    data = dict(data, access_token=access_token)
+    if 'batch' in data:
+        # Operations carrying their own token would otherwise still use it
+        batch = [dict(operation, relative_url=set_access_token(operation['relative_url'], access_token)) for operation in json.loads(data['batch'])]
+        data['batch'] = json.dumps(batch, separators=(',', ':'))
+    return url, data
+
+
+def print_token_pool_report():
+    if token_pool is not None and len(token_pool.access_tokens) > 1 and sum(token_pool.assigned.values()) > 0:
+        print 'Public page requests by token: {}'.format(token_pool.report())
+
+
+def print_rate_limit_report():
+    for rate_limiter in rate_limiters.values():
+        if rate_limiter.throttle_events > 0 or rate_limiter.state != 'ok':
+            print 'Rate limit for token {}: {}'.format(rate_limiter.name, rate_limiter.report())
+
+
+def graph_endpoint(url):
+    # Short name of the Graph API edge a URL requests e.g. 'posts', 'insights', 'video_insights', 'url' (share lookups)
+    path = urlparse.urlsplit(url).path.strip('/').split('/')
+    if path and path[0].startswith('v') and path[0][1:].replace('.', '').isdigit():
+        path = path[1:]
+    if len(path) == 0 or path == ['']:
+        return 'batch' if '?' not in url else 'url'
+    if len(path) == 1:
+        return 'node'
+    return path[1]
+
+
+def strip_access_token(url):
+    # Path and sorted query of a URL without its access token, so responses can be shared across tokens and stored safely
+    split_url = urlparse.urlsplit(url)
+    query = sorted((key, value) for key, value in urlparse.parse_qsl(split_url.query, keep_blank_values=True) if key != 'access_token')
+    return split_url.path + '?' + urllib.urlencode(query)
+
+
+def set_access_token(url, access_token=None):
+    # Replace a URL's access token, or remove it if access_token is None (e.g. before writing a cursor to disk)
+    split_url = urlparse.urlsplit(url)
+    query = [(key, value) for key, value in urlparse.parse_qsl(split_url.query, keep_blank_values=True) if key != 'access_token']
+    if access_token is not None:
+        query.append(('access_token', access_token))
+    return urlparse.urlunsplit((split_url.scheme, split_url.netloc, split_url.path, urllib.urlencode(query), split_url.fragment))
+
+
+def posix_from_utc_string(utc_datetime_string):
+    return calendar.timegm(datetime.datetime.strptime(utc_datetime_string, '%Y-%m-%dT%H:%M:%S+0000').timetuple())
+
+
+def response_cache_ttl(url, published=None):
+    # Old items' numbers barely change so are kept longer.  Listings are aged by their 'until' cursor
+    endpoint = graph_endpoint(url)
+    if endpoint in RESPONSE_CACHE_ENDPOINT_TTLS:
+        return RESPONSE_CACHE_ENDPOINT_TTLS[endpoint]
+
+    if published is not None:
+        published_posix = posix_from_utc_string(published)
+    else:
+        until = urlparse.parse_qs(urlparse.urlsplit(url).query).get('until', [''])[0]
+        if not until.isdigit():
+            return RESPONSE_CACHE_RECENT_TTL
+        published_posix = int(until)
+
+    if time.time() - published_posix > RESPONSE_CACHE_RECENT_DAYS * 24 * 60 * 60:
+        return RESPONSE_CACHE_OLD_TTL
+    return RESPONSE_CACHE_RECENT_TTL
+
+
+class ResponseCache(object):
+    # SQLite store of zlib-compressed response bodies with an expiry per entry and least recently used eviction
+    def __init__(self, path, max_bytes):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body BLOB, size INTEGER, expires_at REAL, last_access REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+        self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, url):
+        key = strip_access_token(url)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT body, expires_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                self.misses += 1
+                return None
+            self.connection.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return zlib.decompress(row[0])
+
+    def contains(self, url):
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT expires_at FROM responses WHERE key = ?', (strip_access_token(url),)).fetchone()
+        return row is not None and (row[0] is None or row[0] >= now)
+
+    def put(self, url, content, ttl):
+        key = strip_access_token(url)
+        body = sqlite3.Binary(zlib.compress(content))
+        now = time.time()
+        expires_at = None if ttl is None else now + ttl
+        with self.lock:
+            previous = self.connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', (key, body, len(body), expires_at, now))
+            self.total_bytes += len(body) - (previous[0] if previous else 0)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # Trim to 90% of the limit so every insert near the limit doesn't trigger another eviction
+        target_bytes = self.max_bytes * 0.9
+        rows = self.connection.execute('SELECT key, size FROM responses ORDER BY last_access').fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.total_bytes <= target_bytes:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.connection.executemany('DELETE FROM responses WHERE key = ?', evicted)
+
+
+response_cache = None
+response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    global response_cache
+    if not RESPONSE_CACHE_BOOL or TRAFFIC_RECORD_PATH is not None or TRAFFIC_REPLAY_PATH is not None:
+        return None
+    if response_cache is None:
+        with response_cache_lock:
+            if response_cache is None:
+                response_cache = ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_MB * 1024 * 1024)
+    return response_cache
+
+
+def print_response_cache_report():
+    if response_cache is not None:
+        total = response_cache.hits + response_cache.misses
+        print 'Response cache: {} hits out of {} lookups ({:.0f}%)'.format(response_cache.hits, total, 100.0 * response_cache.hits / total if total else 0)
+
+
+def cache_response(url, response, published=None):
+    cache = get_response_cache()
+    if cache is not None and response.status_code == 200 and not response.content.startswith('{"error"'):
+        cache.put(url, response.content, response_cache_ttl(url, published))
+
+
+def traffic_archive_key(url, data=None):
+    # Host independent and without the access token so a capture replays against any GRAPH_API_HOST with any token
+    if data is None:
+        return 'GET ' + strip_access_token(url)
+    fields = sorted((name, value) for name, value in data.items() if name != 'access_token')
+    return 'POST ' + urlparse.urlsplit(url).path + ' ' + json.dumps(fields, separators=(',', ':'))
+
+
+def batch_operation_urls(url, data):
+    # URLs of a batch request's GET operations, as the fetchers would have requested them one by one
+    base = url.rstrip('/') + '/'
+    return [base + operation['relative_url'] for operation in json.loads(data['batch'])]
+
+
+access_token_values = re.compile(r'(access_token=|"access_token"\s*:\s*")[^&"\\\s]+')
+
+
+def redact_access_tokens(content):
+    # Paging URLs in responses carry the token they were requested with
+    return access_token_values.sub(r'\1REDACTED', content)
+
+
+class TrafficArchive(object):
+    # SQLite store of zlib-compressed responses with their status, usage headers and latency.  A request made more than
+    # once (e.g. retried after throttling) is stored once per attempt and replayed in the same order, the last
+    # recorded answer being repeated should the replay ask more times.  Batch requests are stored per operation, as
+    # which items share a batch depends on timing, and are reassembled from them on replay
+    def __init__(self, path, record_bool):
+        self.lock = threading.Lock()
+        self.record_bool = record_bool
+        self.sequences = {}
+        self.requests = 0
+        self.misses = 0
+        if not record_bool and not os.path.isfile(path):
+            raise Exception('No traffic archive at {}'.format(path))
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS exchanges (key TEXT, seq INTEGER, status INTEGER, headers TEXT, body BLOB, '
+                                'latency REAL, recorded_at REAL, PRIMARY KEY (key, seq))')
+        if record_bool:
+            # A recording is of one run
+            self.connection.execute('DELETE FROM exchanges')
+
+    def next_sequence(self, key):
+        with self.lock:
+            seq = self.sequences.get(key, 0)
+            self.sequences[key] = seq + 1
+            self.requests += 1
+        return seq
+
+    def record(self, url, data, response, latency):
+        if data is not None and 'batch' in data:
+            # A failed batch is followed by its operations being requested individually, which are recorded then
+            if response.status_code == 200:
+                for operation_url, result in zip(batch_operation_urls(url, data), response.json()):
+                    if result is not None:
+                        self.record(operation_url, None, GraphResponse(result.get('code'), result.get('body') or ''), latency)
+            return
+        key = traffic_archive_key(url, data)
+        seq = self.next_sequence(key)
+        headers = dict((name, response.headers[name]) for name in TRAFFIC_ARCHIVE_HEADERS if name in response.headers)
+        body = sqlite3.Binary(zlib.compress(redact_access_tokens(response.content)))
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO exchanges VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (key, seq, response.status_code, json.dumps(headers), body, latency, time.time()))
+
+    def replay(self, url, data):
+        # Returns (GraphResponse, recorded latency), or (None, None) if the request was never recorded
+        if data is not None and 'batch' in data:
+            return self.replay_batch(url, data)
+        key = traffic_archive_key(url, data)
+        seq = self.next_sequence(key)
+        with self.lock:
+            row = self.connection.execute('SELECT status, headers, body, latency FROM exchanges WHERE key = ? AND seq <= ? ORDER BY seq DESC LIMIT 1',
+                                          (key, seq)).fetchone()
+            if row is None:
+                self.misses += 1
+        if row is None:
+            return None, None
+        return GraphResponse(row[0], zlib.decompress(row[2]), json.loads(row[1])), row[3]
+
+    def replay_batch(self, url, data):
+        # Operations not in the archive come back null, as ones Facebook didn't get round to, so their fetchers ask again
+        results = []
+        latency = 0.0
+        for operation_url in batch_operation_urls(url, data):
+            response, operation_latency = self.replay(operation_url, None)
+            if response is None:
+                results.append(None)
+            else:
+                results.append({'code': response.status_code, 'body': response.content})
+                latency = max(latency, operation_latency)
+        return GraphResponse(200, json.dumps(results)), latency
+
+    def report(self):
+        if self.record_bool:
+            return '{} responses recorded to {}'.format(self.requests, self.path)
+        return '{} responses replayed from {}, {} not in the archive'.format(self.requests - self.misses, self.path, self.misses)
 
-# Set display precision when printing Pandas dataframes
-pd.set_option('precision',1)
-# Deal with scientific notation
-pd.options.display.float_format = '{:20,.0f}'.format
-# Don't wrap dataframe when printing to console
-pd.set_option('display.expand_frame_repr', False)
 
+traffic_archive = None
+traffic_archive_lock = threading.Lock()
+
+
+def get_traffic_archive():
+    global traffic_archive
+    if TRAFFIC_RECORD_PATH is None and TRAFFIC_REPLAY_PATH is None:
+        return None
+    if traffic_archive is None:
+        with traffic_archive_lock:
+            if traffic_archive is None:
+                if TRAFFIC_RECORD_PATH is not None:
+                    traffic_archive = TrafficArchive(TRAFFIC_RECORD_PATH, True)
+                else:
+                    traffic_archive = TrafficArchive(TRAFFIC_REPLAY_PATH, False)
+    return traffic_archive
+
+
+def print_traffic_archive_report():
+    if traffic_archive is not None:
+        print 'Traffic archive: {}'.format(traffic_archive.report())
+
+
+class RawStore(object):
+    # SQLite store of zlib-compressed JSON per scraped item: the item as listed and the responses, by URL without access
+    # token, of the requests made to process it.  Rescraping an item replaces it
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS raw_items (endpoint TEXT, page_id TEXT, item_id TEXT, created_posix INTEGER, '
+                                'item BLOB, responses BLOB, scraped_at REAL, PRIMARY KEY (endpoint, page_id, item_id))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS raw_items_created ON raw_items (endpoint, page_id, created_posix)')
+
+    def put(self, endpoint, page_id, item, responses):
+        item_blob = sqlite3.Binary(zlib.compress(json.dumps(item)))
+        responses_blob = sqlite3.Binary(zlib.compress(redact_access_tokens(json.dumps(responses))))
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO raw_items VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (endpoint, page_id, item['id'], posix_from_utc_string(item['created_time']), item_blob, responses_blob, time.time()))
+
+    def iter_items(self, endpoint, page_ids, from_posix, until_posix):
+        # (page_id, item blob, responses blob) for each page in turn, newest first as scraped
+        for page_id in page_ids:
+            with self.lock:
+                rows = self.connection.execute('SELECT page_id, item, responses FROM raw_items WHERE endpoint = ? AND page_id = ? AND created_posix >= ? '
+                                               'AND created_posix < ? ORDER BY created_posix DESC', (endpoint, page_id, from_posix, until_posix)).fetchall()
+            for page_id, item_blob, responses_blob in rows:
+                yield page_id, str(item_blob), str(responses_blob)
+
+
+raw_store = None
+raw_store_lock = threading.Lock()
+
+
+def get_raw_store():
+    global raw_store
+    if not RAW_STORE_BOOL and not REPROCESS_BOOL:
+        return None
+    if raw_store is None:
+        with raw_store_lock:
+            if raw_store is None:
+                raw_store = RawStore(RAW_STORE_PATH)
+    return raw_store
+
+
+# Per thread (greenlet under gevent) dict of the responses to an item's requests: 'captured' collects them while the
+# item is processed for the raw store, 'served' answers them in reprocess mode
+raw_item_requests = threading.local()
+
+
+def process_item_keeping_raw(endpoint, process_item_function, item, access_token, page_id):
+    store = get_raw_store()
+    if store is None or endpoint is None:
+        return process_item_function(item, access_token, page_id)
+    raw_item_requests.captured = {}
+    try:
+        processed_item = process_item_function(item, access_token, page_id)
+        store.put(endpoint, page_id, item, raw_item_requests.captured)
+    finally:
+        raw_item_requests.captured = None
+    return processed_item
+
+
+def serve_raw_item_request(url):
+    status_content = raw_item_requests.served.get(strip_access_token(url))
+    if status_content is None:
+        print 'Not in raw store | {}'.format(strip_access_token(url))
+        return GraphResponse(404, json.dumps({'error': {'message': 'Request not in raw store', 'code': None}}))
+    return GraphResponse(status_content[0], status_content[1].encode('utf-8'))
+
+
+def reprocess_raw_item(process_item_function_name, page_id, item_blob, responses_blob):
+    # Rebuild one item's row in a reprocess worker.  The function is passed by name so it can be sent to the process
+    raw_item_requests.served = json.loads(zlib.decompress(responses_blob))
+    try:
+        return globals()[process_item_function_name](json.loads(zlib.decompress(item_blob)), get_page_access_token(page_id), page_id)
+    finally:
+        raw_item_requests.served = None
+
+
+def reprocess_raw_items_chunk(arguments):
+    # [(page_id, row)] for a chunk of (process_item_function_name, page_id, item_blob, responses_blob)
+    return [(item_arguments[1], reprocess_raw_item(*item_arguments)) for item_arguments in arguments]
+
+
+class RunTelemetry(object):
+    # Request statistics keyed by (endpoint, page) and time per page.  The page a request belongs to is a thread local
+    # set by scrape_single_fb_page_items and its item workers, which under gevent's patching is local to the greenlet
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.requests = {}
+        self.pages = {}
+
+    def current_page(self):
+        return getattr(self.local, 'page', None)
+
+    def set_page(self, page_id):
+        self.local.page = page_id
+
+    def request_stats(self, endpoint, page_id):
+        stats = self.requests.get((endpoint, page_id))
+        if stats is None:
+            stats = {'requests': 0, 'bytes': 0, 'errors': 0, 'throttled': 0, 'retries': 0, 'cache_hits': 0, 'batched_hits': 0,
+                     'latency_seconds': 0.0, 'queued_seconds': 0.0, 'latency_buckets': [0] * (len(TELEMETRY_LATENCY_BUCKETS) + 1)}
+            self.requests[(endpoint, page_id)] = stats
+        return stats
+
+    def page_stats(self, page_id):
+        stats = self.pages.get(page_id)
+        if stats is None:
+            stats = {'items': 0, 'wall_seconds': 0.0, 'process_seconds': 0.0}
+            self.pages[page_id] = stats
+        return stats
+
+    def count(self, url, name, data=None):
+        endpoint = 'batch' if data is not None else graph_endpoint(url)
+        with self.lock:
+            self.request_stats(endpoint, self.current_page())[name] += 1
+
+    def record_request(self, url, data, queued_seconds, latency_seconds, response):
+        # queued_seconds is time spent waiting on the rate limiter and in-flight cap before the request was sent
+        if response is None:
+            outcome = 'errors'
+        elif response.status_code == 200:
+            outcome = None
+        else:
+            outcome = 'throttled' if graph_error_code(response) in THROTTLE_ERROR_CODES else 'errors'
+        bucket = 0
+        while bucket < len(TELEMETRY_LATENCY_BUCKETS) and latency_seconds > TELEMETRY_LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        endpoint = 'batch' if data is not None else graph_endpoint(url)
+        if getattr(self.local, 'wait_seconds', None) is not None:
+            self.local.wait_seconds += queued_seconds + latency_seconds
+        with self.lock:
+            stats = self.request_stats(endpoint, self.current_page())
+            stats['requests'] += 1
+            stats['bytes'] += 0 if response is None else len(response.content or '')
+            stats['latency_seconds'] += latency_seconds
+            stats['queued_seconds'] += queued_seconds
+            stats['latency_buckets'][bucket] += 1
+            if outcome is not None:
+                stats[outcome] += 1
+
+    def time_item(self, page_id, function, *args):
+        # Call function for one of page_id's items, adding its time less that spent on requests to the page's processing time
+        previous_page = self.current_page()
+        previous_wait_seconds = getattr(self.local, 'wait_seconds', None)
+        self.local.page = page_id
+        self.local.wait_seconds = 0.0
+        t0 = time.time()
+        try:
+            return function(*args)
+        finally:
+            process_seconds = time.time() - t0 - self.local.wait_seconds
+            if previous_wait_seconds is not None:
+                previous_wait_seconds += self.local.wait_seconds
+            self.local.page = previous_page
+            self.local.wait_seconds = previous_wait_seconds
+            with self.lock:
+                self.page_stats(page_id)['process_seconds'] += process_seconds
+
+    def record_page(self, page_id, num_items, wall_seconds):
+        # A page scraped in back-fill windows adds each window's wall time
+        with self.lock:
+            stats = self.page_stats(page_id)
+            stats['items'] += num_items
+            stats['wall_seconds'] += wall_seconds
+
+    def report(self):
+        # Endpoints and pages ordered by the time spent on them so the slowest come first
+        with self.lock:
+            requests = [(key, dict(stats, latency_buckets=list(stats['latency_buckets']))) for key, stats in self.requests.items()]
+            pages = dict((page_id, dict(stats)) for page_id, stats in self.pages.items())
+
+        def add_request_stats(total, stats):
+            for name, value in stats.items():
+                if name == 'latency_buckets':
+                    total[name] = [a + b for a, b in zip(total.get(name, [0] * len(value)), value)]
+                else:
+                    total[name] = total.get(name, 0) + value
+
+        endpoints = {}
+        page_endpoints = {}
+        for (endpoint, page_id), stats in requests:
+            add_request_stats(endpoints.setdefault(endpoint, {}), stats)
+            add_request_stats(page_endpoints.setdefault(page_id, {}).setdefault(endpoint, {}), stats)
+
+        def summarise(stats):
+            summary = dict((name, round(value, 3) if isinstance(value, float) else value) for name, value in stats.items() if name != 'latency_buckets')
+            summary['latency_mean_seconds'] = round(stats['latency_seconds'] / stats['requests'], 4) if stats['requests'] else None
+            summary['latency_histogram'] = [list(bucket) for bucket in zip(list(TELEMETRY_LATENCY_BUCKETS) + ['+Inf'], stats['latency_buckets'])]
+            return summary
+
+        page_reports = []
+        for page_id in set(pages) | set(page_endpoints):
+            stats = pages.get(page_id, {'items': 0, 'wall_seconds': 0.0, 'process_seconds': 0.0})
+            by_endpoint = page_endpoints.get(page_id, {})
+            wait_seconds = sum(endpoint_stats['latency_seconds'] + endpoint_stats['queued_seconds'] for endpoint_stats in by_endpoint.values())
+            page_reports.append({
+                'page': page_id,
+                'items': stats['items'],
+                'wall_seconds': round(stats['wall_seconds'], 3),
+                'process_seconds': round(stats['process_seconds'], 3),
+                'wait_seconds': round(wait_seconds, 3),
+                'requests': sum(endpoint_stats['requests'] for endpoint_stats in by_endpoint.values()),
+                'bytes': sum(endpoint_stats['bytes'] for endpoint_stats in by_endpoint.values()),
+                'endpoints': dict((endpoint, summarise(endpoint_stats)) for endpoint, endpoint_stats in by_endpoint.items())
+            })
+        page_reports.sort(key=lambda page_report: (-page_report['wall_seconds'], -page_report['wait_seconds']))
+
+        endpoint_reports = [dict(summarise(stats), endpoint=endpoint) for endpoint, stats in endpoints.items()]
+        endpoint_reports.sort(key=lambda endpoint_report: -endpoint_report['latency_seconds'])
+
+        return {
+            'started': datetime.datetime.fromtimestamp(self.started).strftime('%Y-%m-%d %H:%M:%S'),
+            'seconds': round(time.time() - self.started, 3),
+            'endpoints': endpoint_reports,
+            'pages': page_reports
+        }
+
+    def prometheus_text(self):
+        # Counters labelled by endpoint and page, in the text exposition format read by e.g. node_exporter's textfile collector
+        with self.lock:
+            requests = sorted(self.requests.items(), key=lambda item: (item[0][0], item[0][1] or ''))
+            pages = sorted(self.pages.items(), key=lambda item: item[0] or '')
+
+        def labels(*pairs):
+            return '{' + ','.join('{}="{}"'.format(name, (value or '').replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+        lines = []
+        counters = [('requests', 'Graph API requests sent'), ('bytes', 'Response body bytes received'),
+                    ('errors', 'Requests that failed other than by throttling'), ('throttled', 'Requests refused by rate limiting'),
+                    ('retries', 'Requests resent after a failed or throttled attempt'), ('cache_hits', 'Responses served by the response cache'),
+                    ('batched_hits', 'Responses served from a batch request'), ('queued_seconds', 'Seconds requests waited on rate limiting')]
+        for name, description in counters:
+            lines.append('# HELP fb_scraper_{}_total {}'.format(name, description))
+            lines.append('# TYPE fb_scraper_{}_total counter'.format(name))
+            for (endpoint, page_id), stats in requests:
+                lines.append('fb_scraper_{}_total{} {}'.format(name, labels(('endpoint', endpoint), ('page', page_id)), stats[name]))
+
+        lines.append('# HELP fb_scraper_request_duration_seconds Graph API request latency')
+        lines.append('# TYPE fb_scraper_request_duration_seconds histogram')
+        for (endpoint, page_id), stats in requests:
+            cumulative = 0
+            for bound, count in zip([str(bound) for bound in TELEMETRY_LATENCY_BUCKETS] + ['+Inf'], stats['latency_buckets']):
+                cumulative += count
+                lines.append('fb_scraper_request_duration_seconds_bucket{} {}'.format(labels(('endpoint', endpoint), ('page', page_id), ('le', bound)), cumulative))
+            lines.append('fb_scraper_request_duration_seconds_sum{} {}'.format(labels(('endpoint', endpoint), ('page', page_id)), stats['latency_seconds']))
+            lines.append('fb_scraper_request_duration_seconds_count{} {}'.format(labels(('endpoint', endpoint), ('page', page_id)), stats['requests']))
+
+        page_counters = [('items', 'items_total', 'Items scraped'), ('wall_seconds', 'wall_seconds_total', 'Seconds from starting to finishing the page'),
+                         ('process_seconds', 'process_seconds_total', 'Seconds processing items other than waiting on requests')]
+        for name, metric, description in page_counters:
+            lines.append('# HELP fb_scraper_page_{} {}'.format(metric, description))
+            lines.append('# TYPE fb_scraper_page_{} counter'.format(metric))
+            for page_id, stats in pages:
+                lines.append('fb_scraper_page_{}{} {}'.format(metric, labels(('page', page_id)), stats[name]))
+        return '\n'.join(lines) + '\n'
+
+
+run_telemetry = RunTelemetry()
+
+
+def write_run_report(path):
+    # JSON unless the path ends in .prom
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as report_file:
+        if path.endswith('.prom'):
+            report_file.write(run_telemetry.prometheus_text())
+        else:
+            json.dump(run_telemetry.report(), report_file, indent=2, sort_keys=True)
+    print 'Run report written to {}'.format(path)
+
+
+def print_telemetry_report():
+    # Where the time went, as the endpoints that took longest
+    endpoint_reports = [endpoint_report for endpoint_report in run_telemetry.report()['endpoints'] if endpoint_report['requests'] > 0]
+    if endpoint_reports:
+        print 'Requests by endpoint: {}'.format(' | '.join('{} {} ({:.1f}s, {} retries, {} throttled)'.format(
+            endpoint_report['endpoint'], endpoint_report['requests'], endpoint_report['latency_seconds'], endpoint_report['retries'],
+            endpoint_report['throttled']) for endpoint_report in endpoint_reports))
+
+
+# Caps concurrent Graph API calls when set by an engine
+in_flight_requests = None
+
+
+def send_graph_request(url, data=None):
+    # The response's sent_access_token is the token the request went out with, which the token pool may have swapped in
+    queued_at = time.time()
+    url, data = route_public_page_request(url, data)
+    sent_access_token = request_access_token(url, data)
+    if TRAFFIC_REPLAY_PATH is not None and not TRAFFIC_REPLAY_TIMING:
+        # Full speed replay: no pacing or backing off
+        response = send_timed_http_request(url, data, queued_at)
+        response.sent_access_token = sent_access_token
+        return response
+    rate_limiter = get_rate_limiter(sent_access_token)
+    rate_limiter.acquire()
+    response = None
+    try:
+        if in_flight_requests is None:
+            response = send_timed_http_request(url, data, queued_at)
+        else:
+            with in_flight_requests:
+                response = send_timed_http_request(url, data, queued_at)
+    finally:
+        rate_limiter.release(response)
+    response.sent_access_token = sent_access_token
+    return response
+
+
+def send_timed_http_request(url, data, queued_at):
+    t0 = time.time()
+    response = None
+    try:
+        response = send_http_request(url, data)
+        return response
+    finally:
+        run_telemetry.record_request(url, data, t0 - queued_at, time.time() - t0, response)
+
+
+def send_http_request(url, data=None):
+    archive = get_traffic_archive()
+    if archive is not None and not archive.record_bool:
+        return replay_http_request(archive, url, data)
+    t0 = time.time()
+    if data is None:
+        response = get_http_session().get(url, timeout=HTTP_TIMEOUT_SECONDS)
+    else:
+        response = get_http_session().post(url, data=data, timeout=HTTP_TIMEOUT_SECONDS)
+    if archive is not None:
+        archive.record(url, data, response, time.time() - t0)
+    return response
+
+
+def replay_http_request(archive, url, data=None):
+    response, latency = archive.replay(url, data)
+    if response is None:
+        print 'Not in traffic archive | {}'.format(traffic_archive_key(url, data))
+        return GraphResponse(404, json.dumps({'error': {'message': 'Request not in traffic archive', 'code': None}}))
+    if TRAFFIC_REPLAY_TIMING:
+        time.sleep(latency)
+    return response
+
+
+# Responses fetched ahead of time by batch requests, keyed by the exact URL the get_* fetcher would have requested.
+# Values are [response, number of pages holding the URL, event set once the batch fetching it has returned] since pages
+# sharing a token can need the same URL (e.g. a link)
+batched_responses = {}
+batched_responses_lock = threading.Lock()
+
+
+def request_until_succeed(url, data=None, published=None):
+    # published: creation time of the item the URL is about, which sets how long the response is cached
+    if getattr(raw_item_requests, 'served', None) is not None:
+        return serve_raw_item_request(url)
+    response = request_graph_until_succeed(url, data, published)
+    if getattr(raw_item_requests, 'captured', None) is not None and data is None:
+        raw_item_requests.captured[strip_access_token(url)] = [response.status_code, response.content]
+    return response
+
+
+def request_graph_until_succeed(url, data=None, published=None):
+    with batched_responses_lock:
+        batched_response = batched_responses.get(url)
+    if batched_response is not None:
+        # Another page's batch may still be fetching the URL; its response is waited on, for up to
+        # BATCHED_RESPONSE_WAIT_SECONDS, rather than requested again
+        batched_response[2].wait(BATCHED_RESPONSE_WAIT_SECONDS)
+    if batched_response is not None and batched_response[0] is not None:
+        cache_response(url, batched_response[0], published)
+        run_telemetry.count(url, 'batched_hits')
+        return batched_response[0]
+
+    cache = get_response_cache() if data is None else None
+    if cache is not None:
+        content = cache.get(url)
+        if content is not None:
+            run_telemetry.count(url, 'cache_hits')
+            return GraphResponse(200, content)
 
-def request_until_succeed(url):
     max_attempts = 3
     attempts = 0
+    throttled_attempts = 0
     success = False
     while success == False and attempts < max_attempts:
+        if attempts > 0 or throttled_attempts > 0:
+            run_telemetry.count(url, 'retries', data)
         attempts = attempts + 1
         try:
-            response = requests.get(url)
+            response = send_graph_request(url, data)
             if response.status_code == 200:
                 success = True
+            elif graph_error_code(response) in THROTTLE_ERROR_CODES and throttled_attempts < RATE_LIMIT_MAX_RETRIES:
+                # The token's rate limiter has already backed off, so a throttled attempt doesn't use up max_attempts
+                throttled_attempts += 1
+                attempts -= 1
         except Exception as e:
             print e
             print 'Error for URL {} | {} | attempt {} of {}'.format(url, datetime.datetime.now(), attempts, max_attempts)
             if attempts == max_attempts:
                 raise Exception('Failed after {} attempts | {}'.format(attempts, url))    
             time.sleep(3)
+    if cache is not None and success:
+        cache_response(url, response, published)
     return response
-     
+
+
+def graph_api_base():
+    return '{}/v{}'.format(GRAPH_API_HOST, API_VERSION)
+
+
+def request_graph_batch(urls, access_token):
+    # Send up to GRAPH_BATCH_SIZE GETs in one round-trip. Returns {url: GraphResponse} for the operations that succeeded
+    base = graph_api_base()
+    batch = [{'method': 'GET', 'relative_url': url[len(base):].lstrip('/')} for url in urls]
+    data = {'access_token': access_token, 'batch': json.dumps(batch, separators=(',', ':')), 'include_headers': 'false'}
+
+    response = request_until_succeed(base + '/', data=data)
+    if response.status_code != 200:
+        print 'Batch request failed with status {} | {}'.format(response.status_code, datetime.datetime.now())
+        return {}
+
+    results = {}
+    for url, result in zip(urls, response.json()):
+        # Null results are operations Facebook didn't get round to; failed ones are retried individually by their fetcher
+        if result is not None and result.get('code') == 200:
+            results[url] = GraphResponse(200, result.get('body'))
+        elif result is not None and graph_error_code(GraphResponse(result.get('code'), result.get('body'))) in THROTTLE_ERROR_CODES:
+            # Back off the token the batch was sent with, not necessarily the page's own
+            get_rate_limiter(getattr(response, 'sent_access_token', access_token)).record_throttle({})
+            run_telemetry.count(url, 'throttled')
+    return results
+
+
+def prefetch_batched_sub_requests(urls, access_token):
+    # De-duplicate (e.g. several posts linking the same article) while keeping order and claim each URL until
+    # discard_batched_responses.  Only URLs not already held by another page are batched
+    unique_urls = []
+    unique_urls_seen = set()
+    urls_to_fetch = []
+    cache = get_response_cache()
+    with batched_responses_lock:
+        for url in urls:
+            # Answered from the response cache by the fetcher
+            if url in unique_urls_seen or (cache is not None and cache.contains(url)):
+                continue
+            unique_urls_seen.add(url)
+            unique_urls.append(url)
+            if url in batched_responses:
+                batched_responses[url][1] += 1
+            else:
+                batched_responses[url] = [None, 1, threading.Event()]
+                urls_to_fetch.append(url)
+
+    try:
+        for i in range(0, len(urls_to_fetch), GRAPH_BATCH_SIZE):
+            chunk_urls = urls_to_fetch[i:i + GRAPH_BATCH_SIZE]
+            try:
+                results = request_graph_batch(chunk_urls, access_token)
+                with batched_responses_lock:
+                    for url, response in results.items():
+                        batched_responses[url][0] = response
+            except Exception as e:
+                # Not fatal: each fetcher falls back to its own request
+                print e
+            # Release fetchers waiting on these URLs, whether or not the batch answered them
+            with batched_responses_lock:
+                for url in chunk_urls:
+                    batched_responses[url][2].set()
+    finally:
+        # Also if the batches stop part way (e.g. the thread is interrupted), so no fetcher waits on one never sent
+        with batched_responses_lock:
+            for url in urls_to_fetch:
+                batched_responses[url][2].set()
+    return unique_urls
+
+
+def discard_batched_responses(urls):
+    with batched_responses_lock:
+        for url in urls:
+            batched_response = batched_responses.get(url)
+            if batched_response is not None:
+                batched_response[1] -= 1
+                if batched_response[1] <= 0:
+                    del batched_responses[url]
+
 
 # Handle non-ASCII characters when writing to csv
 def unicode_normalize(text):
     return text.translate({ 0x2018:0x27, 0x2019:0x27, 0x201C:0x22, 0x201D:0x22, 0xa0:0x20 }).encode('utf-8')
 
 
-def get_fb_page_video_data(page_id, access_token, num_posts=100, until=''):
-    base = 'https://graph.facebook.com/v{}'.format(API_VERSION)
+def fetch_profile(page_id):
+    if COMPETITOR_FETCH_PROFILE is not None and page_id.lower() not in [x.lower() for x in OWNED_PAGES_TOKENS.keys()]:
+        return FETCH_PROFILES[COMPETITOR_FETCH_PROFILE]
+    return FETCH_PROFILES[FETCH_PROFILE]
+
+
+def get_fb_page_video_data(page_id, access_token, num_posts=100, until='', since=''):
+    base = '{}/v{}'.format(GRAPH_API_HOST, API_VERSION)
     node = '/{}/videos'.format(page_id)
-    fields = '/?fields=title,description,created_time,id,comments.limit(0).summary(true),likes.limit(0).summary(true),reactions.limit(0).summary(true),permalink_url,live_status,status'
-    parameters = '&limit={}&access_token={}&until={}'.format(num_posts, access_token, until)
+    fields = '/?fields={}'.format(fetch_profile(page_id)['video_fields'])
+    parameters = '&limit={}&access_token={}&until={}&since={}'.format(num_posts, access_token, until, since)
     url = base + node + fields + parameters
 
     data = request_until_succeed(url).json()
     return data
 
 
-def get_fb_page_post_data(page_id, access_token, num_posts=100, until=''):
+def get_fb_page_post_data(page_id, access_token, num_posts=100, until='', since=''):
     # Shares on videos must be grabbed from the /posts endpoint; unavailable from the /videos endpoint
-    base = 'https://graph.facebook.com/v{}'.format(API_VERSION)
+    base = '{}/v{}'.format(GRAPH_API_HOST, API_VERSION)
     node = '/{}/posts'.format(page_id)
-    fields = '/?fields=message,link,created_time,type,name,id,comments.limit(0).summary(true),shares,reactions.limit(0).summary(true)'
-    parameters = '&limit={}&access_token={}&until={}'.format(num_posts, access_token, until)
+    fields = '/?fields={}'.format(fetch_profile(page_id)['post_fields'])
+    parameters = '&limit={}&access_token={}&until={}&since={}'.format(num_posts, access_token, until, since)
     url = base + node + fields + parameters
     
     data = request_until_succeed(url).json()
     return data
    
 
-def get_specific_reactions_for_post(status_id, access_token):
+def build_specific_reactions_url(status_id, access_token):
     # Reaction types are only accessible at an individual post's endpoint
-    base = 'https://graph.facebook.com/v{}'.format(API_VERSION)
+    base = '{}/v{}'.format(GRAPH_API_HOST, API_VERSION)
     node = '/{}'.format(status_id)
     reactions = '/?fields=' \
                     'reactions.type(LIKE).limit(0).summary(total_count).as(like)'\
@@ -115,51 +1320,187 @@ def get_specific_reactions_for_post(status_id, access_token):
                     ',reactions.type(SAD).limit(0).summary(total_count).as(sad)'\
                     ',reactions.type(ANGRY).limit(0).summary(total_count).as(angry)'
     parameters = '&access_token={}'.format(access_token)
-    url = base + node + reactions + parameters
+    return base + node + reactions + parameters
 
-    data = request_until_succeed(url).json()
+
+def get_specific_reactions_for_post(status_id, access_token, published=None):
+    url = build_specific_reactions_url(status_id, access_token)
+
+    data = request_until_succeed(url, published=published).json()
     return data
 
 
-def get_insights_for_post(object_id, access_token, fields, period='', since=''):
-    base = 'https://graph.facebook.com/v{}'.format(API_VERSION)
+def build_post_insights_url(object_id, access_token, fields, period='', since=''):
+    base = '{}/v{}'.format(GRAPH_API_HOST, API_VERSION)
     node = '/{}/insights/'.format(object_id)
     parameters = '?access_token={}&period={}&since={}&date_format=U'.format(access_token, period, since)
-    url = base + node + fields + parameters
+    return base + node + fields + parameters
+
+
+def get_insights_for_post(object_id, access_token, fields, period='', since='', published=None):
+    url = build_post_insights_url(object_id, access_token, fields, period, since)
     
-    data = request_until_succeed(url)
+    data = request_until_succeed(url, published=published)
     if data is not None:
         return data.json()
     else:
         raise Exception('No Post Insights Data')
 
 
-def get_insights_for_video(video_id, access_token, period='lifetime'):
-    base = 'https://graph.facebook.com/v{}'.format(API_VERSION)
+def build_video_insights_url(video_id, access_token, period='lifetime', metrics=None):
+    # metrics None for every metric
+    base = '{}/v{}'.format(GRAPH_API_HOST, API_VERSION)
     node = '/{}/video_insights'.format(video_id)
-    fields = ''
+    fields = '' if metrics is None else '/{}'.format(metrics)
     parameters = '?access_token={}&period={}'.format(access_token, period)
-    url = base + node + fields + parameters
+    return base + node + fields + parameters
+
+
+def get_insights_for_video(video_id, access_token, period='lifetime', published=None, metrics=None):
+    url = build_video_insights_url(video_id, access_token, period, metrics)
     
-    data = request_until_succeed(url).json()
+    data = request_until_succeed(url, published=published).json()
     return data
 
 
-def get_fb_url_shares_comments(access_token, url):
+def normalize_share_url(url):
+    # The form of a link its shares are looked up and cached by
+    split_url = urlparse.urlsplit(url.strip())
+    query = urlparse.parse_qsl(split_url.query, keep_blank_values=True)
+    kept_query = [(key, value) for key, value in query if not key.lower().startswith('utm_') and key.lower() not in URL_TRACKING_PARAMETERS]
+    # The query is only re-encoded if a parameter was dropped
+    query_string = split_url.query if len(kept_query) == len(query) else urllib.urlencode(kept_query)
+    return urlparse.urlunsplit((split_url.scheme.lower(), split_url.netloc.lower(), split_url.path.rstrip('/'), query_string, ''))
+
+
+class UrlSharesCache(object):
+    # Share lookup responses by normalised link for the whole process, backed by an optional SQLite store for later runs.
+    # Only one lookup of a link is in flight at a time; other lookups of it wait for its response
+    def __init__(self, path, ttl):
+        self.lock = threading.Lock()
+        self.ttl = ttl
+        self.responses = {}
+        self.in_flight = {}
+        self.stats = {'lookups': 0, 'memory_hits': 0, 'store_hits': 0, 'coalesced': 0, 'requests': 0}
+        self.connection = None
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS url_shares (url TEXT PRIMARY KEY, response TEXT, fetched_at REAL)')
+
+    def load(self, url):
+        # A response from the store young enough to reuse, or None.  Called with the lock held
+        if self.connection is None:
+            return None
+        row = self.connection.execute('SELECT response FROM url_shares WHERE url = ? AND fetched_at >= ?', (url, time.time() - self.ttl)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def contains(self, url):
+        # Whether a lookup of url now would be answered without a request of its own
+        with self.lock:
+            return url in self.responses or url in self.in_flight or self.load(url) is not None
+
+    def lookup(self, url, fetch):
+        # The response for url, calling fetch() for it only if it isn't cached or being fetched.  Error responses aren't
+        # cached, so a lookup that waited on one makes its own request
+        waited_bool = False
+        with self.lock:
+            self.stats['lookups'] += 1
+        while True:
+            with self.lock:
+                if url in self.responses:
+                    if not waited_bool:
+                        self.stats['memory_hits'] += 1
+                    return self.responses[url]
+                event = self.in_flight.get(url)
+                if event is None:
+                    response = self.load(url)
+                    if response is not None:
+                        self.stats['store_hits'] += 1
+                        self.responses[url] = response
+                        return response
+                    event = threading.Event()
+                    self.in_flight[url] = event
+                    self.stats['requests'] += 1
+                    break
+                if not waited_bool:
+                    self.stats['coalesced'] += 1
+                    waited_bool = True
+            event.wait()
+
+        try:
+            response = fetch()
+            if 'error' not in response:
+                with self.lock:
+                    self.responses[url] = response
+                    if self.connection is not None:
+                        self.connection.execute('INSERT OR REPLACE INTO url_shares VALUES (?, ?, ?)', (url, json.dumps(response), time.time()))
+            return response
+        finally:
+            with self.lock:
+                del self.in_flight[url]
+            event.set()
+
+    def report(self):
+        stats = dict(self.stats)
+        stats['links'] = len(self.responses)
+        return stats
+
+
+url_shares_cache = None
+url_shares_cache_lock = threading.Lock()
+
+
+def get_url_shares_cache():
+    global url_shares_cache
+    if url_shares_cache is None:
+        with url_shares_cache_lock:
+            if url_shares_cache is None:
+                # Counts from earlier runs would keep lookups out of a recording or answer them in a replay
+                store_bool = TRAFFIC_RECORD_PATH is None and TRAFFIC_REPLAY_PATH is None
+                url_shares_cache = UrlSharesCache(URL_SHARES_CACHE_PATH if store_bool else None, URL_SHARES_TTL_SECONDS)
+    return url_shares_cache
+
+
+def print_url_shares_report():
+    if url_shares_cache is not None:
+        stats = url_shares_cache.report()
+        answered = stats['memory_hits'] + stats['store_hits'] + stats['coalesced']
+        print 'URL shares: {} lookups of {} links, {} ({:.0f}%) without a request: {} already looked up, {} from earlier runs, {} waited on a ' \
+              'lookup in flight'.format(stats['lookups'], stats['links'], answered, 100.0 * answered / stats['lookups'] if stats['lookups'] else 0,
+                                        stats['memory_hits'], stats['store_hits'], stats['coalesced'])
+
+
+def build_url_shares_url(access_token, url):
     # Remove pound signs from URL which mess up FB API
     url = url.replace('#','')
-    base = 'https://graph.facebook.com/v{}'.format(API_VERSION)
+    base = '{}/v{}'.format(GRAPH_API_HOST, API_VERSION)
     node = ''
     fields = '/?id={}'.format(url)
     parameters = '&access_token={}'.format(access_token)
-    url = base + node + fields + parameters
+    return base + node + fields + parameters
 
-    data = request_until_succeed(url).json()
+
+def get_fb_url_shares_comments(access_token, url):
+    # Raw store items keep the response under the link as posted, so reprocessing reads it there
+    raw_url = build_url_shares_url(access_token, url)
+    if getattr(raw_item_requests, 'served', None) is not None:
+        return request_until_succeed(raw_url).json()
+
+    # The normalised link only keys the cache; the link is looked up as posted
+    data = get_url_shares_cache().lookup(normalize_share_url(url), lambda: request_until_succeed(raw_url).json())
+    captured = getattr(raw_item_requests, 'captured', None)
+    if captured is not None:
+        captured[strip_access_token(raw_url)] = [200, json.dumps(data)]
     return data
 
 
 def get_insights_for_page(access_token, metrics, page_id, period, start_date, excl_end_date):
-    base = 'https://graph.facebook.com/v{}'.format(FB_API_VERSION)
+    base = '{}/v{}'.format(GRAPH_API_HOST, FB_API_VERSION)
     node = '/{}/insights'.format(page_id)
     fields = '/{}'.format(metrics)
     period_string = 'period={}&since={}&until={}'.format(period, start_date, excl_end_date)
@@ -183,12 +1524,39 @@ def get_insights_for_page(access_token, metrics, page_id, period, start_date, ex
 #     return datetime.datetime.utcfromtimestamp(posix_int).strftime('%Y-%m-%dT%H:%M:%S+0000')
 
 
+timezones = {}
+# Offsets from UTC keyed by timezone and quarter hour of UTC time; DST transitions always fall on a quarter hour
+utc_offsets = {}
+
+
+def get_timezone(timezone):
+    # tz.gettz reads the zoneinfo file on every call
+    if timezone not in timezones:
+        timezones[timezone] = tz.gettz(timezone)
+    return timezones[timezone]
+
+
 def utc_to_timezone(utc_datetime_string, to_timezone):
-    utc_datetime = datetime.datetime.strptime(utc_datetime_string,'%Y-%m-%dT%H:%M:%S+0000')
-    from_zone = tz.gettz('UTC')
-    to_zone = tz.gettz(to_timezone)
-    est_datetime = utc_datetime.replace(tzinfo=from_zone).astimezone(to_zone)
-    return est_datetime.replace(tzinfo=None) #Remove timezone component to allow for comparison with local time
+    # Called for every item scraped, so Facebook's fixed '%Y-%m-%dT%H:%M:%S+0000' format is sliced rather than strptime'd
+    if len(utc_datetime_string) != 24 or not utc_datetime_string.endswith('+0000'):
+        utc_datetime = datetime.datetime.strptime(utc_datetime_string,'%Y-%m-%dT%H:%M:%S+0000')
+    else:
+        s = utc_datetime_string
+        utc_datetime = datetime.datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+
+    offset_key = (to_timezone, utc_datetime_string[:13], utc_datetime.minute // 15)
+    offset = utc_offsets.get(offset_key)
+    if offset is None:
+        est_datetime = utc_datetime.replace(tzinfo=get_timezone('UTC')).astimezone(get_timezone(to_timezone))
+        offset = est_datetime.replace(tzinfo=None) - utc_datetime
+        utc_offsets[offset_key] = offset
+    return utc_datetime + offset #Timezone component is left off to allow for comparison with local time
+
+
+# For the 'since' parameter: POSIX time of a naive datetime in the given timezone
+def timezone_to_posix(local_datetime, from_timezone):
+    utc_datetime = local_datetime.replace(tzinfo=get_timezone(from_timezone)).astimezone(get_timezone('UTC'))
+    return calendar.timegm(utc_datetime.timetuple())
 
 # Not used right now
 def utc_to_local(utc_datetime_string):
@@ -213,13 +1581,217 @@ def ci_lower_bound(pos, n, confidence):
     if n == 0:
         return 0
     elif n > pos:
-        z = norm.ppf((1-(1-confidence)/2), loc=0, scale=1)
+        z = wilson_z(confidence)
         phat = float(pos)/n
         return (phat + z*z/(2*n) - z * math.sqrt((phat*(1-phat)+z*z/(4*n))/n)) / (1+z*z/n)
     else:
         return 0
 
 
+# z-score per confidence level.  Seeded with scipy's norm.ppf for the usual levels; others are computed on first use
+wilson_z_scores = {
+    0.8: 1.2815515655446004,
+    0.9: 1.6448536269514722,
+    0.95: 1.959963984540054,
+    0.98: 2.3263478740408408,
+    0.99: 2.5758293035489004,
+    0.995: 2.807033768343811,
+    0.999: 3.2905267314919255
+}
+
+
+def wilson_z(confidence):
+    z = wilson_z_scores.get(confidence)
+    if z is None:
+        z = inverse_normal_cdf(1-(1-confidence)/2)
+        wilson_z_scores[confidence] = z
+    return z
+
+
+# Standard normal quantile without scipy: Acklam's rational approximation, refined by a step of Halley's method to
+# agree with norm.ppf to within 1e-14.  https://web.archive.org/web/20151030215612/http://home.online.no/~pjacklam/notes/invnorm/
+def inverse_normal_cdf(p):
+    a = (-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02, 1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00)
+    b = (-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02, 6.680131188771972e+01, -1.328068155288572e+01)
+    c = (-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00, -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00)
+    d = (7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00, 3.754408661907416e+00)
+    if p <= 0 or p >= 1:
+        raise ValueError('inverse_normal_cdf needs 0 < p < 1, not {}'.format(p))
+    if p < 0.02425 or p > 1 - 0.02425:
+        q = math.sqrt(-2*math.log(min(p, 1-p)))
+        x = (((((c[0]*q+c[1])*q+c[2])*q+c[3])*q+c[4])*q+c[5]) / ((((d[0]*q+d[1])*q+d[2])*q+d[3])*q+1)
+        x = x if p < 0.5 else -x
+    else:
+        q = p - 0.5
+        r = q*q
+        x = (((((a[0]*r+a[1])*r+a[2])*r+a[3])*r+a[4])*r+a[5])*q / (((((b[0]*r+b[1])*r+b[2])*r+b[3])*r+b[4])*r+1)
+    # Error in the cdf, taken from the nearer tail where erfc is accurate
+    if p < 0.5:
+        e = 0.5 * math.erfc(-x/math.sqrt(2)) - p
+    else:
+        e = (1-p) - 0.5 * math.erfc(x/math.sqrt(2))
+    u = e * math.sqrt(2*math.pi) * math.exp(x*x/2)
+    return x - u/(1 + x*u/2)
+
+
+POST_METRIC_COLUMNS = ['CTR (%)', 'Adjusted CTR (%)', 'Impression Rate Non-Likers (%)', 'Hide Rate (%)', 'Engagement Rate (%)', 'Adjusted Engagement Rate (%)']
+VIDEO_METRIC_COLUMNS = ['Impression Rate Non-Likers (%)', '10s/3s Views (%)', 'Complete/3s Views (%)', 'Engagement Rate (%)']
+
+
+# Derived metrics of an owned post from its counts, keyed by POST_METRIC_COLUMNS.  Only total_unique_impressions is
+# required; a metric whose other counts are None is None
+def post_metrics(status_type, unique_link_clicks, total_unique_impressions, fan_unique_impressions, post_video_views, hide_clicks, hide_all_clicks,
+                 num_shares, num_reactions, num_comments):
+    ctr = None
+    ctr_lb_confidence = None
+    if unique_link_clicks is not None:
+        ctr = None if total_unique_impressions == 0 else (float(unique_link_clicks)/float(total_unique_impressions)) * 100
+        ctr_lb_confidence = None if status_type != 'link' else ci_lower_bound(unique_link_clicks, total_unique_impressions, 0.95) * 100
+    non_fan_unique_impressions_rate = None
+    if fan_unique_impressions is not None:
+        non_fan_unique_impressions = total_unique_impressions - fan_unique_impressions
+        non_fan_unique_impressions_rate = None if total_unique_impressions == 0 else (float(non_fan_unique_impressions)/float(total_unique_impressions)) * 100
+    hide_rate = None
+    if hide_clicks is not None and hide_all_clicks is not None:
+        hide_rate = None if total_unique_impressions == 0 else (float(hide_clicks + hide_all_clicks)/float(total_unique_impressions)) * 100
+
+    # Engagement Rate
+    engagement_rate = None
+    engage_lb_confidence = None
+    if num_shares is not None and num_reactions is not None and num_comments is not None:
+        total_engagement = num_shares + num_reactions + num_comments
+        if status_type != 'video':
+            engagement_rate = None if total_unique_impressions == 0 else float(total_engagement)/float(total_unique_impressions) * 100
+            engage_lb_confidence = ci_lower_bound(total_engagement, total_unique_impressions, 0.95) * 100
+        if status_type == 'video' and post_video_views is not None:
+            engagement_rate = None if post_video_views == 0 else float(total_engagement)/float(post_video_views) * 100
+            engage_lb_confidence = ci_lower_bound(total_engagement, post_video_views, 0.95) * 100
+
+    return dict(zip(POST_METRIC_COLUMNS, [ctr, ctr_lb_confidence, non_fan_unique_impressions_rate, hide_rate, engagement_rate, engage_lb_confidence]))
+
+
+# Derived metrics of an owned video from its insights, keyed by VIDEO_METRIC_COLUMNS
+def video_metrics(total_video_impressions, total_video_impressions_fan, total_3s_views, total_10s_views, total_complete_views, num_reactions, num_comments):
+    total_non_fan_impressions = total_video_impressions - total_video_impressions_fan
+    total_non_fan_impressions_rate = None if total_video_impressions == 0 else float(total_non_fan_impressions)/float(total_video_impressions) * 100
+    ten_three_s_ratio = None if total_3s_views == 0 else float(total_10s_views)/float(total_3s_views) * 100
+    complete_three_s_ratio = None if total_3s_views == 0 else float(total_complete_views)/float(total_3s_views) * 100
+    engagement_rate = None if total_3s_views == 0 else float(num_reactions + num_comments)/float(total_3s_views) * 100 # Video endpoint doesn't have shares
+    return dict(zip(VIDEO_METRIC_COLUMNS, [total_non_fan_impressions_rate, ten_three_s_ratio, complete_three_s_ratio, engagement_rate]))
+
+
+# Marks a schema field a row doesn't have, so rows keep the same keys as the dicts they replace
+unset_field = object()
+
+
+class ScrapedRow(object):
+    # A scraped item held as a list of values in FIELDS order, plus a dict made only for fields outside the schema (e.g.
+    # every insights metric of process_fb_page_video_all_metrics).  Reads and writes like a dict; to_dict() for json/pandas
+    __slots__ = ('values', 'overflow')
+    FIELDS = ()
+    FIELD_INDEX = {}
+
+    def __init__(self, fields=None):
+        self.values = [unset_field] * len(self.FIELDS)
+        self.overflow = None
+        if fields is not None:
+            for key, value in fields.iteritems():
+                self[key] = value
+
+    def __getitem__(self, key):
+        idx = self.FIELD_INDEX.get(key)
+        if idx is not None:
+            value = self.values[idx]
+            if value is not unset_field:
+                return value
+        elif self.overflow is not None and key in self.overflow:
+            return self.overflow[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        idx = self.FIELD_INDEX.get(key)
+        if idx is not None:
+            self.values[idx] = value
+        else:
+            if self.overflow is None:
+                self.overflow = {}
+            self.overflow[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def iteritems(self):
+        for key, value in zip(self.FIELDS, self.values):
+            if value is not unset_field:
+                yield key, value
+        if self.overflow is not None:
+            for item in self.overflow.iteritems():
+                yield item
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return [key for key, value in self.iteritems()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    # Slotted classes need these to be pickled.  unset_field is replaced by the indexes of the fields set, as it is only
+    # unset_field within one process (e.g. not once a reprocess worker's rows are sent back)
+    def __getstate__(self):
+        set_indexes = [idx for idx, value in enumerate(self.values) if value is not unset_field]
+        return [self.values[idx] for idx in set_indexes], set_indexes, self.overflow
+
+    def __setstate__(self, state):
+        set_values, set_indexes, self.overflow = state
+        self.values = [unset_field] * len(self.FIELDS)
+        for idx, value in zip(set_indexes, set_values):
+            self.values[idx] = value
+
+
+class PostRow(ScrapedRow):
+    __slots__ = ()
+    FIELDS = ('Page', 'Published', 'Post ID', 'Type', 'Headline', 'Caption', 'Link', 'Num Shares', 'Num Reactions', 'Num Comments', 'Num Likes',
+              'Num Loves', 'Num Wows', 'Num Hahas', 'Num Sads', 'Num Angrys', 'Lifetime Public Num Shares', 'Unique Impressions',
+              'Paid Unique Impressions', 'Organic Unique Impressions', 'Impression Rate Non-Likers (%)', 'Unique Link Clicks', 'CTR (%)',
+              'Adjusted CTR (%)', 'Hide Rate (%)', 'Hide Clicks', 'Hide All Clicks', 'Engagement Rate (%)', 'Adjusted Engagement Rate (%)',
+              'Video Views', 'Timestamp')
+    FIELD_INDEX = dict((field, idx) for idx, field in enumerate(FIELDS))
+
+
+class VideoRow(ScrapedRow):
+    __slots__ = ()
+    FIELDS = ('Page', 'Video ID', 'Published', 'Live Video', 'Crossposted Video', 'Headline', 'Caption', 'Link', 'Num Likes', 'Num Reactions',
+              'Num Comments', '3s Views', '10s Views', 'Complete Views', 'Total Paid Views', '10s/3s Views (%)', 'Complete/3s Views (%)',
+              'Impressions', 'Impression Rate Non-Likers (%)', 'Avg View Time', 'Video Views', 'Timestamp')
+    FIELD_INDEX = dict((field, idx) for idx, field in enumerate(FIELDS))
+
+
+# Rows as plain dicts for json and pandas.  Rows loaded from checkpoints already are
+def row_to_dict(row):
+    return row.to_dict() if isinstance(row, ScrapedRow) else row
+
+
 def process_fb_page_video(video, access_token, page_id):
     if video.get('status').get('video_status') == 'expired':
         return None
@@ -251,8 +1823,9 @@ def process_fb_page_video(video, access_token, page_id):
     total_video_views_paid = None
 
     # Get insights for videos iff they are our OWN and also NOT Live videos which have no data
-    if page_id.lower() in [x.lower() for x in OWNED_PAGES_TOKENS.keys()]:
-        video_insights = get_insights_for_video(video_id, access_token, 'lifetime')
+    video_insights_metrics = fetch_profile(page_id)['video_insights']
+    if page_id.lower() in [x.lower() for x in OWNED_PAGES_TOKENS.keys()] and video_insights_metrics != '':
+        video_insights = get_insights_for_video(video_id, access_token, 'lifetime', utc_video_published, video_insights_metrics)
 
         if len(video_insights['data']) > 0:
             for metric_result in video_insights['data']:
@@ -271,15 +1844,12 @@ def process_fb_page_video(video, access_token, page_id):
                 if metric_result['name'] == 'total_video_views_paid':
                     total_video_views_paid = metric_result['values'][0]['value']
 
-            total_non_fan_impressions = total_video_impressions - total_video_impressions_fan
-            total_non_fan_impressions_rate = None if total_video_impressions == 0 else float(total_non_fan_impressions)/float(total_video_impressions) * 100
-            ten_three_s_ratio = None if total_3s_views == 0 else float(total_10s_views)/float(total_3s_views) * 100
-            complete_three_s_ratio = None if total_3s_views == 0 else float(total_complete_views)/float(total_3s_views) * 100
-            engagement_rate = None if total_3s_views == 0 else float(num_reactions + num_comments)/float(total_3s_views) * 100 # Video endpoint doesn't have shares
+            metrics = video_metrics(total_video_impressions, total_video_impressions_fan, total_3s_views, total_10s_views, total_complete_views, num_reactions, num_comments)
+            total_non_fan_impressions_rate, ten_three_s_ratio, complete_three_s_ratio, engagement_rate = [metrics[column] for column in VIDEO_METRIC_COLUMNS]
 
     crossposted_boolean = True if total_3s_views is None and live_boolean is False else False
 
-    scraped_row = {
+    scraped_row = VideoRow({
         'Page': page_id,
         'Video ID': video_id,
         'Published': utc_video_published,
@@ -301,7 +1871,7 @@ def process_fb_page_video(video, access_token, page_id):
         'Avg View Time': total_video_avg_time_watched,
         'Link': video_permalink,
         'Timestamp': timestamp
-    }
+    })
     return scraped_row
 
 
@@ -319,7 +1889,7 @@ def process_fb_page_video_all_metrics(video, access_token, page_id):
 
     live_boolean = False if video.get('live_status') is None else True
 
-    scraped_row = {
+    scraped_row = VideoRow({
         'Page': page_id,
         'Video ID': video_id,
         'Published': utc_video_published,
@@ -331,10 +1901,11 @@ def process_fb_page_video_all_metrics(video, access_token, page_id):
         'Num Comments': num_comments,
         'Link': video_permalink,
         'Timestamp': timestamp
-    }
+    })
 
-    if page_id.lower() in [x.lower() for x in OWNED_PAGES_TOKENS.keys()]:
-        video_insights = get_insights_for_video(video_id, access_token, 'lifetime')
+    video_insights_metrics = fetch_profile(page_id)['video_insights']
+    if page_id.lower() in [x.lower() for x in OWNED_PAGES_TOKENS.keys()] and video_insights_metrics != '':
+        video_insights = get_insights_for_video(video_id, access_token, 'lifetime', utc_video_published, video_insights_metrics)
 
         if len(video_insights['data']) > 0:
             
@@ -349,15 +1920,20 @@ def process_fb_page_video_all_metrics(video, access_token, page_id):
                 scraped_row[metric_name] = metric_value
 
             # Unpack dicts of important metrics.  !Actually Kibana unpacks these for us so unnecessary!
-            scraped_row['total_video_views_by_crossposted'] = scraped_row['total_video_views_by_distribution_type'].get('crossposted')
-            scraped_row['total_video_views_by_page_owned'] = scraped_row['total_video_views_by_distribution_type'].get('page_owned')
-            scraped_row['total_video_views_by_page_shared'] = scraped_row['total_video_views_by_distribution_type'].get('shared')
+            # Derived metrics are only added where the profile fetched what they're derived from
+            if 'total_video_views_by_distribution_type' in scraped_row:
+                scraped_row['total_video_views_by_crossposted'] = scraped_row['total_video_views_by_distribution_type'].get('crossposted')
+                scraped_row['total_video_views_by_page_owned'] = scraped_row['total_video_views_by_distribution_type'].get('page_owned')
+                scraped_row['total_video_views_by_page_shared'] = scraped_row['total_video_views_by_distribution_type'].get('shared')
             #del scraped_row['total_video_views_by_distribution_type']
 
-            scraped_row['total_video_impressions_non_fan'] = scraped_row['total_video_impressions'] - scraped_row['total_video_impressions_fan']
-            scraped_row['total_non_fan_impressions_rate'] = None if scraped_row['total_video_impressions'] == 0 else float(scraped_row['total_video_impressions_non_fan'])/float(scraped_row['total_video_impressions']) * 100
-            scraped_row['ten_three_s_ratio'] = None if scraped_row['total_video_views'] == 0 else float(scraped_row['total_video_10s_views'])/float(scraped_row['total_video_views']) * 100
-            scraped_row['complete_three_s_ratio'] = None if scraped_row['total_video_views'] == 0 else float(scraped_row['total_video_complete_views'])/float(scraped_row['total_video_views']) * 100
+            if 'total_video_impressions' in scraped_row and 'total_video_impressions_fan' in scraped_row:
+                scraped_row['total_video_impressions_non_fan'] = scraped_row['total_video_impressions'] - scraped_row['total_video_impressions_fan']
+                scraped_row['total_non_fan_impressions_rate'] = None if scraped_row['total_video_impressions'] == 0 else float(scraped_row['total_video_impressions_non_fan'])/float(scraped_row['total_video_impressions']) * 100
+            if 'total_video_views' in scraped_row and 'total_video_10s_views' in scraped_row:
+                scraped_row['ten_three_s_ratio'] = None if scraped_row['total_video_views'] == 0 else float(scraped_row['total_video_10s_views'])/float(scraped_row['total_video_views']) * 100
+            if 'total_video_views' in scraped_row and 'total_video_complete_views' in scraped_row:
+                scraped_row['complete_three_s_ratio'] = None if scraped_row['total_video_views'] == 0 else float(scraped_row['total_video_complete_views'])/float(scraped_row['total_video_views']) * 100
 
         scraped_row['Crossposted Video'] = True if scraped_row.get('total_video_views') is None and live_boolean is False else False
         if scraped_row.get('total_video_views') is not None:
@@ -366,6 +1942,18 @@ def process_fb_page_video_all_metrics(video, access_token, page_id):
     return scraped_row
 
 
+# An insights value read as a count, or None if the API sent something else (e.g. a list or a breakdown)
+def insight_count(value):
+    return value if isinstance(value, (int, long, float)) and not isinstance(value, bool) else None
+
+
+# A count from a breakdown insights value: default if the breakdown doesn't have key, None if the value isn't a breakdown
+def insight_breakdown_count(breakdown, key, default=0):
+    if not isinstance(breakdown, dict):
+        return None
+    return insight_count(breakdown.get(key, default))
+
+
 def process_fb_page_post(status, access_token, page_id):
     timestamp = datetime.datetime.utcnow().replace(microsecond=0).isoformat() + '+0000'
     status_id = status['id']
@@ -409,7 +1997,7 @@ def process_fb_page_post(status, access_token, page_id):
 
     if (GET_SPECIFIC_REACTIONS_BOOL):
         # Reactions only exists after implementation date: http://newsroom.fb.com/news/2016/02/reactions-now-available-globally/
-        reactions = get_specific_reactions_for_post(status_id, access_token) if utc_status_published > '2016-02-24 00:00:00' else {}
+        reactions = get_specific_reactions_for_post(status_id, access_token, utc_status_published) if utc_status_published > '2016-02-24 00:00:00' else {}
         num_likes = 0 if 'like' not in reactions else reactions['like']['summary']['total_count']       
         # Special case: Set number of Likes to Number of reactions for pre-reaction statuses
         num_likes = num_reactions if utc_status_published < '2016-02-24 00:00:00' else num_likes
@@ -424,7 +2012,7 @@ def process_fb_page_post(status, access_token, page_id):
     # If not one of our own pages or a pesky cover photo
     if (page_id.lower() not in [x.lower() for x in OWNED_PAGES_TOKENS.keys()]) or (post_title is not None and 'cover photo' in post_title and status_type=='photo'):
 
-        scraped_row = {
+        scraped_row = PostRow({
             'Page': page_id,
             'Published': utc_status_published,
             'Num Shares': num_shares,
@@ -443,45 +2031,34 @@ def process_fb_page_post(status, access_token, page_id):
             'Lifetime Public Num Shares': public_num_shares,
             'Post ID': status_id,
             'Timestamp': timestamp
-        }
+        })
         return scraped_row
 
-    # Iff one of our own pages, read insights too
-    elif page_id.lower() in [x.lower() for x in OWNED_PAGES_TOKENS.keys()]:
-
-        fields = 'post_consumptions_by_type_unique'\
-                ',post_impressions_by_paid_non_paid_unique'\
-                ',post_video_views'\
-                ',post_impressions_fan_unique'\
-                ',post_negative_feedback_by_type_unique'
+    # Iff one of our own pages, read the insights the profile asks for too
+    elif page_id.lower() in [x.lower() for x in OWNED_PAGES_TOKENS.keys()] and fetch_profile(page_id)['post_insights'] != '':
 
         try:
-            insights = get_insights_for_post(status_id, access_token, fields, 'lifetime')
-
-            unique_link_clicks = 0 if 'link clicks' not in insights['data'][0]['values'][0]['value'] else insights['data'][0]['values'][0]['value'].get('link clicks')
-            total_unique_impressions = insights['data'][1]['values'][0]['value'].get('total')
-            ctr = None if total_unique_impressions == 0 else (float(unique_link_clicks)/float(total_unique_impressions)) * 100
-            ctr_lb_confidence = None if status_type != 'link' else ci_lower_bound(unique_link_clicks, total_unique_impressions, 0.95) * 100
-
-            paid_unique_impressions = insights['data'][1]['values'][0]['value'].get('paid')
-            organic_unique_impressions = insights['data'][1]['values'][0]['value'].get('unpaid')
-            post_video_views = insights['data'][2]['values'][0]['value']
-            fan_unique_impressions = insights['data'][3]['values'][0]['value']
-            non_fan_unique_impressions = total_unique_impressions - fan_unique_impressions
-            non_fan_unique_impressions_rate = None if total_unique_impressions == 0 else (float(non_fan_unique_impressions)/float(total_unique_impressions)) * 100
-            hide_clicks = 0 if 'hide_clicks' not in insights['data'][4]['values'][0]['value'] else insights['data'][4]['values'][0]['value'].get('hide_clicks')
-            hide_all_clicks = 0 if 'hide_all_clicks' not in insights['data'][4]['values'][0]['value'] else insights['data'][4]['values'][0]['value'].get('hide_all_clicks')
-            hide_rate = None if total_unique_impressions == 0 else (float(hide_clicks + hide_all_clicks)/float(total_unique_impressions)) * 100
-
-            # Engagement Rate
-            if num_shares is not None and num_reactions is not None and num_comments is not None:
-                total_engagement = num_shares + num_reactions + num_comments
-                if status_type != 'video':
-                    engagement_rate = None if total_unique_impressions == 0 else float(total_engagement)/float(total_unique_impressions) * 100
-                    engage_lb_confidence = ci_lower_bound(total_engagement, total_unique_impressions, 0.95) * 100
-                if status_type == 'video':
-                    engagement_rate = None if post_video_views == 0 else float(total_engagement)/float(post_video_views) * 100
-                    engage_lb_confidence = ci_lower_bound(total_engagement, post_video_views, 0.95) * 100
+            insights = get_insights_for_post(status_id, access_token, fetch_profile(page_id)['post_insights'], 'lifetime', published=utc_status_published)
+            # Read by name as a profile may ask for any of the metrics.  A value of an unexpected shape only leaves its own
+            # field empty
+            insight_values = dict((metric['name'], metric['values'][0]['value'] if metric.get('values') else None) for metric in insights['data'])
+
+            consumptions = insight_values.get('post_consumptions_by_type_unique')
+            unique_link_clicks = None if consumptions is None else insight_breakdown_count(consumptions, 'link clicks')
+            impressions = insight_values.get('post_impressions_by_paid_non_paid_unique', {})
+            total_unique_impressions = insight_breakdown_count(impressions, 'total', None)
+            paid_unique_impressions = insight_breakdown_count(impressions, 'paid', None)
+            organic_unique_impressions = insight_breakdown_count(impressions, 'unpaid', None)
+            post_video_views = insight_count(insight_values.get('post_video_views'))
+            fan_unique_impressions = insight_count(insight_values.get('post_impressions_fan_unique'))
+            negative_feedback = insight_values.get('post_negative_feedback_by_type_unique')
+            hide_clicks = None if negative_feedback is None else insight_breakdown_count(negative_feedback, 'hide_clicks')
+            hide_all_clicks = None if negative_feedback is None else insight_breakdown_count(negative_feedback, 'hide_all_clicks')
+
+            if total_unique_impressions is not None:
+                metrics = post_metrics(status_type, unique_link_clicks, total_unique_impressions, fan_unique_impressions, post_video_views, hide_clicks, hide_all_clicks,
+                                       num_shares, num_reactions, num_comments)
+                ctr, ctr_lb_confidence, non_fan_unique_impressions_rate, hide_rate, engagement_rate, engage_lb_confidence = [metrics[column] for column in POST_METRIC_COLUMNS]
     
             ## Counts of each reaction separately.  Can comment out for speed's sake 
             
@@ -489,7 +2066,7 @@ def process_fb_page_post(status, access_token, page_id):
         except Exception as e:
             print e
 
-    scraped_row = {
+    scraped_row = PostRow({
             'Page': page_id,
             'Published': utc_status_published,
             'Unique Impressions': total_unique_impressions,
@@ -507,8 +2084,8 @@ def process_fb_page_post(status, access_token, page_id):
             'Engagement Rate (%)': engagement_rate,
             'Adjusted Engagement Rate (%)': engage_lb_confidence,
             'Video Views': post_video_views,
-            'Headline': post_title.decode('utf-8','ignore').encode('utf-8') if post_title is not None else None,
-            'Caption': status_message.decode('utf-8','ignore').encode('utf-8') if status_message is not None else None,
+            'Headline': post_title,
+            'Caption': status_message,
             'Link': status_link,
             'Num Likes': num_likes, 
             'Num Comments': num_comments, 
@@ -521,90 +2098,413 @@ def process_fb_page_post(status, access_token, page_id):
             'Post ID': status_id,
             'Organic Unique Impressions': organic_unique_impressions,
             'Timestamp': timestamp
-    }
+    })
     return scraped_row
 
 
-def scrape_single_fb_page_items(page_id, from_date, until_date, access_token, scrape_function, process_item_function):
+# Sub-requests the row builders will make for an item, so they can be sent ahead of time as batch requests
+def post_sub_request_urls(status, access_token, page_id):
+    urls = []
+    if GET_PUBLIC_SHARES_BOOL and 'link' in status:
+        status_link = unicode_normalize(status['link'])
+        if not get_url_shares_cache().contains(normalize_share_url(status_link)):
+            urls.append(build_url_shares_url(access_token, status_link))
+    if GET_SPECIFIC_REACTIONS_BOOL and status['created_time'] > '2016-02-24 00:00:00':
+        urls.append(build_specific_reactions_url(status['id'], access_token))
+
+    post_title = status.get('name')
+    is_cover_photo = post_title is not None and 'cover photo' in post_title and status['type'] == 'photo'
+    post_insights_fields = fetch_profile(page_id)['post_insights']
+    if page_id.lower() in [x.lower() for x in OWNED_PAGES_TOKENS.keys()] and not is_cover_photo and post_insights_fields != '':
+        urls.append(build_post_insights_url(status['id'], access_token, post_insights_fields, 'lifetime'))
+    return urls
+
+
+def video_sub_request_urls(video, access_token, page_id):
+    if video.get('status', {}).get('video_status') == 'expired':
+        return []
+    video_insights_metrics = fetch_profile(page_id)['video_insights']
+    if page_id.lower() in [x.lower() for x in OWNED_PAGES_TOKENS.keys()] and video_insights_metrics != '':
+        return [build_video_insights_url(video['id'], access_token, 'lifetime', video_insights_metrics)]
+    return []
+
+
+BATCH_URL_COLLECTORS = {
+    process_fb_page_post: post_sub_request_urls,
+    process_fb_page_video: video_sub_request_urls,
+    process_fb_page_video_all_metrics: video_sub_request_urls
+}
+
+# Endpoint names used to keep checkpoints of each scrape_function apart
+SCRAPE_FUNCTION_ENDPOINTS = {
+    get_fb_page_post_data: 'posts',
+    get_fb_page_video_data: 'videos'
+}
+
+
+def checkpoint_paths(endpoint, process_name, page_id):
+    # Rows differ with the function that builds them (e.g. social_elastic's all metrics videos), so each has its own
+    base_path = os.path.join(CHECKPOINT_DIR, '{}_{}_{}'.format(endpoint, process_name, page_id.lower()))
+    return base_path + '.json', base_path + '.rows.jsonl'
+
+
+def load_checkpoint(endpoint, process_name, page_id):
+    checkpoint_path, rows_path = checkpoint_paths(endpoint, process_name, page_id)
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def save_checkpoint(endpoint, process_name, page_id, checkpoint):
+    checkpoint_path, rows_path = checkpoint_paths(endpoint, process_name, page_id)
+    # Write then rename so a Ctrl+C mid-write can't leave a truncated checkpoint
+    with open(checkpoint_path + '.tmp', 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.rename(checkpoint_path + '.tmp', checkpoint_path)
+
+
+def load_checkpoint_rows(endpoint, process_name, page_id):
+    checkpoint_path, rows_path = checkpoint_paths(endpoint, process_name, page_id)
+    if not os.path.exists(rows_path):
+        return []
+    with open(rows_path) as rows_file:
+        return [json.loads(line) for line in rows_file if line.strip()]
+
+
+def append_checkpoint_rows(endpoint, process_name, page_id, rows, truncate=False):
+    checkpoint_path, rows_path = checkpoint_paths(endpoint, process_name, page_id)
+    with open(rows_path, 'w' if truncate else 'a') as rows_file:
+        for row in rows:
+            rows_file.write(json.dumps(row_to_dict(row), separators=(',', ':')) + '\n')
+
+
+def checkpoint_cursor(url):
+    # Path after the API version and query of a paging URL, less its access token, so a resumed run sends it to its own
+    # GRAPH_API_HOST.  Also takes the whole URLs older checkpoints saved
+    split_url = urlparse.urlsplit(set_access_token(url))
+    path = split_url.path.strip('/').split('/')
+    if path and path[0].startswith('v') and path[0][1:].replace('.', '').isdigit():
+        path = path[1:]
+    return '/'.join(path) + '?' + split_url.query
+
+
+def start_from_checkpoint(endpoint, process_name, page_id, from_date, until_date):
+    # Returns the checkpoint to keep updating, rows already collected, the cursor to continue from and the from_date to use
+    if not os.path.isdir(CHECKPOINT_DIR):
+        os.makedirs(CHECKPOINT_DIR)
+    checkpoint = load_checkpoint(endpoint, process_name, page_id) or {}
+    from_date_string = from_date.strftime('%Y-%m-%d %H:%M:%S')
+
+    # Same from_date as an interrupted run: pick up its rows and cursor, or just its rows if the page had finished.  Its
+    # until_date stands as the cursor encodes it
+    if CHECKPOINT_MODE == 'resume' and checkpoint.get('from_date') == from_date_string and 'complete' in checkpoint:
+        if checkpoint['complete']:
+            print 'Reusing {} {} rows of finished checkpoint of {}'.format(page_id, endpoint, checkpoint.get('updated'))
+        else:
+            print 'Resuming {} {} from checkpoint of {}'.format(page_id, endpoint, checkpoint.get('updated'))
+        return checkpoint, load_checkpoint_rows(endpoint, process_name, page_id), checkpoint.get('cursor'), from_date
+
+    if CHECKPOINT_MODE == 'incremental' and checkpoint.get('newest_created_time') is not None:
+        # One second past the newest item already scraped
+        newest_published = utc_to_timezone(checkpoint['newest_created_time'], TIMEZONE) + datetime.timedelta(seconds=1)
+        if newest_published > from_date:
+            print 'Scraping {} {} incrementally from {}'.format(page_id, endpoint, newest_published.strftime('%Y-%m-%d %H:%M:%S'))
+            from_date = newest_published
+
+    checkpoint = {'from_date': from_date_string, 'until_date': str(until_date), 'cursor': None, 'complete': False,
+                  'newest_created_time': checkpoint.get('newest_created_time')}
+    append_checkpoint_rows(endpoint, process_name, page_id, [], truncate=True)
+    return checkpoint, [], None, from_date
+
+
+def page_reaches_from_date(items, from_date):
+    # Items are newest first so the oldest is last
+    return len(items['data']) > 0 and utc_to_timezone(items['data'][-1]['created_time'], TIMEZONE) < from_date
+
+
+def iter_result_pages(items, from_date, lookahead):
+    # Yield the first page of results then follow paging.next until a page reaches from_date.  With a lookahead the
+    # following pages are requested on a background thread while the caller is still processing the current page
+    def next_page_url(items):
+        if page_reaches_from_date(items, from_date):
+            return None
+        return items.get('paging', {}).get('next')
+
+    yield items
+
+    if lookahead <= 0:
+        url = next_page_url(items)
+        while url is not None:
+            items = request_until_succeed(url).json()
+            yield items
+            url = next_page_url(items)
+        return
+
+    pages = Queue.Queue(maxsize=lookahead)
+    stop = threading.Event()
+
+    def put_unless_stopped(message):
+        while not stop.is_set():
+            try:
+                pages.put(message, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+    # Requests for the following pages belong to the same Facebook page as the caller's
+    page_id = run_telemetry.current_page()
+
+    def fetch_ahead(items):
+        run_telemetry.set_page(page_id)
+        try:
+            url = next_page_url(items)
+            while url is not None and not stop.is_set():
+                items = request_until_succeed(url).json()
+                put_unless_stopped(('page', items))
+                url = next_page_url(items)
+            put_unless_stopped(('done', None))
+        except Exception:
+            put_unless_stopped(('error', sys.exc_info()))
+
+    prefetcher = threading.Thread(target=fetch_ahead, args=[items])
+    prefetcher.setDaemon(True)
+    prefetcher.start()
+
+    try:
+        while True:
+            kind, value = pages.get()
+            if kind == 'done':
+                return
+            if kind == 'error':
+                raise value[0], value[1], value[2]
+            yield value
+    finally:
+        # Also reached when the caller abandons the generator, so the prefetcher doesn't carry on down the cursor
+        stop.set()
+
+
+def scrape_single_fb_page_items(page_id, from_date, until_date, access_token, scrape_function, process_item_function, map_function=map, checkpoint_bool=True):
     num_processed = 0   # keep a count on how many we've processed
     scraped_rows_list = []
 
     scrape_starttime = datetime.datetime.now()
-
-    items = scrape_function(page_id, access_token, 100, until_date)
+    run_telemetry.set_page(page_id)
+
+    endpoint = SCRAPE_FUNCTION_ENDPOINTS.get(scrape_function)
+    process_name = process_item_function.__name__
+    checkpoint = None
+    cursor = None
+    if CHECKPOINT_MODE is not None and endpoint is not None and checkpoint_bool:
+        checkpoint, scraped_rows_list, cursor, from_date = start_from_checkpoint(endpoint, process_name, page_id, from_date, until_date)
+        num_processed = len(scraped_rows_list)
+        if checkpoint.get('complete'):
+            return scraped_rows_list
+    num_checkpointed = num_processed
+
+    if cursor is not None:
+        items = request_until_succeed(set_access_token('{}/{}'.format(graph_api_base(), checkpoint_cursor(cursor)), access_token)).json()
+    else:
+        # 'since' has Facebook filter out items before from_date, which is in TIMEZONE
+        items = scrape_function(page_id, access_token, 100, until_date, timezone_to_posix(from_date, TIMEZONE))
     if 'error' in items:
         print items['error']
         return scraped_rows_list
     
-    needs_next_page = True
-
-    while needs_next_page:
+    for items in iter_result_pages(items, from_date, PAGINATION_LOOKAHEAD):
+        # Items arrive newest first so those on or after from_date are a prefix of the page
+        items_in_range = []
         for item in items['data']:
 
             item_published = utc_to_timezone(item['created_time'], TIMEZONE)
             if item_published >= from_date:
-
-                processed_item = process_item_function(item, access_token, page_id)
-                if processed_item is not None:
-                    scraped_rows_list.append(processed_item)
-                    # output progress occasionally to make sure code is not stalling
-                    num_processed += 1
-                    if num_processed % 10 == 0:
-                        print '{} {} items Processed | {}'.format(num_processed, page_id, item_published.strftime('%Y-%m-%d %H:%M:%S'))
+                items_in_range.append((item, item_published))
             else:
-                needs_next_page = False
                 # Else avoid processing items that fall before from_date in a single 'items run'
                 break
 
-        if needs_next_page and 'paging' in items.keys():
-            if 'next' in items['paging']:
-                items = request_until_succeed(items['paging']['next']).json()
-            else:
-                needs_next_page = False
-        else:
-            needs_next_page = False
+        batched_urls = []
+        sub_request_urls = BATCH_URL_COLLECTORS.get(process_item_function)
+        if BATCH_SUB_REQUESTS_BOOL and sub_request_urls is not None:
+            urls = [url for item, item_published in items_in_range for url in sub_request_urls(item, access_token, page_id)]
+            batched_urls = prefetch_batched_sub_requests(urls, access_token)
+
+        # map_function lets an engine process a page's items concurrently; results must come back in item order
+        processed_items = map_function(lambda item_in_range: run_telemetry.time_item(page_id, process_item_keeping_raw, endpoint, process_item_function,
+                                                                                     item_in_range[0], access_token, page_id), items_in_range)
+
+        for (item, item_published), processed_item in zip(items_in_range, processed_items):
+            if processed_item is not None:
+                scraped_rows_list.append(processed_item)
+                # output progress occasionally to make sure code is not stalling
+                num_processed += 1
+                if num_processed % 10 == 0:
+                    print '{} {} items Processed | {}'.format(num_processed, page_id, item_published.strftime('%Y-%m-%d %H:%M:%S'))
+
+        discard_batched_responses(batched_urls)
+
+        if checkpoint is not None:
+            page_rows = [processed_item for processed_item in processed_items if processed_item is not None]
+            append_checkpoint_rows(endpoint, process_name, page_id, page_rows)
+            if len(items_in_range) > 0 and (checkpoint['newest_created_time'] is None or items_in_range[0][0]['created_time'] > checkpoint['newest_created_time']):
+                checkpoint['newest_created_time'] = items_in_range[0][0]['created_time']
+            next_url = None if page_reaches_from_date(items, from_date) else items.get('paging', {}).get('next')
+            checkpoint['cursor'] = None if next_url is None else checkpoint_cursor(next_url)
+            checkpoint['updated'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            save_checkpoint(endpoint, process_name, page_id, checkpoint)
+
+    if checkpoint is not None:
+        checkpoint['complete'] = True
+        save_checkpoint(endpoint, process_name, page_id, checkpoint)
     
+    run_telemetry.record_page(page_id, num_processed - num_checkpointed, (datetime.datetime.now() - scrape_starttime).total_seconds())
     print 'Finished Processing {} {} items! | {}'.format(num_processed, page_id, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
     return scraped_rows_list
 
 
-def scrape_fb_pages_items(page_ids, from_date, until_date, scrape_function, process_item_function):
-    # Define length of results for indexed access store page results in order of specification, rather than appending result from first thread to finish
-    results = [None] * len(page_ids)
-    
-    # Create FIFO queue
-    queue_page_ids = Queue.Queue()
-    
-    # Set number of threads to the number of pages to be scraped
-    num_threads = len(page_ids)
+item_work_queue = None
+item_work_queue_lock = threading.Lock()
 
-    # Add items with their ordinal number to queue
-    for idx, page_id in enumerate(page_ids):
-        queue_page_ids.put((idx, page_id))
 
-    # Wrapper function to scrape_single_fb_page_items which pulls from queue and is able to assign return output to a variable in this scope
-    def grab_page_from_queue(queue):
-        while not queue.empty():
-            idx, page_id = queue.get()
-            
-            # Select appropriate access token based on page. Include some logic handling FB page capitalisations
-            access_token = OWNED_PAGES_TOKENS.get(page_id) if OWNED_PAGES_TOKENS.get(page_id.lower()) is None else OWNED_PAGES_TOKENS.get(page_id.lower())
-            if access_token is None:
-                # For competitors set default access token to use as arbitrary token in owned dict
-                access_token = OWNED_PAGES_TOKENS.itervalues().next()
+def process_item_work_queue(queue):
+    while True:
+        function, arg, result_slot, done = queue.get()
+        try:
+            result_slot.append((True, function(arg)))
+        except Exception:
+            result_slot.append((False, sys.exc_info()))
+        done.set()
+        queue.task_done()
+
+
+def get_item_work_queue():
+    global item_work_queue
+    if item_work_queue is None:
+        with item_work_queue_lock:
+            if item_work_queue is None:
+                queue = Queue.Queue()
+                for n in range(ITEM_WORKER_THREADS):
+                    t_i = threading.Thread(target=process_item_work_queue, args=[queue])
+                    t_i.setDaemon(True)
+                    t_i.start()
+                item_work_queue = queue
+    return item_work_queue
+
+
+def item_pool_map(function, items):
+    # Drop-in for map() that runs on the shared item worker pool. Results are assembled in the order of items
+    queue = get_item_work_queue()
+    pending = []
+    for item in items:
+        result_slot = []
+        done = threading.Event()
+        queue.put((function, item, result_slot, done))
+        pending.append((result_slot, done))
+
+    results = []
+    for result_slot, done in pending:
+        done.wait()
+        succeeded, result = result_slot[0]
+        if not succeeded:
+            raise result[0], result[1], result[2]
+        results.append(result)
+    return results
+
+
+def get_page_access_token(page_id):
+    # Select appropriate access token based on page. Include some logic handling FB page capitalisations
+    access_token = OWNED_PAGES_TOKENS.get(page_id) if OWNED_PAGES_TOKENS.get(page_id.lower()) is None else OWNED_PAGES_TOKENS.get(page_id.lower())
+    if access_token is None:
+        # For competitors set default access token to use as arbitrary token in owned dict.  As they're sent, their
+        # requests are spread over the token pool (see route_public_page_request)
+        access_token = OWNED_PAGES_TOKENS.itervalues().next()
+    return access_token
+
+
+def print_scrape_summary(page_ids, from_date, until_date, t0, t1):
+    if type(until_date) is datetime.datetime:
+        end_date = until_date.strftime('%Y-%m-%d %H:%M:%S')
+    else:
+        end_date = datetime.datetime.fromtimestamp(until_date)
+
+    print '\nDone!\n{} Facebook page(s) processed between {} and {} in {} second(s)'.format(len(page_ids), from_date.strftime('%Y-%m-%d %H:%M:%S'), end_date, (t1 - t0).seconds)
+    print_rate_limit_report()
+    print_token_pool_report()
+    print_response_cache_report()
+    print_url_shares_report()
+    print_traffic_archive_report()
+    print_telemetry_report()
+
+
+def scrape_fb_pages_items_gevent(page_ids, from_date, until_date, scrape_function, process_item_function, page_rows_function=None, keep_rows_bool=True):
+    # Same inputs and output as scrape_fb_pages_items, but every page and every item within a page runs on its own
+    # greenlet.  Requires the standard library to be monkey patched, which happens at import with --engine=gevent
+    global in_flight_requests
+    import gevent
+    import gevent.lock
+    import gevent.pool
+    from gevent import monkey
 
-            results[idx] = scrape_single_fb_page_items(page_id, from_date, until_date, access_token, scrape_function, process_item_function)
-            queue.task_done()
+    if not monkey.is_module_patched('socket'):
+        raise Exception('The gevent engine needs the standard library monkey patched. Run with --engine=gevent')
 
+    in_flight_requests = gevent.lock.BoundedSemaphore(MAX_IN_FLIGHT_REQUESTS)
+    size_http_pool(len(page_ids))
 
     t0 = datetime.datetime.now()
 
+    def scrape_page(page_id):
+        # Group.map keeps the results in item order so rows come out as they do with the threaded engine
+        rows = scrape_single_fb_page_items(page_id, from_date, until_date, get_page_access_token(page_id), scrape_function,
+                                           process_item_function, gevent.pool.Group().map)
+        if page_rows_function is not None:
+            page_rows_function(page_id, rows)
+        return rows if keep_rows_bool else []
+
+    page_greenlets = [gevent.spawn(scrape_page, page_id) for page_id in page_ids]
+    gevent.joinall(page_greenlets, raise_error=True)
+
+    t1 = datetime.datetime.now()
+    print_scrape_summary(page_ids, from_date, until_date, t0, t1)
+
+    scraped_rows_list = [item for page_greenlet in page_greenlets for item in page_greenlet.value]
+    return scraped_rows_list
+
+
+def run_work_units_on_threads(work_units, work_function, num_threads=None):
+    # Define length of results for indexed access store results in order of specification, rather than appending result from first thread to finish
+    results = [None] * len(work_units)
+    # exc_info of work units that raised, re-raised in the calling thread once every work unit is done
+    errors = []
+    
+    # Create FIFO queue
+    queue_work_units = Queue.Queue()
+    
+    # By default set number of threads to the number of work units e.g. pages to be scraped
+    num_threads = len(work_units) if num_threads is None else min(num_threads, len(work_units))
+
+    # Add work units with their ordinal number to queue
+    for idx, work_unit in enumerate(work_units):
+        queue_work_units.put((idx, work_unit))
+
+    # Wrapper function to work_function which pulls from queue and is able to assign return output to a variable in this scope
+    def grab_work_unit_from_queue(queue):
+        while not queue.empty():
+            idx, work_unit = queue.get()
+            try:
+                results[idx] = work_function(work_unit)
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                # Always mark the work unit done, or the join below would wait forever
+                queue.task_done()
+
     # To avoid strptime multithreading bug where strptime isn't loaded completely by first thread but called by another thread; call it first here
-    dummy = datetime.datetime.strptime(t0.strftime('%Y-%m-%d'), '%Y-%m-%d')
+    dummy = datetime.datetime.strptime(datetime.datetime.now().strftime('%Y-%m-%d'), '%Y-%m-%d')
 
     for n in range(num_threads):
         # Configure thread action
-        t_i = threading.Thread(target=grab_page_from_queue, args=[queue_page_ids])
+        t_i = threading.Thread(target=grab_work_unit_from_queue, args=[queue_work_units])
         # Must start threads in daemon mode to enable hard-kill
         t_i.setDaemon(True)
         t_i.start()
@@ -615,42 +2515,539 @@ def scrape_fb_pages_items(page_ids, from_date, until_date, scrape_function, proc
     Wrap Queue's join (no timeout argument) in designated terminator thread which HAS a timeout argument.  
     Ctrl+C can then end Terminator and thus MainThread whereupon the Python Interpreter hard-kills all spawned 'daemon' threads
     '''
-    term = threading.Thread(target=queue_page_ids.join)
+    term = threading.Thread(target=queue_work_units.join)
     term.setDaemon(True)
     term.start()
     # Terminator thread only stays alive when Queue's join() is running i.e. until natural completion once all queue elements have been processed
     while term.isAlive():
         # Any large timeout number crucial
         term.join(timeout=360000000)
-    
-    t1 = datetime.datetime.now()
 
-    if type(until_date) is datetime.datetime:
-        end_date = until_date.strftime('%Y-%m-%d %H:%M:%S')
+    if len(errors) > 0:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+def posix_to_timezone(posix_int, to_timezone):
+    return utc_to_timezone(datetime.datetime.utcfromtimestamp(posix_int).strftime('%Y-%m-%dT%H:%M:%S+0000'), to_timezone)
+
+
+def plan_backfill_windows(page_id, from_date, until_date, access_token, scrape_function):
+    # Split [from_date, until_date] into (from_date, until_date) windows of roughly BACKFILL_WINDOW_ITEMS items each, newest
+    # first, going by the post density of the latest page of results
+    since_posix = timezone_to_posix(from_date, TIMEZONE)
+    until_posix = timezone_to_posix(until_date, TIMEZONE) if type(until_date) is datetime.datetime else int(until_date)
+
+    items = scrape_function(page_id, access_token, 100, until_posix, since_posix)
+    if 'error' in items or 'next' not in items.get('paging', {}) or len(items['data']) == 0:
+        # Everything fits on one page of results
+        return [(from_date, until_date)]
+
+    oldest_posix = posix_from_utc_string(items['data'][-1]['created_time'])
+    items_per_second = float(len(items['data'])) / max(until_posix - oldest_posix, 1)
+    num_windows = math.ceil((until_posix - since_posix) * items_per_second / BACKFILL_WINDOW_ITEMS)
+    num_windows = int(min(BACKFILL_MAX_WINDOWS, max(1, num_windows)))
+
+    step = float(until_posix - since_posix) / num_windows
+    windows = []
+    for n in range(num_windows):
+        window_until = until_posix - int(n * step)
+        window_from_date = from_date if n == num_windows - 1 else posix_to_timezone(until_posix - int((n + 1) * step), TIMEZONE)
+        windows.append((window_from_date, window_until))
+    return windows
+
+
+def scrape_fb_pages_backfill(page_ids, from_date, until_date, scrape_function, process_item_function, map_function):
+    # Each page's date range is split into windows which are all scraped as separate work units then merged back per page.
+    # Windows share their boundary instant so rows are de-duplicated on Post ID/Video ID
+    def plan_page(page_id):
+        return plan_backfill_windows(page_id, from_date, until_date, get_page_access_token(page_id), scrape_function)
+
+    page_windows = run_work_units_on_threads(page_ids, plan_page)
+    work_units = []
+    for idx, page_id in enumerate(page_ids):
+        print 'Back-filling {} in {} window(s)'.format(page_id, len(page_windows[idx]))
+        work_units.extend((idx, page_id, window) for window in page_windows[idx])
+
+    def scrape_window(work_unit):
+        idx, page_id, (window_from_date, window_until_date) = work_unit
+        return scrape_single_fb_page_items(page_id, window_from_date, window_until_date, get_page_access_token(page_id), scrape_function,
+                                           process_item_function, map_function, checkpoint_bool=False)
+
+    window_results = run_work_units_on_threads(work_units, scrape_window, BACKFILL_MAX_THREADS)
+
+    page_window_rows = [[] for page_id in page_ids]
+    for (idx, page_id, window), rows in zip(work_units, window_results):
+        page_window_rows[idx].append(rows)
+    return [merge_window_rows(window_rows) for window_rows in page_window_rows]
+
+
+def merge_window_rows(window_rows):
+    # A page's rows from each of its windows in window order, less the duplicates of items on a shared boundary
+    rows = []
+    seen_ids = set()
+    for rows_of_window in window_rows:
+        for row in rows_of_window:
+            row_id = row.get('Post ID', row.get('Video ID'))
+            if row_id not in seen_ids:
+                seen_ids.add(row_id)
+                rows.append(row)
+    return rows
+
+
+# Rows are queued as (class name, state) so a worker run as __main__ and a coordinator importing this module (e.g.
+# social_elastic) agree on them.  Rows loaded from checkpoints are dicts
+def dump_shard_rows(rows):
+    rows_state = [(row.__class__.__name__, row.__getstate__()) if isinstance(row, ScrapedRow) else (None, row) for row in rows]
+    return zlib.compress(cPickle.dumps(rows_state, cPickle.HIGHEST_PROTOCOL))
+
+
+def load_shard_rows(rows_blob):
+    rows = []
+    for class_name, state in cPickle.loads(zlib.decompress(rows_blob)):
+        if class_name is None:
+            rows.append(state)
+        else:
+            row = globals()[class_name].__new__(globals()[class_name])
+            row.__setstate__(state)
+            rows.append(row)
+    return rows
+
+
+class ShardQueue(object):
+    # SQLite work queue of sharded runs.  A shard is a page or a back-fill window of one, kept with its status and, once
+    # scraped, its rows.  Workers claim shards in write transactions so any number of processes and hosts can share the
+    # file; it keeps the default rollback journal as WAL doesn't work over network filesystems
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY, scrape_function TEXT, process_item_function TEXT, '
+                                'state TEXT, started_at REAL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS shards (run_id INTEGER, shard_index INTEGER, page_index INTEGER, page_id TEXT, '
+                                'from_date TEXT, until_posix INTEGER, checkpoint INTEGER, status TEXT, worker TEXT, heartbeat_at REAL, '
+                                'attempts INTEGER, error TEXT, rows BLOB, PRIMARY KEY (run_id, shard_index))')
+
+    def write(self, function):
+        # function(connection) in a write transaction, which waits on other processes' for up to the connection timeout
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            committed = False
+            try:
+                result = function(self.connection)
+                self.connection.execute('COMMIT')
+                committed = True
+            finally:
+                if not committed:
+                    self.connection.execute('ROLLBACK')
+            return result
+
+    def read(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def start_run(self, scrape_function_name, process_item_function_name, shards):
+        # shards: (page_index, page_id, from_date, until_posix, checkpoint_bool) in the order rows are to be merged
+        def insert(connection):
+            run_id = connection.execute('INSERT INTO runs (scrape_function, process_item_function, state, started_at) VALUES (?, ?, ?, ?)',
+                                        (scrape_function_name, process_item_function_name, 'running', time.time())).lastrowid
+            connection.executemany('INSERT INTO shards VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL, 0, NULL, NULL)',
+                                   [(run_id, shard_index, page_index, page_id, from_date.strftime('%Y-%m-%d %H:%M:%S.%f'), until_posix,
+                                     int(checkpoint_bool), 'pending') for shard_index, (page_index, page_id, from_date, until_posix, checkpoint_bool)
+                                    in enumerate(shards)])
+            return run_id
+        return self.write(insert)
+
+    def finish_run(self, run_id, state):
+        # Rows are only kept until merged
+        def finish(connection):
+            connection.execute('UPDATE runs SET state = ? WHERE run_id = ?', (state, run_id))
+            connection.execute('DELETE FROM shards WHERE run_id = ?', (run_id,))
+        self.write(finish)
+
+    def num_running_runs(self):
+        return self.read("SELECT COUNT(*) FROM runs WHERE state = 'running'")[0][0]
+
+    def claim(self, worker):
+        # The first pending shard of the oldest running run, or one whose worker has stopped reporting in.  None if none
+        def claim_shard(connection):
+            shard = connection.execute("SELECT shards.run_id, shard_index, page_id, from_date, until_posix, checkpoint, scrape_function, process_item_function "
+                                       "FROM shards JOIN runs ON shards.run_id = runs.run_id WHERE runs.state = 'running' AND (status = 'pending' "
+                                       "OR (status = 'running' AND heartbeat_at < ?)) ORDER BY shards.run_id, shard_index LIMIT 1",
+                                       (time.time() - SHARD_CLAIM_TIMEOUT_SECONDS,)).fetchone()
+            if shard is not None:
+                connection.execute("UPDATE shards SET status = 'running', worker = ?, heartbeat_at = ?, attempts = attempts + 1 WHERE run_id = ? "
+                                   "AND shard_index = ?", (worker, time.time(), shard[0], shard[1]))
+            return shard
+        shard = self.write(claim_shard)
+        if shard is None:
+            return None
+        return {
+            'run_id': shard[0],
+            'shard_index': shard[1],
+            'page_id': shard[2],
+            'from_date': datetime.datetime.strptime(shard[3], '%Y-%m-%d %H:%M:%S.%f'),
+            'until_posix': shard[4],
+            'checkpoint_bool': bool(shard[5]),
+            'scrape_function': globals()[shard[6]],
+            'process_item_function': globals()[shard[7]]
+        }
+
+    def heartbeat(self, worker_prefix):
+        self.write(lambda connection: connection.execute("UPDATE shards SET heartbeat_at = ? WHERE status = 'running' AND worker LIKE ?",
+                                                         (time.time(), worker_prefix + '%')))
+
+    def complete(self, shard, rows):
+        # A shard claimed again from a worker thought lost may be completed twice; the first rows stand
+        rows_blob = sqlite3.Binary(dump_shard_rows(rows))
+        self.write(lambda connection: connection.execute("UPDATE shards SET status = 'done', rows = ? WHERE run_id = ? AND shard_index = ? "
+                                                         "AND status = 'running'", (rows_blob, shard['run_id'], shard['shard_index'])))
+
+    def fail(self, shard, error):
+        # Back to pending for another attempt, until it has had SHARD_MAX_ATTEMPTS
+        self.write(lambda connection: connection.execute("UPDATE shards SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                                                         "error = ? WHERE run_id = ? AND shard_index = ? AND status = 'running'",
+                                                         (SHARD_MAX_ATTEMPTS, error, shard['run_id'], shard['shard_index'])))
+
+    def page_shards(self, run_id, page_index):
+        # [(status, error)] of a page's shards
+        return self.read('SELECT status, error FROM shards WHERE run_id = ? AND page_index = ? ORDER BY shard_index', (run_id, page_index))
+
+    def page_window_rows(self, run_id, page_index):
+        return [load_shard_rows(str(rows_blob)) for (rows_blob,) in self.read('SELECT rows FROM shards WHERE run_id = ? AND page_index = ? '
+                                                                               'ORDER BY shard_index', (run_id, page_index))]
+
+
+def reset_forked_state():
+    # A forked worker process starts with copies of the coordinator's HTTP session, stores and worker pool, and of locks
+    # its other threads may have held at the fork.  Replace them all with fresh ones
+    global http_session, http_session_lock, rate_limiters, rate_limiters_lock, token_pool, token_pool_lock, response_cache, response_cache_lock
+    global traffic_archive, traffic_archive_lock, raw_store, raw_store_lock, run_telemetry, batched_responses, batched_responses_lock
+    global item_work_queue, item_work_queue_lock, url_shares_cache, url_shares_cache_lock
+    http_session, http_session_lock = None, threading.Lock()
+    rate_limiters, rate_limiters_lock = {}, threading.Lock()
+    token_pool, token_pool_lock = None, threading.Lock()
+    response_cache, response_cache_lock = None, threading.Lock()
+    traffic_archive, traffic_archive_lock = None, threading.Lock()
+    raw_store, raw_store_lock = None, threading.Lock()
+    run_telemetry = RunTelemetry()
+    batched_responses, batched_responses_lock = {}, threading.Lock()
+    item_work_queue, item_work_queue_lock = None, threading.Lock()
+    url_shares_cache, url_shares_cache_lock = None, threading.Lock()
+
+
+def scrape_shards(queue, worker, idle_seconds):
+    # One worker thread: claims and scrapes shards until no run is open, having waited up to idle_seconds for one
+    map_function = item_pool_map if ITEM_WORKER_THREADS > 0 else map
+    started_at = time.time()
+    while True:
+        shard = queue.claim(worker)
+        if shard is None:
+            if queue.num_running_runs() == 0 and time.time() - started_at >= idle_seconds:
+                return
+            time.sleep(SHARD_POLL_SECONDS)
+            continue
+        try:
+            rows = scrape_single_fb_page_items(shard['page_id'], shard['from_date'], shard['until_posix'], get_page_access_token(shard['page_id']),
+                                               shard['scrape_function'], shard['process_item_function'], map_function, shard['checkpoint_bool'])
+        except Exception:
+            print 'Shard {} of run {} ({}) failed | {}'.format(shard['shard_index'], shard['run_id'], shard['page_id'], worker)
+            queue.fail(shard, traceback.format_exc())
+            continue
+        queue.complete(shard, rows)
+
+
+def run_shard_worker(queue_path, idle_seconds=0):
+    queue = ShardQueue(queue_path)
+    worker_prefix = '{}:{}:'.format(socket.gethostname(), os.getpid())
+
+    # Keeps this process's claims from being taken over while its shards are scraped
+    def report_in():
+        while True:
+            time.sleep(SHARD_CLAIM_TIMEOUT_SECONDS / 10.0)
+            queue.heartbeat(worker_prefix)
+    t_heartbeat = threading.Thread(target=report_in)
+    t_heartbeat.setDaemon(True)
+    t_heartbeat.start()
+
+    size_http_pool(SHARD_WORKER_THREADS)
+    run_work_units_on_threads(range(SHARD_WORKER_THREADS), lambda n: scrape_shards(queue, worker_prefix + str(n), idle_seconds))
+
+
+def run_local_shard_worker(queue_path):
+    reset_forked_state()
+    run_shard_worker(queue_path)
+
+
+def wait_for_page_rows(queue, run_id, page_index, processes):
+    while True:
+        page_shards = queue.page_shards(run_id, page_index)
+        for status, error in page_shards:
+            if status == 'failed':
+                raise Exception('A shard failed {} times:\n{}'.format(SHARD_MAX_ATTEMPTS, error))
+        if all(status == 'done' for status, error in page_shards):
+            return merge_window_rows(queue.page_window_rows(run_id, page_index))
+        for process in processes:
+            if process.exitcode not in (None, 0):
+                raise Exception('Shard worker process {} exited with code {}'.format(process.pid, process.exitcode))
+        time.sleep(SHARD_POLL_SECONDS)
+
+
+def scrape_fb_pages_sharded(page_ids, from_date, until_date, scrape_function, process_item_function, page_rows_function=None, keep_rows_bool=True):
+    # Same inputs and output as scrape_fb_pages_items, with pages (or their back-fill windows) scraped by worker processes
+    # through the shard queue.  Each page is merged and handed on once it and every page before it is done, so rows and
+    # page_rows_function calls come in page order whichever worker finishes first
+    num_processes = SHARD_PROCESSES or multiprocessing.cpu_count()
+    t0 = datetime.datetime.now()
+
+    until_posix = timezone_to_posix(until_date, TIMEZONE) if type(until_date) is datetime.datetime else int(until_date)
+    if BACKFILL_MAX_WINDOWS > 1:
+        def plan_page(page_id):
+            return plan_backfill_windows(page_id, from_date, until_posix, get_page_access_token(page_id), scrape_function)
+        page_windows = run_work_units_on_threads(page_ids, plan_page)
     else:
-        end_date = datetime.datetime.fromtimestamp(until_date)
+        page_windows = [[(from_date, until_posix)] for page_id in page_ids]
+    # Windows are scraped without checkpoints, as in back-fill mode
+    shards = [(idx, page_id, window_from_date, int(window_until_posix), BACKFILL_MAX_WINDOWS <= 1)
+              for idx, page_id in enumerate(page_ids) for window_from_date, window_until_posix in page_windows[idx]]
+
+    queue = ShardQueue(SHARD_QUEUE_PATH)
+    run_id = queue.start_run(scrape_function.__name__, process_item_function.__name__, shards)
+    print 'Sharded run {}: {} shard(s) of {} page(s) queued in {} for {} worker process(es)'.format(run_id, len(shards), len(page_ids),
+                                                                                                   SHARD_QUEUE_PATH, num_processes)
+
+    processes = []
+    state = 'failed'
+    try:
+        for n in range(num_processes):
+            process = multiprocessing.Process(target=run_local_shard_worker, args=(SHARD_QUEUE_PATH,))
+            process.daemon = True
+            process.start()
+            processes.append(process)
+
+        results = []
+        for idx, page_id in enumerate(page_ids):
+            page_rows = wait_for_page_rows(queue, run_id, idx, processes)
+            print 'Merged {} {} items | {}'.format(len(page_rows), page_id, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            if page_rows_function is not None:
+                page_rows_function(page_id, page_rows)
+            if keep_rows_bool:
+                results.extend(page_rows)
+        state = 'done'
+    finally:
+        # Workers stop claiming once the run is no longer running
+        queue.finish_run(run_id, state)
+        for process in processes:
+            if state != 'done':
+                process.terminate()
+            process.join()
 
-    print '\nDone!\n{} Facebook page(s) processed between {} and {} in {} second(s)'.format(len(page_ids), from_date.strftime('%Y-%m-%d %H:%M:%S'), end_date, (t1 - t0).seconds)
+    t1 = datetime.datetime.now()
+    print_scrape_summary(page_ids, from_date, until_date, t0, t1)
+    return results
+
+
+def reprocess_fb_pages_items(page_ids, from_date, until_date, scrape_function, process_item_function, page_rows_function=None, keep_rows_bool=True):
+    # Same inputs and output as scrape_fb_pages_items, rebuilding rows from the raw store across processes instead of scraping
+    endpoint = SCRAPE_FUNCTION_ENDPOINTS[scrape_function]
+    num_processes = REPROCESS_PROCESSES or multiprocessing.cpu_count()
+    t0 = datetime.datetime.now()
+
+    raw_items = get_raw_store().iter_items(endpoint, page_ids, timezone_to_posix(from_date, TIMEZONE), until_date)
+    chunks = iter(lambda: [(process_item_function.__name__,) + raw_item for raw_item in itertools.islice(raw_items, 64)], [])
+    pool = multiprocessing.Pool(num_processes) if num_processes > 1 else None
+    try:
+        # Chunks come back in order so each page's rows are together and newest first, as scraped
+        row_chunks = itertools.imap(reprocess_raw_items_chunk, chunks) if pool is None else pool.imap(reprocess_raw_items_chunk, chunks)
+        page_id_rows = (page_id_row for row_chunk in row_chunks for page_id_row in row_chunk if page_id_row[1] is not None)
+        results = []
+        for page_id, page_rows in itertools.groupby(page_id_rows, key=lambda page_id_row: page_id_row[0]):
+            page_rows = [page_id_row[1] for page_id_row in page_rows]
+            print 'Reprocessed {} {} items | {}'.format(len(page_rows), page_id, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            if page_rows_function is not None:
+                page_rows_function(page_id, page_rows)
+            if keep_rows_bool:
+                results.extend(page_rows)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    t1 = datetime.datetime.now()
+    print '\nDone!\n{} Facebook page(s) reprocessed from {} in {} second(s)'.format(len(page_ids), RAW_STORE_PATH, (t1 - t0).seconds)
+    return results
+
+
+def scrape_fb_pages_items(page_ids, from_date, until_date, scrape_function, process_item_function, page_rows_function=None, keep_rows_bool=True):
+    # page_rows_function(page_id, rows), if given, is called from the worker as soon as each page's rows are complete
+    # so they can be handed on (e.g. indexed) while the remaining pages are still being scraped.  Without keep_rows_bool
+    # rows are dropped once handed on and an empty list is returned
+    if REPROCESS_BOOL:
+        return reprocess_fb_pages_items(page_ids, from_date, until_date, scrape_function, process_item_function, page_rows_function, keep_rows_bool)
+    if SHARD_BOOL:
+        return scrape_fb_pages_sharded(page_ids, from_date, until_date, scrape_function, process_item_function, page_rows_function, keep_rows_bool)
+    if SCRAPE_ENGINE == 'gevent':
+        return scrape_fb_pages_items_gevent(page_ids, from_date, until_date, scrape_function, process_item_function, page_rows_function, keep_rows_bool)
+
+    map_function = item_pool_map if ITEM_WORKER_THREADS > 0 else map
+    size_http_pool(max(len(page_ids), BACKFILL_MAX_THREADS) if BACKFILL_MAX_WINDOWS > 1 else len(page_ids))
+
+    def scrape_page(page_id):
+        rows = scrape_single_fb_page_items(page_id, from_date, until_date, get_page_access_token(page_id), scrape_function, process_item_function, map_function)
+        if page_rows_function is not None:
+            page_rows_function(page_id, rows)
+        return rows if keep_rows_bool else []
+
+    t0 = datetime.datetime.now()
+
+    if BACKFILL_MAX_WINDOWS > 1:
+        results = scrape_fb_pages_backfill(page_ids, from_date, until_date, scrape_function, process_item_function, map_function)
+        # Windows of a page finish in any order, so its rows are only complete once they've all been merged
+        if page_rows_function is not None:
+            for page_id, rows in zip(page_ids, results):
+                page_rows_function(page_id, rows)
+        if not keep_rows_bool:
+            results = []
+    else:
+        results = run_work_units_on_threads(page_ids, scrape_page)
+    
+    t1 = datetime.datetime.now()
+    print_scrape_summary(page_ids, from_date, until_date, t0, t1)
 
     scraped_rows_list = [item for sublist in results for item in sublist]
     return scraped_rows_list
 
 
+POST_OUTPUT_COLUMNS = ['Page', 'Published (EST)', 'Type', 'Headline', 'Unique Impressions', 'Impression Rate Non-Likers (%)', 'Unique Link Clicks', 'CTR (%)', 'Adjusted CTR (%)', 
+                       'Num Shares', 'Engagement Rate (%)', 'Adjusted Engagement Rate (%)', 'Lifetime Public Num Shares', 'Num Reactions', 'Video Views', 'Caption', 'Link', 'Num Likes',
+                       'Num Comments', 'Num Loves', 'Num Wows', 'Num Hahas', 'Num Sads', 'Num Angrys', 'Hide Rate (%)', 'Hide Clicks', 'Hide All Clicks', 
+                       'Paid Unique Impressions', 'Organic Unique Impressions', 'Post ID']
+
+VIDEO_OUTPUT_COLUMNS = ['Page', 'Video ID', 'Published (EST)', 'Live Video', 'Crossposted Video', 'Headline', 'Caption', 'Num Likes', 'Num Reactions', 'Num Comments', '3s Views', 
+                        '10s Views', 'Complete Views', 'Total Paid Views', '10s/3s Views (%)', 'Complete/3s Views (%)', 'Impressions', 
+                        'Impression Rate Non-Likers (%)', 'Avg View Time', 'Link']
+
+# Parquet column types.  Every other column is float64 so all partitions share one schema whatever the values in them
+OUTPUT_STRING_COLUMNS = ('Page', 'Published (EST)', 'Published Date', 'Type', 'Headline', 'Caption', 'Link', 'Post ID', 'Video ID')
+OUTPUT_BOOL_COLUMNS = ('Live Video', 'Crossposted Video')
+
+
+def output_row_values(row, columns):
+    # Values in column order with 'Published (EST)' added and floats rounded to 1dp as in the pandas CSV
+    values = []
+    for column in columns:
+        if column == 'Published (EST)':
+            value = utc_to_timezone(row['Published'], TIMEZONE).strftime('%Y-%m-%d %H:%M:%S')
+        else:
+            value = row.get(column)
+        if isinstance(value, float):
+            value = round(value, 1)
+        elif type(value) is unicode:
+            value = value.encode('utf-8')
+        values.append(value)
+    return values
+
+
+class CsvOutputSink(object):
+    # Appends each page's rows to a single CSV as it finishes, optionally compressed with gzip or zstandard
+    def __init__(self, path, columns, compression=None):
+        self.lock = threading.Lock()
+        self.path = path
+        self.columns = columns
+        self.num_rows = 0
+        self.raw_file = None
+        if compression == 'gz':
+            self.file = gzip.open(path, 'wb')
+        elif compression == 'zst':
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception('csv.zst output needs the zstandard package. pip install zstandard')
+            self.raw_file = open(path, 'wb')
+            self.file = zstandard.ZstdCompressor().stream_writer(self.raw_file)
+        else:
+            self.file = open(path, 'wb')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write_page_rows(self, page_id, rows):
+        with self.lock:
+            self.writer.writerows(output_row_values(row, self.columns) for row in rows)
+            self.num_rows += len(rows)
+
+    def close(self):
+        self.file.close()
+        if self.raw_file is not None and not self.raw_file.closed:
+            self.raw_file.close()
+
+
+class ParquetOutputSink(object):
+    # Writes each page's rows as Parquet files under path/Page=<page>/Published Date=<yyyy-mm-dd>/ as it finishes
+    def __init__(self, path, columns):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise Exception('parquet output needs the pyarrow package. pip install pyarrow')
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.lock = threading.Lock()
+        self.path = path
+        self.columns = columns + ['Published Date']
+        self.types = [pyarrow.string() if column in OUTPUT_STRING_COLUMNS else pyarrow.bool_() if column in OUTPUT_BOOL_COLUMNS else pyarrow.float64()
+                      for column in self.columns]
+        self.num_rows = 0
+
+    def write_page_rows(self, page_id, rows):
+        if len(rows) == 0:
+            return
+        value_rows = [values + [values[self.columns.index('Published (EST)')][:10]] for values in
+                      (output_row_values(row, self.columns[:-1]) for row in rows)]
+        arrays = [self.pa.array([values[n] for values in value_rows], type=column_type) for n, column_type in enumerate(self.types)]
+        table = self.pa.Table.from_arrays(arrays, names=self.columns)
+        with self.lock:
+            self.pq.write_to_dataset(table, self.path, partition_cols=['Page', 'Published Date'])
+            self.num_rows += len(rows)
+
+    def close(self):
+        pass
+
+
+def open_output_sink(output_format, name, columns):
+    path = '{}/{}_{}.{}'.format(OUTPUT_DIR, name, datetime.datetime.now().strftime('%y-%m-%d_%H.%M.%S'), output_format)
+    if output_format == 'parquet':
+        return ParquetOutputSink(path, columns)
+    elif output_format in ('csv', 'csv.gz', 'csv.zst'):
+        return CsvOutputSink(path, columns, output_format.partition('.')[2] or None)
+    raise Exception('Unknown output format {}'.format(output_format))
+
+
+def scrape_items_to_sink(page_ids, from_date, until_date, scrape_function, process_item_function, name, columns):
+    sink = open_output_sink(OUTPUT_FORMAT, name, columns)
+    try:
+        scrape_fb_pages_items(page_ids, from_date, until_date, scrape_function, process_item_function, sink.write_page_rows, keep_rows_bool=False)
+    finally:
+        sink.close()
+    print '{} rows written to {}'.format(sink.num_rows, sink.path)
+
+
 def scrape_posts_to_csv(page_ids, from_date, until_date, scrape_function, process_item_function):
+    if OUTPUT_FORMAT is not None:
+        return scrape_items_to_sink(page_ids, from_date, until_date, scrape_function, process_item_function, 'posts', POST_OUTPUT_COLUMNS)
+
     scraped_rows_list = scrape_fb_pages_items(page_ids, from_date, until_date, scrape_function, process_item_function)
-    scraped_rows_df = pd.DataFrame(scraped_rows_list)
+    pd = import_pandas()
+    scraped_rows_df = pd.DataFrame([row_to_dict(row) for row in scraped_rows_list])
 
     # Convert UTC datetimes to EST
     scraped_rows_df['Published (EST)'] = [utc_to_timezone(x, TIMEZONE).strftime('%Y-%m-%d %H:%M:%S') for x in scraped_rows_df['Published']]
 
-    csvColumns = ['Page', 'Published (EST)', 'Type', 'Headline', 'Unique Impressions', 'Impression Rate Non-Likers (%)', 'Unique Link Clicks', 'CTR (%)', 'Adjusted CTR (%)', 
-                    'Num Shares', 'Engagement Rate (%)', 'Adjusted Engagement Rate (%)', 'Lifetime Public Num Shares', 'Num Reactions', 'Video Views', 'Caption', 'Link', 'Num Likes',
-                    'Num Comments', 'Num Loves', 'Num Wows', 'Num Hahas', 'Num Sads', 'Num Angrys', 'Hide Rate (%)', 'Hide Clicks', 'Hide All Clicks', 
-                    'Paid Unique Impressions', 'Organic Unique Impressions', 'Post ID']
-
     scraped_rows_df = scraped_rows_df.round(1)
     csv_filename = './facebook_output/{}_{}.csv'.format('posts', datetime.datetime.now().strftime('%y-%m-%d_%H.%M.%S'))
-    scraped_rows_df.to_csv(csv_filename, index=False, columns=csvColumns, encoding='utf-8')
+    scraped_rows_df.to_csv(csv_filename, index=False, columns=POST_OUTPUT_COLUMNS, encoding='utf-8')
     print csv_filename + ' written'
 
     # Output Summary to Terminal
@@ -668,8 +3065,12 @@ def scrape_posts_to_csv(page_ids, from_date, until_date, scrape_function, proces
 
 
 def scrape_videos_to_csv(page_ids, from_date, until_date, scrape_function, process_item_function):
+    if OUTPUT_FORMAT is not None:
+        return scrape_items_to_sink(page_ids, from_date, until_date, scrape_function, process_item_function, 'videos', VIDEO_OUTPUT_COLUMNS)
+
     scraped_rows_list = scrape_fb_pages_items(page_ids, from_date, until_date, scrape_function, process_item_function)
-    scraped_rows_df = pd.DataFrame(scraped_rows_list)
+    pd = import_pandas()
+    scraped_rows_df = pd.DataFrame([row_to_dict(row) for row in scraped_rows_list])
 
     # Convert UTC datetimes to EST
     scraped_rows_df['Published (EST)'] = [utc_to_timezone(x, TIMEZONE).strftime('%Y-%m-%d %H:%M:%S') for x in scraped_rows_df['Published']]
@@ -681,13 +3082,9 @@ def scrape_videos_to_csv(page_ids, from_date, until_date, scrape_function, proce
     print '\n'
 
     # We set ordering of csv columns here
-    csvColumns = ['Page', 'Video ID', 'Published (EST)', 'Live Video', 'Crossposted Video', 'Headline', 'Caption', 'Num Likes', 'Num Reactions', 'Num Comments', '3s Views', 
-                            '10s Views', 'Complete Views', 'Total Paid Views', '10s/3s Views (%)', 'Complete/3s Views (%)', 'Impressions', 
-                            'Impression Rate Non-Likers (%)', 'Avg View Time', 'Link']
-
     scraped_rows_df = scraped_rows_df.round(1)
     csv_filename = './facebook_output/{}_{}.csv'.format('videos', datetime.datetime.now().strftime('%y-%m-%d_%H.%M.%S'))
-    scraped_rows_df.to_csv(csv_filename, index=False, columns=csvColumns, encoding='utf-8')
+    scraped_rows_df.to_csv(csv_filename, index=False, columns=VIDEO_OUTPUT_COLUMNS, encoding='utf-8')
     print csv_filename + ' written'
 
     if __name__ != '__main__':
@@ -697,8 +3094,43 @@ def scrape_videos_to_csv(page_ids, from_date, until_date, scrape_function, proce
 def print_usage():
     print '\nUsage:\n python {0} <post/video> <num days back to begin scraping>\n e.g. for posts since yesterday midnight:'\
     ' python {0} post 1\n'\
-    ' python {0} <post/video> <start date> <end date> where dates are inclusive and in format yyyy-mm-dd'\
-    '\nCtrl+C to cancel\n'.format(sys.argv[0])
+    ' python {0} <post/video> <start date> <end date> where dates are inclusive and in format yyyy-mm-dd\n'\
+    ' python {0} reprocess <post/video> <num days back, or start date and end date> rebuilds rows from the raw store\n'\
+    ' python {0} worker [<shard queue path>] scrapes shards of sharded runs queued by another host'\
+    '\nOptions:\n'\
+    ' --engine=<threads/gevent>  gevent scrapes pages and their items concurrently on greenlets\n'\
+    ' --max-in-flight=<n>        cap on concurrent Graph API calls for the gevent engine (default {1})\n'\
+    ' --item-workers=<n>         threads shared by all pages to process items concurrently (default {2}, 0 to disable)\n'\
+    ' --lookahead=<n>            result pages to request ahead of the page being processed (default {3}, 0 to disable)\n'\
+    ' --cache                    reuse Graph API responses from the on-disk cache where still fresh\n'\
+    ' --incremental              only scrape items newer than those scraped by the last run\n'\
+    ' --resume                   carry on an interrupted run with the same start date from its last checkpoint\n'\
+    ' --backfill=<n>             split each page\'s date range into up to n windows scraped in parallel\n'\
+    ' --output=<format>          csv, csv.gz, csv.zst or parquet written page by page as the scrape runs\n'\
+    ' --report=<path>            write request and timing telemetry per endpoint and page as JSON, or Prometheus text for .prom\n'\
+    ' --share-store=<path>       keep public share counts in a SQLite store reused by later runs for up to {7} hours\n'\
+    ' --record=<path>            archive every Graph API request and response, with access tokens redacted\n'\
+    ' --replay=<path>            serve Graph API requests from a recorded archive with no network, at full speed\n'\
+    ' --replay-timing            replay with the recorded latencies and live rate limiting\n'\
+    ' --keep-raw                 keep scraped items and their insights responses in the raw store for reprocessing\n'\
+    ' --shards[=<n>]             scrape pages on n worker processes (default one per core) through the shard queue\n'\
+    ' --shard-queue=<path>       SQLite shard queue, shared with workers on other hosts (default {4})\n'\
+    ' --profile=<name>           fields and insights to fetch: {5} (default {6})\n'\
+    ' --competitor-profile=<name>  fetch profile for pages without their own token, e.g. lean-competitor\n'\
+    '\nCtrl+C to cancel\n'.format(sys.argv[0], MAX_IN_FLIGHT_REQUESTS, ITEM_WORKER_THREADS, PAGINATION_LOOKAHEAD, SHARD_QUEUE_PATH,
+                                  ', '.join(sorted(FETCH_PROFILES)), FETCH_PROFILE,
+                                  URL_SHARES_TTL_SECONDS // 3600)
+
+
+# Split '--name=value' options from positional arguments.  Bare '--name' flags are set to True
+def parse_cli_options(argv):
+    positional = [arg for arg in argv if not arg.startswith('--')]
+    options = {}
+    for arg in argv:
+        if arg.startswith('--'):
+            name, _, value = arg[2:].partition('=')
+            options[name] = value if value else True
+    return positional, options
 
 
 def is_date_string(date_string):
@@ -711,10 +3143,71 @@ def is_date_string(date_string):
 
 if __name__ == '__main__':
 
-    if len(sys.argv) == 3:
+    args, options = parse_cli_options(sys.argv)
+    if len(args) > 1 and args[1] == 'reprocess':
+        REPROCESS_BOOL = True
+        args = args[:1] + args[2:]
+
+    if options.get('engine') is not None:
+        if options['engine'] not in ('threads', 'gevent'):
+            print_usage()
+            sys.exit()
+        SCRAPE_ENGINE = options['engine']
+    if options.get('max-in-flight') is not None:
+        MAX_IN_FLIGHT_REQUESTS = int(options['max-in-flight'])
+    if options.get('item-workers') is not None:
+        ITEM_WORKER_THREADS = int(options['item-workers'])
+    if options.get('lookahead') is not None:
+        PAGINATION_LOOKAHEAD = int(options['lookahead'])
+    if options.get('cache'):
+        RESPONSE_CACHE_BOOL = True
+    if options.get('incremental'):
+        CHECKPOINT_MODE = 'incremental'
+    if options.get('resume'):
+        CHECKPOINT_MODE = 'resume'
+    if options.get('backfill') is not None:
+        BACKFILL_MAX_WINDOWS = int(options['backfill'])
+    if options.get('output') is not None:
+        if options['output'] not in ('csv', 'csv.gz', 'csv.zst', 'parquet'):
+            print_usage()
+            sys.exit()
+        OUTPUT_FORMAT = options['output']
+    if options.get('report') is not None:
+        TELEMETRY_REPORT_PATH = options['report']
+    if options.get('share-store') is not None:
+        URL_SHARES_CACHE_PATH = options['share-store']
+    if options.get('record') is not None:
+        TRAFFIC_RECORD_PATH = options['record']
+    if options.get('replay') is not None:
+        TRAFFIC_REPLAY_PATH = options['replay']
+    if options.get('replay-timing'):
+        TRAFFIC_REPLAY_TIMING = True
+    if options.get('keep-raw'):
+        RAW_STORE_BOOL = True
+    if options.get('shards') is not None:
+        SHARD_BOOL = True
+        if options['shards'] is not True:
+            SHARD_PROCESSES = int(options['shards'])
+    if options.get('shard-queue') is not None:
+        SHARD_QUEUE_PATH = options['shard-queue']
+    for option in ('profile', 'competitor-profile'):
+        if options.get(option) is not None and options[option] not in FETCH_PROFILES:
+            print_usage()
+            sys.exit()
+    if options.get('profile') is not None:
+        FETCH_PROFILE = options['profile']
+    if options.get('competitor-profile') is not None:
+        COMPETITOR_FETCH_PROFILE = options['competitor-profile']
+
+    if len(args) > 1 and args[1] == 'worker':
+        # Settings such as tokens must match the coordinator's, as shards are scraped with this host's
+        run_shard_worker(args[2] if len(args) > 2 else SHARD_QUEUE_PATH, SHARD_WORKER_IDLE_SECONDS)
+        sys.exit()
+
+    if len(args) == 3:
         # Option 1: Simply specify number of days back and scrape until now:
-        if sys.argv[2].isdigit():
-            num_days_back = int(sys.argv[2])
+        if args[2].isdigit():
+            num_days_back = int(args[2])
             local_now = datetime.datetime.now()
             today = datetime.datetime(year=local_now.year, month=local_now.month, day=local_now.day, hour=0, minute=0, second=0)
             local_from_date = today + datetime.timedelta(days=-num_days_back)
@@ -724,11 +3217,11 @@ if __name__ == '__main__':
         else:
             print_usage()
             sys.exit()
-    elif len(sys.argv) == 4:
+    elif len(args) == 4:
         # Option 2: Specify two inclusive dates in format YYYY-mm-dd
-        if is_date_string(sys.argv[2]) and is_date_string(sys.argv[3]):
-            local_from_date = datetime.datetime.strptime(sys.argv[2], '%Y-%m-%d')
-            local_until_date = datetime.datetime.strptime(sys.argv[3], '%Y-%m-%d')
+        if is_date_string(args[2]) and is_date_string(args[3]):
+            local_from_date = datetime.datetime.strptime(args[2], '%Y-%m-%d')
+            local_until_date = datetime.datetime.strptime(args[3], '%Y-%m-%d')
             # Add a day so Facebook includes whole day itself and transform to POSIX to ensure time component is included (normalized EST is NOT normalized UTC)
             utc_until_date = local_to_utc(local_until_date + datetime.timedelta(days = 1))
             utc_posix_until_date = calendar.timegm(utc_until_date.timetuple())
@@ -740,11 +3233,14 @@ if __name__ == '__main__':
             print_usage()
             sys.exit()
     # Until date is a string (used in API call).  From date is datetime object used to check paging
-    if sys.argv[1] == 'post':
+    if args[1] == 'post':
         scrape_posts_to_csv(PAGE_IDS_TO_SCRAPE, local_from_date, utc_posix_until_date, get_fb_page_post_data, process_fb_page_post)
     # Scrape OUR OWN crossposted videos using the /videos endpoint.  These don't include shares, but video POSTS do include shares!
-    elif sys.argv[1] == 'video':
+    elif args[1] == 'video':
         scrape_videos_to_csv(OWNED_PAGES_TOKENS.keys(), local_from_date, utc_posix_until_date, get_fb_page_video_data, process_fb_page_video)
     else:
         print_usage()
-        sys.exit()
\ No newline at end of file
+        sys.exit()
+
+    if TELEMETRY_REPORT_PATH is not None:
+        write_run_report(TELEMETRY_REPORT_PATH)
\ No newline at end of file
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+import sys
+import json
+import time
+import math
+import random
+import re
+import datetime
+import calendar
+import threading
+import collections
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+# Local stand-in for the Graph API serving synthetic pages, so scraper changes can be measured without a token or the
+# live API.  Any page id requested exists.  Also answers the Elasticsearch calls social_elastic.py makes (_bulk, aliases,
+# templates, ping).  Point get_fb_data.GRAPH_API_HOST (and social_elastic.ELASTIC_HOSTS) at it.
+# python mock_graph_server.py [port]
+
+# Every page has MOCK_POSTS_PER_DAY posts and MOCK_VIDEOS_PER_DAY videos evenly spaced over the MOCK_DAYS up to MOCK_END_DATE (UTC)
+MOCK_POSTS_PER_DAY = 8
+MOCK_VIDEOS_PER_DAY = 1
+MOCK_DAYS = 90
+MOCK_END_DATE = datetime.datetime(2018, 1, 1)
+# Largest limit honoured for /posts and /videos, so this and the date range set the pagination depth
+MOCK_MAX_PAGE_SIZE = 100
+# Distinct links per page; posts sharing a link exercise de-duplication of URL share lookups
+MOCK_LINKS_PER_PAGE = 50
+# Share of link posts linking one of MOCK_LINKS_PER_PAGE articles common to every page, each page with its own tracking
+# parameters, as when several pages post the same story
+MOCK_SHARED_LINK_RATE = 0.0
+
+# Per request latency is log-normal around the median.  0 answers straight away
+MOCK_LATENCY_MEDIAN_MS = 0
+MOCK_LATENCY_SIGMA = 0.5
+# Share of requests (and batch operations) answered with a 500 Graph error or an application request limit error
+MOCK_ERROR_RATE = 0.0
+MOCK_THROTTLE_RATE = 0.0
+# call_count/total_time/total_cputime % reported in X-App-Usage on every response
+MOCK_APP_USAGE = 10
+# False to send no usage headers at all, as some endpoints and API versions don't
+MOCK_USAGE_HEADERS_BOOL = True
+# Calls per second each access token may make, a batch counting one per operation.  Beyond it requests get a user request
+# limit error, and X-App-Usage reports the share of the quota used over the last second when that's above MOCK_APP_USAGE.
+# 0 for no limit
+MOCK_TOKEN_CALLS_PER_SECOND = 0
+# Share of documents an Elasticsearch _bulk request rejects with a 429
+MOCK_BULK_REJECT_RATE = 0.0
+
+mock_stats = {}
+mock_stats_lock = threading.Lock()
+
+
+def count_stat(name, amount=1):
+    with mock_stats_lock:
+        mock_stats[name] = mock_stats.get(name, 0) + amount
+
+
+def reset_mock_stats():
+    with mock_stats_lock:
+        mock_stats.clear()
+
+
+token_calls = {}
+token_calls_lock = threading.Lock()
+
+
+def record_token_calls(access_token, num_calls=1):
+    # Returns the % of the token's quota used over the last second including these calls, or None without a quota
+    if MOCK_TOKEN_CALLS_PER_SECOND <= 0:
+        return None
+    now = time.time()
+    with token_calls_lock:
+        calls = token_calls.setdefault(access_token, collections.deque())
+        while calls and calls[0] < now - 1:
+            calls.popleft()
+        calls.extend([now] * num_calls)
+        count_stat('calls_' + (access_token or 'none')[-12:], num_calls)
+        return 100 * len(calls) // MOCK_TOKEN_CALLS_PER_SECOND
+
+
+def posix_from_datetime(utc_datetime):
+    return calendar.timegm(utc_datetime.timetuple())
+
+
+def graph_time_string(posix_time):
+    return datetime.datetime.utcfromtimestamp(posix_time).strftime('%Y-%m-%dT%H:%M:%S+0000')
+
+
+# Items are numbered from 0, the newest, so any since/until window is a range of numbers
+def item_posix_time(item_number, items_per_day):
+    return posix_from_datetime(MOCK_END_DATE) - int(item_number * 86400.0 / items_per_day)
+
+
+def item_number_range(items_per_day, since, until):
+    step = 86400.0 / items_per_day
+    end_posix = posix_from_datetime(MOCK_END_DATE)
+    first = 0 if until is None else max(0, int(math.ceil((end_posix - until) / step)))
+    last = int(MOCK_DAYS * items_per_day) - 1
+    if since is not None:
+        last = min(last, int(math.floor((end_posix - since) / step)))
+    # Rounding the step can put an item a second either side of a bound
+    while first <= last and until is not None and item_posix_time(first, items_per_day) > until:
+        first += 1
+    while last >= first and since is not None and item_posix_time(last, items_per_day) < since:
+        last -= 1
+    return first, last
+
+
+def item_random(page_id, item_number, kind):
+    # Same numbers for an item on every request and every run
+    return random.Random('{}/{}/{}'.format(page_id, kind, item_number))
+
+
+def summary(count):
+    return {'data': [], 'summary': {'total_count': count}}
+
+
+def mock_post(page_id, item_number):
+    rng = item_random(page_id, item_number, 'post')
+    status_type = rng.choice(['link', 'link', 'link', 'photo', 'video', 'status'])
+    post = {
+        'id': '{}_{}'.format(page_id, item_number),
+        'created_time': graph_time_string(item_posix_time(item_number, MOCK_POSTS_PER_DAY)),
+        'type': status_type,
+        'message': u'Post {} from {} – “synthetic” caption'.format(item_number, page_id),
+        'name': u'Headline {} ’{}’'.format(item_number, page_id),
+        'comments': summary(rng.randint(0, 500)),
+        'reactions': summary(rng.randint(0, 5000)),
+        'shares': {'count': rng.randint(0, 1000)}
+    }
+    if status_type == 'link' and rng.random() < MOCK_SHARED_LINK_RATE:
+        post['link'] = 'http://example.com/shared/article-{}/?utm_source=facebook&utm_campaign={}'.format(rng.randint(0, MOCK_LINKS_PER_PAGE - 1), page_id)
+    elif status_type == 'link':
+        post['link'] = 'http://example.com/{}/article-{}?utm_source=facebook#top'.format(page_id, item_number % MOCK_LINKS_PER_PAGE)
+    return post
+
+
+def mock_video(page_id, item_number):
+    rng = item_random(page_id, item_number, 'video')
+    video = {
+        'id': '{}{}'.format(abs(hash(page_id)) % 100000, item_number),
+        'created_time': graph_time_string(item_posix_time(item_number, MOCK_VIDEOS_PER_DAY)),
+        'title': u'Video {} – {}'.format(item_number, page_id),
+        'description': u'Synthetic video “{}”'.format(item_number),
+        'permalink_url': '/{}/videos/{}/'.format(page_id, item_number),
+        'status': {'video_status': 'ready'},
+        'comments': summary(rng.randint(0, 300)),
+        'likes': summary(rng.randint(0, 3000)),
+        'reactions': summary(rng.randint(0, 4000))
+    }
+    if rng.random() < 0.05:
+        video['live_status'] = 'VOD'
+    return video
+
+
+def projected_fields(fields):
+    # Top level names of a fields= projection, e.g. 'id,comments.limit(0).summary(true)' gives id and comments
+    return set(field.split('.')[0] for field in re.split(r',(?![^(]*\))', fields))
+
+
+def mock_listing(page_id, kind, query, path):
+    items_per_day = MOCK_POSTS_PER_DAY if kind == 'posts' else MOCK_VIDEOS_PER_DAY
+    since = int(query['since']) if query.get('since') else None
+    until = int(query['until']) if query.get('until') else None
+    limit = min(int(query.get('limit') or 25), MOCK_MAX_PAGE_SIZE)
+
+    first, last = item_number_range(items_per_day, since, until)
+    item_numbers = range(first, min(last, first + limit - 1) + 1)
+    make_item = mock_post if kind == 'posts' else mock_video
+    listing = {'data': [make_item(page_id, item_number) for item_number in item_numbers]}
+    if query.get('fields'):
+        # As the Graph API does, only the fields asked for and the id
+        fields = projected_fields(query['fields'])
+        listing['data'] = [dict((name, value) for name, value in item.items() if name in fields or name == 'id') for item in listing['data']]
+    if len(item_numbers) > 0 and item_numbers[-1] < last:
+        next_query = dict(query)
+        next_query['until'] = item_posix_time(item_numbers[-1], items_per_day) - 1
+        listing['paging'] = {'next': '{}{}?{}'.format(mock_base_url, path, '&'.join('{}={}'.format(key, value) for key, value in next_query.items()))}
+    return listing
+
+
+def mock_post_insights(object_id, metric_names):
+    rng = random.Random('{}/insights'.format(object_id))
+    impressions = rng.randint(0, 200000)
+    fan_impressions = int(impressions * rng.random())
+    paid_impressions = int(impressions * rng.random() * 0.2)
+    values = {
+        'post_consumptions_by_type_unique': {'link clicks': rng.randint(0, max(1, impressions // 20)), 'other clicks': rng.randint(0, 500)},
+        'post_impressions_by_paid_non_paid_unique': {'total': impressions, 'paid': paid_impressions, 'unpaid': impressions - paid_impressions},
+        'post_video_views': rng.randint(0, 50000),
+        'post_impressions_fan_unique': fan_impressions,
+        'post_negative_feedback_by_type_unique': {'hide_clicks': rng.randint(0, 50), 'hide_all_clicks': rng.randint(0, 10)}
+    }
+    return {'data': [{'name': name, 'period': 'lifetime', 'values': [{'value': values.get(name, rng.randint(0, 1000))}]} for name in metric_names]}
+
+
+def mock_video_insights(video_id, metric_names=None):
+    rng = random.Random('{}/video_insights'.format(video_id))
+    views = rng.randint(0, 100000)
+    impressions = views + rng.randint(0, 300000)
+    values = {
+        'total_video_views': views,
+        'total_video_10s_views': int(views * rng.random()),
+        'total_video_complete_views': int(views * rng.random() * 0.5),
+        'total_video_avg_time_watched': rng.randint(1000, 60000),
+        'total_video_impressions': impressions,
+        'total_video_impressions_fan': int(impressions * rng.random()),
+        'total_video_views_paid': 0,
+        'total_video_views_unique': int(views * 0.8),
+        'total_video_views_by_distribution_type': {'page_owned': int(views * 0.7), 'shared': views - int(views * 0.7)}
+    }
+    return {'data': [{'name': name, 'period': 'lifetime', 'values': [{'value': value}]} for name, value in sorted(values.items())
+                     if metric_names is None or name in metric_names]}
+
+
+def mock_node(node_id, query):
+    if 'reactions' in query.get('fields', ''):
+        rng = random.Random('{}/reactions'.format(node_id))
+        return dict((reaction, summary(rng.randint(0, 1000))) for reaction in ('like', 'love', 'wow', 'haha', 'sad', 'angry'))
+    return {'id': node_id}
+
+
+def mock_url_shares(url):
+    # The same counts for a link whatever its query or fragment
+    rng = random.Random(url.split('#')[0].split('?')[0].rstrip('/'))
+    return {'id': url, 'share': {'share_count': rng.randint(0, 100000), 'comment_count': rng.randint(0, 5000)}}
+
+
+def graph_error(status_code, code, message):
+    return status_code, {'error': {'message': message, 'type': 'OAuthException', 'code': code}}
+
+
+def route_graph_get(path, query):
+    # Returns (status code, body) for a Graph API GET.  The version prefix (/v2.7) is optional
+    parts = [part for part in path.split('/') if part]
+    if len(parts) > 0 and parts[0].startswith('v') and parts[0][1:2].isdigit():
+        parts = parts[1:]
+
+    roll = random.random()
+    if roll < MOCK_THROTTLE_RATE:
+        count_stat('throttled')
+        return graph_error(400, 4, 'Application request limit reached')
+    if roll < MOCK_THROTTLE_RATE + MOCK_ERROR_RATE:
+        count_stat('errors')
+        return graph_error(500, 2, 'An unexpected error has occurred. Please retry your request later.')
+
+    if len(parts) == 0 and query.get('id'):
+        count_stat('url')
+        return 200, mock_url_shares(query['id'])
+    if len(parts) == 2 and parts[1] in ('posts', 'videos'):
+        count_stat(parts[1])
+        return 200, mock_listing(parts[0], parts[1], query, path)
+    if len(parts) >= 2 and parts[1] == 'insights':
+        count_stat('insights')
+        return 200, mock_post_insights(parts[0], parts[2].split(',') if len(parts) > 2 else [])
+    if len(parts) >= 2 and parts[1] == 'video_insights':
+        count_stat('video_insights')
+        return 200, mock_video_insights(parts[0], parts[2].split(',') if len(parts) > 2 else None)
+    if len(parts) == 1:
+        count_stat('node')
+        return 200, mock_node(parts[0], query)
+    return graph_error(400, 100, 'Unknown path components: /{}'.format('/'.join(parts)))
+
+
+def flat_query(query_string):
+    return dict((key, values[0]) for key, values in urlparse.parse_qs(query_string, keep_blank_values=True).items())
+
+
+def mock_bulk(body):
+    lines = [line for line in body.split('\n') if line.strip()]
+    items = []
+    for action_line in lines[::2]:
+        action = json.loads(action_line)
+        op_type = action.keys()[0]
+        doc_id = action[op_type].get('_id')
+        if random.random() < MOCK_BULK_REJECT_RATE:
+            count_stat('bulk_rejected')
+            items.append({op_type: {'_id': doc_id, 'status': 429, 'error': {'type': 'es_rejected_execution_exception'}}})
+        else:
+            count_stat('bulk_docs')
+            items.append({op_type: {'_id': doc_id, 'status': 201}})
+    return {'took': 1, 'errors': any('error' in item.values()[0] for item in items), 'items': items}
+
+
+class MockGraphRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status_code, body, usage=None):
+        content = json.dumps(body)
+        usage = max(MOCK_APP_USAGE, min(usage, 100)) if usage is not None else MOCK_APP_USAGE
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        if MOCK_USAGE_HEADERS_BOOL:
+            self.send_header('X-App-Usage', json.dumps({'call_count': usage, 'total_time': MOCK_APP_USAGE, 'total_cputime': MOCK_APP_USAGE}))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+        count_stat('bytes', len(content))
+
+    def wait(self):
+        if MOCK_LATENCY_MEDIAN_MS > 0:
+            time.sleep(random.lognormvariate(math.log(MOCK_LATENCY_MEDIAN_MS / 1000.0), MOCK_LATENCY_SIGMA))
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def do_GET(self):
+        count_stat('requests')
+        url = urlparse.urlparse(self.path)
+        if url.path in ('', '/') and not url.query:
+            # Elasticsearch ping/info
+            return self.send_json(200, {'version': {'number': '6.8.0'}, 'tagline': 'You Know, for Search'})
+        self.wait()
+        query = flat_query(url.query)
+        usage = record_token_calls(query.get('access_token'))
+        if usage is not None and usage > 100:
+            count_stat('token_throttled')
+            return self.send_json(*graph_error(400, 17, 'User request limit reached'), usage=usage)
+        status_code, body = route_graph_get(url.path, query)
+        self.send_json(status_code, body, usage)
+
+    def do_HEAD(self):
+        self.send_json(200, {})
+
+    def do_POST(self):
+        count_stat('requests')
+        url = urlparse.urlparse(self.path)
+        body = self.read_body()
+        self.wait()
+        if url.path.endswith('/_bulk'):
+            return self.send_json(200, mock_bulk(body))
+        if url.path.startswith('/_aliases') or url.path.startswith('/_template'):
+            return self.send_json(200, {'acknowledged': True})
+
+        # Graph batch request: every operation is routed as its own GET
+        count_stat('batch')
+        form = flat_query(body)
+        usage = record_token_calls(form.get('access_token'), len(json.loads(form.get('batch', '[]'))))
+        if usage is not None and usage > 100:
+            count_stat('token_throttled')
+            return self.send_json(*graph_error(400, 17, 'User request limit reached'), usage=usage)
+        results = []
+        for operation in json.loads(form.get('batch', '[]')):
+            operation_url = urlparse.urlparse('/' + operation['relative_url'].lstrip('/'))
+            status_code, operation_body = route_graph_get(operation_url.path, flat_query(operation_url.query))
+            results.append({'code': status_code, 'body': json.dumps(operation_body)})
+        self.send_json(200, results, usage)
+
+    def do_PUT(self):
+        count_stat('requests')
+        self.read_body()
+        self.send_json(200, {'acknowledged': True})
+
+    def do_DELETE(self):
+        count_stat('requests')
+        self.send_json(200, {'acknowledged': True})
+
+
+class MockGraphServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections aren't worth a traceback
+        pass
+
+
+mock_server = None
+mock_base_url = None
+
+
+def start_mock_graph_server(port=0):
+    # Serve on a daemon thread.  Returns the base URL e.g. http://127.0.0.1:8000
+    global mock_server, mock_base_url
+    mock_server = MockGraphServer(('127.0.0.1', port), MockGraphRequestHandler)
+    mock_base_url = 'http://127.0.0.1:{}'.format(mock_server.server_address[1])
+    t = threading.Thread(target=mock_server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return mock_base_url
+
+
+def stop_mock_graph_server():
+    mock_server.shutdown()
+    mock_server.server_close()
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    print 'Mock Graph API at {} | Ctrl+C to stop'.format(start_mock_graph_server(port))
+    while True:
+        time.sleep(3600)
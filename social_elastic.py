@@ -4,10 +4,13 @@ import json
 import datetime
 import calendar
 import time
+import threading
+import Queue
+import hashlib
+import sqlite3
 
 from elasticsearch import Elasticsearch, TransportError, ConnectionError, ConnectionTimeout
 import get_fb_data
-import get_insta_data
 
 # Facebook Globals
 OWNED_PAGES_TOKENS = {
@@ -23,29 +26,228 @@ MY_INSTA_USER_ID = MY_INSTA_TOKEN.split('.')[0]
 ELASTIC_HOSTS = [os.environ['ELASTIC_HOST_PROD2']]
 #ELASTIC_HOSTS = [os.environ['ELASTIC_HOST_DEV']]
 
-
-def create_bulk_req_elastic(json_data, index, doc_type, id_field):
-    action_data_string = ""
-    for i, json_post in enumerate(json_data):
+# Bulk requests are cut at whichever of these limits is reached first
+BULK_CHUNK_MAX_BYTES = 5 * 1024 * 1024
+BULK_CHUNK_MAX_DOCS = 1000
+# Chunks buffered per host; a slow host holds back serialisation rather than letting the whole run pile up in memory
+BULK_QUEUE_CHUNKS = 4
+BULK_MAX_ATTEMPTS = 5
+BULK_RETRY_SECONDS = 3
+# Per-document statuses worth resending: the cluster was too busy rather than the document being bad
+BULK_RETRYABLE_STATUSES = (429, 503)
+# Finished pages buffered between the scrapers and the bulk senders; scraping waits once this many are queued
+PIPELINE_QUEUE_PAGES = 8
+
+# Delta mode (--delta) upserts into these stable indices instead of a new snapshot, sending only documents whose content
+# changed since the last run.  Delete the fingerprint store to send everything again
+DELTA_FACEBOOK_INDEX = 'facebook-current'
+DELTA_INSTAGRAM_INDEX = 'instagram-current'
+FINGERPRINT_STORE_PATH = './facebook_output/fingerprints.sqlite'
+# Fields that change on every scrape regardless of the metrics
+FINGERPRINT_IGNORED_FIELDS = ('Timestamp',)
+
+
+def iter_bulk_actions(json_data, index, doc_type, id_field):
+    # (action line, document line) pairs of NDJSON for the Bulk API.  json_data can be any iterable e.g. a generator of rows
+    for json_post in json_data:
         index_action = {"index":{"_index":index, "_type":doc_type, "_id":json_post[id_field]}}
-        action_data_string += json.dumps(index_action, separators=(',', ':')) + '\n' + json.dumps(json_post, separators=(',', ':')) + '\n'
-    return action_data_string
-
-
-def insert_bulk_elastic(action_data_string, hosts):
-    return_ack_list = []
+        yield json.dumps(index_action, separators=(',', ':')) + '\n', json.dumps(get_fb_data.row_to_dict(json_post), separators=(',', ':')) + '\n'
+
+
+def iter_bulk_chunks(actions, max_bytes=BULK_CHUNK_MAX_BYTES, max_docs=BULK_CHUNK_MAX_DOCS):
+    # Group action pairs into lists bounded by size and count.  Pairs are kept apart so rejected documents can be resent alone
+    chunk = []
+    chunk_bytes = 0
+    for action_pair in actions:
+        pair_bytes = len(action_pair[0]) + len(action_pair[1])
+        if len(chunk) > 0 and (chunk_bytes + pair_bytes > max_bytes or len(chunk) >= max_docs):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(action_pair)
+        chunk_bytes += pair_bytes
+    if len(chunk) > 0:
+        yield chunk
+
+
+def send_bulk_chunk(es, host, chunk):
+    # Returns the per-document results of documents that still couldn't be indexed after BULK_MAX_ATTEMPTS
+    pending = chunk
+    for attempt in range(1, BULK_MAX_ATTEMPTS + 1):
+        try:
+            response = es.bulk(body=''.join(action_line + doc_line for action_line, doc_line in pending))
+        except (ConnectionError, ConnectionTimeout, TransportError) as e:
+            print e
+            if attempt == BULK_MAX_ATTEMPTS:
+                return [{'_id': json.loads(action_line)['index']['_id'], 'error': str(e)} for action_line, doc_line in pending]
+            print "\nRetrying in {} seconds".format(BULK_RETRY_SECONDS * attempt)
+            time.sleep(BULK_RETRY_SECONDS * attempt)
+            continue
+
+        if response.get('errors') == False:
+            return []
+
+        retry = []
+        failed = []
+        for action_pair, item in zip(pending, response['items']):
+            result = item.get('index')
+            if result.get('error') is None:
+                continue
+            if result.get('status') in BULK_RETRYABLE_STATUSES and attempt < BULK_MAX_ATTEMPTS:
+                retry.append(action_pair)
+            else:
+                failed.append(result)
+        if len(retry) == 0:
+            return failed
+        print "{} documents rejected by {}. Resending them in {} seconds".format(len(retry), host, BULK_RETRY_SECONDS * attempt)
+        time.sleep(BULK_RETRY_SECONDS * attempt)
+        pending = retry
+
+
+def send_bulk_chunks_to_host(host, queue, summary):
+    es = Elasticsearch(host)
+    while True:
+        chunk = queue.get()
+        if chunk is None:
+            return
+        try:
+            failed = send_bulk_chunk(es, host, chunk)
+        except Exception as e:
+            # Keep draining so the producer is never left blocked on a full queue
+            print e
+            failed = [{'_id': json.loads(action_line)['index']['_id'], 'error': str(e)} for action_line, doc_line in chunk]
+        summary['indexed'] += len(chunk) - len(failed)
+        summary['errors'].extend(failed)
+
+
+def stream_bulk_elastic(actions, hosts):
+    # Serialise each document once and send the chunks to every host concurrently, one sender thread per host.
+    # Returns a summary per host of documents indexed and those rejected
+    queues = []
+    threads = []
+    summaries = []
     for host in hosts:
-        es = Elasticsearch(host)
-        success = False
-        while success == False:
-            try:
-                return_ack_list.append(es.bulk(body=action_data_string))
-                success = True
-            except (ConnectionError, ConnectionTimeout, TransportError) as e:
-                print e
-                print "\nRetrying in 3 seconds"
-                time.sleep(3)
-    return return_ack_list
+        queue = Queue.Queue(maxsize=BULK_QUEUE_CHUNKS)
+        summary = {'host': host, 'indexed': 0, 'errors': []}
+        t_i = threading.Thread(target=send_bulk_chunks_to_host, args=[host, queue, summary])
+        t_i.setDaemon(True)
+        t_i.start()
+        queues.append(queue)
+        threads.append(t_i)
+        summaries.append(summary)
+
+    for chunk in iter_bulk_chunks(actions):
+        for queue in queues:
+            queue.put(chunk)
+    for queue in queues:
+        queue.put(None)
+
+    for t_i in threads:
+        # Join with a timeout so Ctrl+C still reaches the main thread
+        while t_i.isAlive():
+            t_i.join(timeout=360000000)
+    return summaries
+
+
+def print_bulk_summaries(summaries, index_alias):
+    if all(len(summary['errors']) == 0 for summary in summaries):
+        print "Success"
+    else:
+        print "Errors occured for new index {}".format(index_alias)
+        for summary in summaries:
+            print "{}: {} indexed, {} failed".format(summary['host'], summary['indexed'], len(summary['errors']))
+            for el in summary['errors']:
+                print "_id: " + el.get('_id')
+                print el.get('error')
+
+
+def document_fingerprint(row):
+    content = dict((key, value) for key, value in row.iteritems() if key not in FINGERPRINT_IGNORED_FIELDS)
+    return hashlib.sha1(json.dumps(content, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
+class FingerprintStore(object):
+    # SQLite store of a content hash per (index, doc type, document id) as last indexed.  New hashes are held as pending until
+    # commit() so documents a host rejected are sent again next run
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.changed = 0
+        self.unchanged = 0
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS fingerprints (index_name TEXT, doc_type TEXT, doc_id TEXT, digest TEXT, '
+                                'PRIMARY KEY (index_name, doc_type, doc_id))')
+
+    def changed_rows(self, rows, index, doc_type, id_field):
+        # Rows that are new or whose content differs from what was last indexed
+        changed_rows = []
+        with self.lock:
+            for row in rows:
+                doc_id = unicode(row[id_field])
+                digest = document_fingerprint(row)
+                stored = self.connection.execute('SELECT digest FROM fingerprints WHERE index_name = ? AND doc_type = ? AND doc_id = ?', (index, doc_type, doc_id)).fetchone()
+                if stored is not None and stored[0] == digest:
+                    self.unchanged += 1
+                    continue
+                self.pending[(index, doc_type, doc_id)] = digest
+                self.changed += 1
+                changed_rows.append(row)
+        return changed_rows
+
+    def commit(self, summaries):
+        # Store the pending hashes of documents every host indexed
+        failed_ids = set(unicode(error.get('_id')) for summary in summaries for error in summary['errors'])
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)',
+                                        [key + (digest,) for key, digest in self.pending.iteritems() if key[2] not in failed_ids])
+            self.connection.commit()
+            self.pending = {}
+
+    def report(self):
+        print "Delta: {} changed documents sent, {} unchanged skipped".format(self.changed, self.unchanged)
+
+
+def start_scrape_producer(pages_queue, page_ids, from_date, until_date, scrape_function, process_item_function, index, doc_type, id_field,
+                          fingerprints=None):
+    # Scrape on a daemon thread, queueing each page's bulk actions as soon as that page is finished.
+    # Ends with ('done', doc_type, number of rows), or ('error', doc_type, exc_info) if the scrape raised
+    page_row_counts = []
+
+    def queue_page_rows(page_id, rows):
+        page_row_counts.append(len(rows))
+        if fingerprints is not None:
+            rows = fingerprints.changed_rows(rows, index, doc_type, id_field)
+        pages_queue.put(('actions', doc_type, list(iter_bulk_actions(rows, index, doc_type, id_field))))
+
+    def produce():
+        try:
+            get_fb_data.scrape_fb_pages_items(page_ids, from_date, until_date, scrape_function, process_item_function, queue_page_rows, keep_rows_bool=False)
+            pages_queue.put(('done', doc_type, sum(page_row_counts)))
+        except Exception:
+            pages_queue.put(('error', doc_type, sys.exc_info()))
+
+    t_i = threading.Thread(target=produce)
+    t_i.setDaemon(True)
+    t_i.start()
+    return t_i
+
+
+def iter_queued_actions(pages_queue, num_producers, doc_counts):
+    # Drain the pages queue until every producer is done, filling in doc_counts as each one finishes.
+    # A scrape error is re-raised here, in the thread doing the indexing
+    while len(doc_counts) < num_producers:
+        # Get with a timeout so Ctrl+C still reaches the main thread
+        message, doc_type, value = pages_queue.get(timeout=360000000)
+        if message == 'actions':
+            for action in value:
+                yield action
+        elif message == 'done':
+            doc_counts[doc_type] = value
+        else:
+            raise value[0], value[1], value[2]
 
 
 def update_alias(source_index, alias_index, hosts):
@@ -65,6 +267,7 @@ def update_alias(source_index, alias_index, hosts):
 def insert_ig_followers(user_id, access_token, index, doc_type):
     return_ack_list = []
 
+    import get_insta_data
     num_followers = get_insta_data.get_followers(user_id, access_token)
     followers_insert_timestamp = datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z'
 
@@ -117,34 +320,32 @@ def is_date_string(date_string):
         return False
 
 
-def ig_main(local_from_date):
+def ig_main(local_from_date, delta_bool=False):
+        # Imported here so Facebook runs don't load the Instagram scraper and its dependencies
+        import get_insta_data
         instagram_doc_type = 'instagram-media-endpoint'
 
         local_now = datetime.datetime.now()
         index_suffix = local_now.strftime('%Y%m%d-%H%M')
-        instagram_index = 'instagram-' + index_suffix
+        instagram_index = DELTA_INSTAGRAM_INDEX if delta_bool else 'instagram-' + index_suffix
         instagram_index_alias = 'instagram'
+        fingerprints = FingerprintStore(FINGERPRINT_STORE_PATH) if delta_bool else None
 
         api_scraped_rows = get_insta_data.scrape_insta_items(MY_INSTA_USER_ID, local_from_date, MY_INSTA_TOKEN)
         posts_with_views = get_insta_data.append_views(api_scraped_rows)
         posts_with_views_impressions = get_insta_data.append_social_analytics(posts_with_views)
 
-        # Create request
-        action_data_string = create_bulk_req_elastic(posts_with_views_impressions, instagram_index, instagram_doc_type, 'Post ID')
+        if fingerprints is not None:
+            posts_with_views_impressions = fingerprints.changed_rows(posts_with_views_impressions, instagram_index, instagram_doc_type, 'Post ID')
         print "\nInserting {} documents into Elasticsearch at {}".format(str(len(posts_with_views_impressions)), ELASTIC_HOSTS)
         
         # Insert documents via Bulk API
-        insert_acks = insert_bulk_elastic(action_data_string, ELASTIC_HOSTS)
-        if all(response.get('errors') == False for response in insert_acks):
-            print "Success"
-        else:
-            print "Errors occured with new index {}".format(instagram_index_alias)
-            for host_el in insert_acks:
-                for el in host_el['items']:
-                    if el.get('index').get('error') is not None:
-                        print "_id: " + el.get('index').get('_id')
-                        print el.get('index').get('error')
-            #sys.exit()
+        bulk_actions = iter_bulk_actions(posts_with_views_impressions, instagram_index, instagram_doc_type, 'Post ID')
+        bulk_summaries = stream_bulk_elastic(bulk_actions, ELASTIC_HOSTS)
+        print_bulk_summaries(bulk_summaries, instagram_index_alias)
+        if fingerprints is not None:
+            fingerprints.commit(bulk_summaries)
+            fingerprints.report()
         
         # Redirect alias so Kibana picks up latest snapshot
         print "\nUpdating Instagram alias"
@@ -167,7 +368,7 @@ def ig_main(local_from_date):
             print "\nFailed to insert followers into Elasticsearch at {}".format(ELASTIC_HOSTS)
 
 
-def fb_main(local_from_date):
+def fb_main(local_from_date, delta_bool=False):
     facebook_video_doctype = 'facebook-video-endpoint'
     facebook_post_doctype = 'facebook-post-endpoint'
     
@@ -175,34 +376,28 @@ def fb_main(local_from_date):
     utc_posix_until_date = calendar.timegm(utc_now.timetuple())
 
     index_suffix = datetime.datetime.now().strftime('%Y%m%d-%H%M')
-    facebook_index = 'facebook-' + index_suffix
+    facebook_index = DELTA_FACEBOOK_INDEX if delta_bool else 'facebook-' + index_suffix
     facebook_index_alias = 'facebook'
-
-    print "Processing Videos"
-    fb_video_data = get_fb_data.scrape_fb_pages_items(OWNED_PAGES_TOKENS.keys(), local_from_date, utc_posix_until_date, get_fb_data.get_fb_page_video_data, get_fb_data.process_fb_page_video_all_metrics)
-    print "\nProcessing Posts"
-    fb_post_data = get_fb_data.scrape_fb_pages_items(OWNED_PAGES_TOKENS.keys(), local_from_date, utc_posix_until_date, get_fb_data.get_fb_page_post_data, get_fb_data.process_fb_page_post)
-
-    print "\nInserting {} post documents and {} video documents into Elasticsearch at {}".format(str(len(fb_post_data)), str(len(fb_video_data)), ELASTIC_HOSTS)
-    for host in ELASTIC_HOSTS:
-        action_data_string_video = create_bulk_req_elastic(fb_video_data, facebook_index, facebook_video_doctype, 'Video ID')
-        action_data_string_post = create_bulk_req_elastic(fb_post_data, facebook_index, facebook_post_doctype, 'Post ID')
-
-        # Insert video documents via Bulk API
-        insert_acks_video = insert_bulk_elastic(action_data_string_video, ELASTIC_HOSTS)
-        # Insert post documents via Bulk API
-        insert_acks_post = insert_bulk_elastic(action_data_string_post, ELASTIC_HOSTS)
-
-    if all(response.get('errors') == False for response in insert_acks_video + insert_acks_post):
-        print "Success"
-    else:
-        print "Errors occured for new index {}".format(facebook_index_alias)
-        for host_el in insert_acks_video + insert_acks_post:
-            for el in host_el['items']:
-                if el.get('index').get('error') is not None:
-                    print "_id: " + el.get('index').get('_id')
-                    print el.get('index').get('error')
-        #sys.exit()
+    fingerprints = FingerprintStore(FINGERPRINT_STORE_PATH) if delta_bool else None
+
+    # Videos and posts are scraped at the same time, and each page's documents are indexed as soon as that page is
+    # finished rather than after the whole scrape
+    print "Processing Videos and Posts, inserting into Elasticsearch at {}".format(ELASTIC_HOSTS)
+    pages_queue = Queue.Queue(maxsize=PIPELINE_QUEUE_PAGES)
+    start_scrape_producer(pages_queue, OWNED_PAGES_TOKENS.keys(), local_from_date, utc_posix_until_date, get_fb_data.get_fb_page_video_data,
+                          get_fb_data.process_fb_page_video_all_metrics, facebook_index, facebook_video_doctype, 'Video ID', fingerprints)
+    start_scrape_producer(pages_queue, OWNED_PAGES_TOKENS.keys(), local_from_date, utc_posix_until_date, get_fb_data.get_fb_page_post_data,
+                          get_fb_data.process_fb_page_post, facebook_index, facebook_post_doctype, 'Post ID', fingerprints)
+
+    doc_counts = {}
+    bulk_summaries = stream_bulk_elastic(iter_queued_actions(pages_queue, 2, doc_counts), ELASTIC_HOSTS)
+    print "\nScraped {} post documents and {} video documents".format(doc_counts[facebook_post_doctype], doc_counts[facebook_video_doctype])
+    for summary in bulk_summaries:
+        print "{}: {} documents indexed".format(summary['host'], summary['indexed'])
+    print_bulk_summaries(bulk_summaries, facebook_index_alias)
+    if fingerprints is not None:
+        fingerprints.commit(bulk_summaries)
+        fingerprints.report()
 
     print "\nUpdating Facebook alias"
     update_alias_acks = update_alias(facebook_index, facebook_index_alias, ELASTIC_HOSTS)
@@ -214,11 +409,19 @@ def fb_main(local_from_date):
 
 if __name__ == '__main__':
 
-    if not is_date_string(sys.argv[2]) or len(sys.argv) != 3:
-        print "python {} <fb/ig> <from-date: yyyy-mm-dd>".format(sys.argv[0])
+    # --delta upserts changed documents into a stable index rather than indexing a new snapshot
+    delta_bool = '--delta' in sys.argv
+    # --reprocess rebuilds the Facebook documents from get_fb_data's raw store instead of scraping
+    get_fb_data.REPROCESS_BOOL = '--reprocess' in sys.argv
+    # --shards scrapes the Facebook pages on one worker process per core through get_fb_data's shard queue
+    get_fb_data.SHARD_BOOL = '--shards' in sys.argv
+    args = [arg for arg in sys.argv if not arg.startswith('--')]
+
+    if len(args) != 3 or not is_date_string(args[2]):
+        print "python {} <fb/ig> <from-date: yyyy-mm-dd> [--delta] [--reprocess] [--shards]".format(sys.argv[0])
         sys.exit()
     else:
-        local_from_date = datetime.datetime.strptime(sys.argv[2], '%Y-%m-%d')
+        local_from_date = datetime.datetime.strptime(args[2], '%Y-%m-%d')
 
     # Verify ES clusters are reachable
     for host in ELASTIC_HOSTS:
@@ -235,7 +438,7 @@ if __name__ == '__main__':
     # Only need to put a template in once, but little harm in overwriting
     put_fb_template('facebook_template', 'facebook-*', 'Headline', ELASTIC_HOSTS)
 
-    if sys.argv[1] == 'fb':
-        fb_main(local_from_date)
-    elif sys.argv[1] == 'ig':
-        ig_main(local_from_date)
\ No newline at end of file
+    if args[1] == 'fb':
+        fb_main(local_from_date, delta_bool)
+    elif args[1] == 'ig':
+        ig_main(local_from_date, delta_bool)
\ No newline at end of file